@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import asyncio
+import datetime
+
+import aiohttp
+
+from pymisp.tools.abstractgenerator import AbstractMISPObjectGenerator
+from PyMISPHelper import PyMISPHelper, CircuitBreaker, MissingID, \
+    NotInEventMode, MISPObjectHasNoName
+from MISPObjectGenerators import ObjectGeneratorRegistry
+
+
+class AsyncPyMISPHelper:
+    MODE_NORMAL = PyMISPHelper.MODE_NORMAL
+    MODE_DAILY = PyMISPHelper.MODE_DAILY
+
+    def __init__(self, misp_url, misp_key, verifycert=True,
+                 mode_type=MODE_NORMAL, verbose=False, max_concurrency=100,
+                 timeout=120, template_cache_ttl=3600, timezone=None):
+        """
+        asyncio version of PyMISPHelper, talking to the MISP REST API with
+        aiohttp. It must be created and used inside a running event loop
+
+        Parameters:
+        -----------
+        misp_url : str
+            The MISP URL
+        misp_key : str
+            The MISP API key
+        verifycert : bool
+            Should the certificate be verified
+        mode_type : int
+            MODE_NORMAL or MODE_DAILY (see `daily_mode`)
+        max_concurrency : int
+            Maximum number of requests in flight to MISP
+        timeout : float
+            Total timeout of a request in seconds
+        template_cache_ttl : int
+            Number of seconds the object template index is kept
+        timezone : tzinfo | str
+            The timezone in which the days of the daily events start
+
+        Examples:
+        ---------
+        >>> pm = AsyncPyMISPHelper(misp_url, misp_key)
+        >>> await pm.daily_mode("honeypot_1")
+        >>> await pm.add_attribute("ip-src", "9.9.9.9", category="Network activity")
+        >>> await pm.add_object("cowrie", {"session": "session_id", "username": "admin", "password": "admin", "protocol": "telnet"})
+        >>> await pm.add_sighting(uuid="5a9e6785-2400-4b6a-a707-4581950d210f")
+        >>> await pm.close()
+        """
+        self.misp_url = misp_url.rstrip('/') + '/'
+        self.misp_key = misp_key
+        self.verifycert = verifycert
+        self.mode_type = mode_type
+        self.verbose = verbose
+        self.timeout = timeout
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # see `enable_circuit_breaker`
+        self.circuit_breaker = None
+        self.session = aiohttp.ClientSession(
+            headers={'Authorization': misp_key,
+                     'Accept': 'application/json',
+                     'content-type': 'application/json',
+                     'User-Agent': 'AsyncPyMISPHelper'},
+            connector=aiohttp.TCPConnector(limit=max_concurrency,
+                                           ssl=None if verifycert else False),
+            timeout=aiohttp.ClientTimeout(total=timeout))
+
+        self.current_date = None
+        self.timezone = PyMISPHelper._get_timezone(timezone)
+        self._rollover_deadline = 0
+        self._daily_lock = asyncio.Lock()
+        self.event_cache_redis = None
+
+        self.template_cache_ttl = template_cache_ttl
+        self._template_index = None
+        self._template_index_time = None
+        self._template_lock = asyncio.Lock()
+
+        # Map object_name with their constructor, imported on first use
+        self.dico_object = ObjectGeneratorRegistry()
+
+    def log(self, msg):
+        if self.verbose:
+            print(msg)
+
+    async def close(self):
+        await self.session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def _request(self, method, path, data=None):
+        if data is not None and not isinstance(data, str):
+            data = json.dumps(data)
+        async with self.semaphore:
+            start = time.time()
+            try:
+                async with self.session.request(method, self.misp_url + path,
+                                                data=data) as resp:
+                    text = await resp.text()
+            except Exception:
+                if self.circuit_breaker is not None:
+                    self.circuit_breaker.record(False, time.time() - start)
+                raise
+            if self.circuit_breaker is not None:
+                self.circuit_breaker.record(
+                    not self.circuit_breaker.is_failure_status(resp.status),
+                    time.time() - start)
+        try:
+            return json.loads(text)
+        except ValueError:
+            # MISP answered with a non-JSON content
+            return text
+
+    def enable_circuit_breaker(self, **kargs):
+        """
+        Track the health of MISP (see PyMISPHelper.enable_circuit_breaker)
+        """
+        self.circuit_breaker = CircuitBreaker(**kargs)
+        return self.circuit_breaker
+
+    def normal_mode(self):
+        """
+        Switch to normal mode
+        """
+        self.mode_type = self.MODE_NORMAL
+
+    # DAILY
+    async def daily_mode(self, daily_event_name):
+        """
+        Switch to daily mode (see PyMISPHelper.daily_mode)
+        """
+        self.current_date = None
+        self._rollover_deadline = 0
+        self.daily_event_name = daily_event_name+' {}'  # used by format
+        self.mode_type = self.MODE_DAILY
+        self.eventID_to_push = await self.get_daily_event_id()
+
+    def enable_shared_event_cache(self, redis_serv,
+                                  prefix='PyMISPHelper:daily_event',
+                                  ttl=2*24*3600, lock_timeout=60):
+        """
+        Share the daily event ids between processes through redis, with the
+        same keys as PyMISPHelper.enable_shared_event_cache
+        Parameters:
+        -----------
+        redis_serv : redis.asyncio.StrictRedis
+            The asyncio redis connection used to store the ids and the lock
+        """
+        self.event_cache_redis = redis_serv
+        self.event_cache_prefix = prefix
+        self.event_cache_ttl = ttl
+        self.event_cache_lock_timeout = lock_timeout
+
+    def today(self):
+        return datetime.datetime.now(self.timezone).date()
+
+    async def get_daily_event_id(self):
+        """
+        Return the correct event id if daily mode is activated
+        """
+        if self.mode_type != self.MODE_DAILY:
+            raise NotInEventMode('Daily mode not activated')
+        if time.monotonic() >= self._rollover_deadline:  # refresh id
+            async with self._daily_lock:
+                if time.monotonic() >= self._rollover_deadline:
+                    self.eventID_to_push = await self.fetch_daily_event_id()
+                    now = datetime.datetime.now(self.timezone)
+                    midnight = datetime.datetime.combine(
+                        now.date() + datetime.timedelta(days=1),
+                        datetime.time(), tzinfo=now.tzinfo)
+                    self._rollover_deadline = time.monotonic() + \
+                        midnight.timestamp() - now.timestamp()
+        return self.eventID_to_push
+
+    async def fetch_daily_event_id(self, date=None):
+        """
+        Get the correct event id from the shared cache, or from MISP
+        """
+        if self.mode_type != self.MODE_DAILY:
+            raise NotInEventMode('Daily mode is disabled. Switch to daily mode required to access this function')
+        is_today = date is None
+        if is_today:
+            date = self.today()
+        serv = self.event_cache_redis
+        if serv is None:
+            e_id = await self.find_or_create_daily_event(date)
+        else:
+            cache_key = '{}:{}'.format(self.event_cache_prefix, self.daily_event_name.format(date))
+            cached = await serv.get(cache_key)
+            if cached is None:
+                async with serv.lock(cache_key + ':lock', timeout=self.event_cache_lock_timeout,
+                                     blocking_timeout=self.event_cache_lock_timeout):
+                    # another process may have created it while we waited
+                    cached = await serv.get(cache_key)
+                    if cached is None:
+                        e_id = await self.find_or_create_daily_event(date)
+                        await serv.set(cache_key, e_id, ex=self.event_cache_ttl)
+            if cached is not None:
+                e_id = int(cached)
+        if is_today:
+            self.current_date = date
+        return e_id
+
+    async def find_or_create_daily_event(self, date):
+        """
+        Search MISP for the daily event of the given day, and create it if
+        it does not exist
+        """
+        to_match = self.daily_event_name.format(date)
+        results = await self._request('POST', 'events/index',
+                                      {'eventinfo': to_match,
+                                       'datefrom': str(date),
+                                       'dateuntil': str(date)})
+        if isinstance(results, dict):
+            results = results.get('response', [])
+        for e in results if isinstance(results, list) else []:
+            if e['info'] == to_match:
+                self.log('Found: ' + e['info'] + '->' + e['id'])
+                return int(e['id'])
+        created_event = (await self.create_daily_event(date=date))['Event']
+        new_id = created_event['id']
+        self.log('New event created: ' + new_id)
+        return int(new_id)
+
+    async def create_daily_event(self, distribution=0, threat_level_id=3,
+                                 analysis=0, date=None, published=False):
+        """
+        Create the daily event on MISP, for the given date (today by default)
+        """
+        day = date if date is not None else self.today()
+        event = {'Event': {'info': self.daily_event_name.format(day),
+                           'distribution': distribution,
+                           'threat_level_id': threat_level_id,
+                           'analysis': analysis,
+                           'date': str(day),
+                           'published': published}}
+        return await self._request('POST', 'events', event)
+
+    async def _get_event_id(self, event_id):
+        if self.mode_type == self.MODE_NORMAL and event_id is None:
+            raise MissingID("Trying to push an item without supplying an event id")
+        elif self.mode_type == self.MODE_DAILY and event_id is None:
+            event_id = await self.get_daily_event_id()
+        return event_id
+
+    @staticmethod
+    def _load(data):
+        if type(data) is str:
+            return json.loads(data)
+        elif type(data) is dict:
+            return dict(data)
+        return None
+
+    # OBJECT
+    async def add_object(self, name, dict_values, event_id=None):
+        """
+        Add an object to MISP (see PyMISPHelper.add_object)
+        """
+        event_id = await self._get_event_id(event_id)
+        templateID = await self.get_object_template(name)
+
+        if type(dict_values) is dict:
+            MISP_ObjectConstructor = self.dico_object[name]
+            MISP_Object = MISP_ObjectConstructor(dict_values)
+        elif isinstance(dict_values, AbstractMISPObjectGenerator) and dict_values.name == name:
+            MISP_Object = dict_values
+        else:
+            self.log("Type error")
+            return
+
+        r = await self._request('POST', 'objects/add/{}/{}'.format(event_id, templateID),
+                                MISP_Object.to_json())
+        if PyMISPHelper._has_errors(r):
+            print(r)
+            return r
+
+    async def add_object_per_json(self, data, event_id=None):
+        """
+        Add an object to MISP from a JSON or dict containing the field 'name'
+        """
+        dict_data = self._load(data)
+        if dict_data is None:
+            self.log('Type error!')
+            return 'error'
+        try:
+            name = dict_data.pop('name')
+        except KeyError:
+            raise MISPObjectHasNoName("Supplied JSON does not contain name field.")
+        return await self.add_object(name, dict_data, event_id=event_id)
+
+    # SIGHTING
+    async def add_sighting(self, value=None, uuid=None, id=None, source=None, type=0, timestamp=None, **kargs):
+        """
+        Make a single sighting (see PyMISPHelper.add_sighting)
+        """
+        sighting = dict(kargs, value=value, uuid=uuid, id=id, source=source,
+                        type=type, timestamp=timestamp)
+        sighting = {k: v for k, v in sighting.items() if v is not None}
+        r = await self._request('POST', 'sightings/add/', sighting)
+        if PyMISPHelper._has_errors(r):
+            print(r)
+            return r
+
+    async def add_sighting_per_json(self, data):
+        """
+        Make a sighting from a JSON or dict
+        """
+        dict_data = self._load(data)
+        if dict_data is None:
+            self.log('Type error!')
+            return 'error'
+        return await self.add_sighting(**dict_data)
+
+    # ATTRIBUTE
+    async def add_attribute(self, type_value, value, event_id=None, category=None, to_ids=False, comment=None, distribution=None, proposal=False, **kargs):
+        """
+        Add an attribute to MISP (see PyMISPHelper.add_attribute)
+        """
+        event_id = await self._get_event_id(event_id)
+        attribute = dict(kargs, type=type_value, value=value, category=category,
+                         to_ids=to_ids, comment=comment, distribution=distribution)
+        attribute = {k: v for k, v in attribute.items() if v is not None}
+        if proposal:
+            r = await self._request('POST', 'shadow_attributes/add/{}'.format(event_id),
+                                    {'ShadowAttribute': attribute})
+        else:
+            r = await self._request('POST', 'attributes/add/{}'.format(event_id), attribute)
+        if PyMISPHelper._has_errors(r):
+            print(r)
+            return r
+
+    async def add_attribute_per_json(self, data, event_id=None, proposal=False):
+        """
+        Push an attribute to MISP from a JSON or dict (Required: type, value)
+        """
+        dict_data = self._load(data)
+        if dict_data is None:
+            self.log('Type error!')
+            return 'error'
+        type_value = dict_data.pop('type')
+        value = dict_data.pop('value')
+        return await self.add_attribute(type_value, value, event_id=event_id,
+                                        proposal=proposal, **dict_data)
+
+    async def add_attributes_bulk(self, attributes, event_id=None):
+        """
+        Add several attributes to MISP in a single request
+        """
+        event_id = await self._get_event_id(event_id)
+        items = [json.loads(x) if type(x) is str else x for x in attributes]
+        r = await self._request('POST', 'attributes/add/{}'.format(event_id), items)
+        if PyMISPHelper._has_errors(r):
+            print(r)
+            return r
+
+    # OTHERS
+    async def get_object_template(self, name):
+        """
+        Get the template id for the given MISP object name, from an index
+        refreshed after `template_cache_ttl` seconds or on a miss (at most
+        every PyMISPHelper.TEMPLATE_MISS_INTERVAL seconds)
+        """
+        async with self._template_lock:
+            if self._template_index is None or (
+                    self.template_cache_ttl is not None and
+                    time.time() - self._template_index_time > self.template_cache_ttl):
+                await self.refresh_object_templates()
+        templateID = self._template_index.get(name)
+        if templateID is None and self._template_miss_refresh_due():
+            async with self._template_lock:
+                if self._template_miss_refresh_due():
+                    await self.refresh_object_templates()
+            templateID = self._template_index.get(name)
+        if templateID is None:
+            valid_types = ", ".join(sorted(self._template_index.keys()))
+            print("Template for type %s not found! Valid types are: %s" % (name, valid_types))
+        return templateID
+
+    def _template_miss_refresh_due(self):
+        return time.time() - self._template_index_time >= PyMISPHelper.TEMPLATE_MISS_INTERVAL
+
+    async def refresh_object_templates(self):
+        """
+        Download the object template index from MISP
+        """
+        templates = await self._request('GET', 'objectTemplates')
+        if isinstance(templates, dict):
+            templates = templates.get('response', [])
+        self._template_index = {x['ObjectTemplate']['name']: x['ObjectTemplate']['id'] for x in templates}
+        self._template_index_time = time.time()
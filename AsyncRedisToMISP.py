@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+
+import time
+import zlib
+import asyncio
+
+import redis.asyncio
+
+import WireFormat
+from PyMISPHelper import PyMISPHelper
+from RedisToMISP import RedisToMISP, NoValidKey, KeyScheduler, parse_key_settings
+
+
+class AsyncRedisToMISP:
+    SUFFIX_SIGH = RedisToMISP.SUFFIX_SIGH
+    SUFFIX_ATTR = RedisToMISP.SUFFIX_ATTR
+    SUFFIX_OBJ = RedisToMISP.SUFFIX_OBJ
+    SUFFIX_LIST = RedisToMISP.SUFFIX_LIST
+    ORDERING_FIELDS = RedisToMISP.ORDERING_FIELDS
+
+    get_suffix = RedisToMISP.get_suffix
+    build_error = RedisToMISP.build_error
+
+    def __init__(self, host, port, db, keynames, AsyncPyMISPHelper, sleep=1,
+                 event_id=None, daily_event_name=None, keynameError=None,
+                 pop_batch=100, max_in_flight=100, error_batch=100,
+                 key_weights=None, key_priorities=None, key_quotas=None,
+                 round_weight=100):
+        """
+        asyncio counterpart of RedisToMISP.consume: items are popped by
+        batch with BRPOP and pushed concurrently with an AsyncPyMISPHelper.
+        Items sharing the same value (see RedisToMISP.ORDERING_FIELDS) are
+        pushed in order
+
+        Parameters:
+        -----------
+        pop_batch : int
+            Maximum number of items taken from redis in a single round trip
+        max_in_flight : int
+            Maximum number of items being pushed to MISP at the same time
+        error_batch : int
+            Number of errors written to the error list at once
+        key_weights, key_priorities, key_quotas : dict
+            Share of the keys in each round (see RedisToMISP.KeyScheduler)
+        """
+        self.host = host
+        self.port = port
+        self.db = db
+        self.prefixes = list(keynames)
+        self.keynames = []
+        for k in keynames:
+            for s in self.SUFFIX_LIST:
+                self.keynames.append(k+s)
+        self.sleep = sleep
+        self.event_id = event_id
+        self.event_name = daily_event_name
+        self.keynameError = keynameError
+        self.pop_batch = max(1, pop_batch)
+        self.max_in_flight = max_in_flight
+        self.error_batch = max(1, error_batch)
+        self._error_buffer = []
+        self.scheduler = KeyScheduler(self.keynames, weights=key_weights,
+                                      priorities=key_priorities,
+                                      quotas=key_quotas,
+                                      default_weight=round_weight,
+                                      default_quota=self.pop_batch)
+
+        self.serv = redis.asyncio.StrictRedis(host=self.host, port=self.port,
+                                              db=self.db, decode_responses=True,
+                                              encoding_errors='surrogateescape')
+        self.pymisphelper = AsyncPyMISPHelper
+        self.in_flight = asyncio.Semaphore(max_in_flight)
+        # asyncio locks are fair, items of a shard are pushed in pop order
+        self.ordering_locks = [asyncio.Lock() for i in range(max_in_flight)]
+        self.tasks = set()
+
+    async def advertise_wire_format(self):
+        # see RedisToMISP.advertise_wire_format
+        self._last_advertisement = time.time()
+        for k in self.prefixes:
+            await self.serv.hset(k + ':wire', WireFormat.capabilities(), int(self._last_advertisement))
+
+    async def consume(self):
+        await self.advertise_wire_format()
+        if self.event_id is None:
+            await self.pymisphelper.daily_mode(self.event_name)
+        while True:
+            if time.time() - self._last_advertisement >= RedisToMISP.WIRE_TTL / 3.0:
+                await self.advertise_wire_format()
+            breaker = self.pymisphelper.circuit_breaker
+            if breaker is not None and breaker.wait_time() > 0:
+                # MISP is unhealthy, leave the items in redis
+                await asyncio.sleep(min(breaker.wait_time(), self.sleep))
+                continue
+            for key, data in await self.pop_scheduled() or await self.pop_blocking():
+                await self.in_flight.acquire()
+                task = asyncio.ensure_future(self.process(key, data))
+                self.tasks.add(task)
+                task.add_done_callback(self._task_done)
+            await self.flush_errors()
+
+    def _task_done(self, task):
+        self.tasks.discard(task)
+        self.in_flight.release()
+
+    async def drain(self):
+        """
+        Wait for the items being pushed to MISP
+        """
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def pop_many(self, key, count):
+        pipe = self.serv.pipeline(transaction=False)
+        for i in range(count):
+            pipe.rpop(key)
+        return [x for x in await pipe.execute() if x is not None]
+
+    async def pop_scheduled(self):
+        """
+        Return a list of (key, data) popped during a round of the deficit
+        round-robin over the keys (see RedisToMISP.pop_scheduled)
+        """
+        items = []
+        for key in self.scheduler.start_round():
+            count = self.scheduler.request(key)
+            while count > 0:
+                raws = await self.pop_many(key, count)
+                self.scheduler.served(key, count, len(raws))
+                for raw in raws:
+                    items += await self.decode_items(key, raw)
+                count = self.scheduler.request(key)
+        return items
+
+    async def pop_blocking(self):
+        """
+        Return a list of (key, data) popped from the first non-empty key
+        """
+        popped = await self.serv.brpop(self.scheduler.keys, timeout=self.sleep)
+        if popped is None:
+            return []
+        key, raw = popped
+        items = [raw]
+        if self.pop_batch > 1:
+            pipe = self.serv.pipeline(transaction=False)
+            for i in range(self.pop_batch - 1):
+                pipe.rpop(key)
+            items += [x for x in await pipe.execute() if x is not None]
+        return [item for raw in items for item in await self.decode_items(key, raw)]
+
+    async def decode_items(self, key, raw):
+        """
+        Return the list of (key, data) of a redis entry (see
+        RedisToMISP.decode_items)
+        """
+        try:
+            items = WireFormat.WireFormat.decode_many(raw)
+        except Exception as error:
+            await self.save_error_to_redis(error, raw, key=key)
+            return []
+        return [(key, data) for data in items]
+
+    def get_ordering_lock(self, data):
+        if isinstance(data, dict):
+            for field in self.ORDERING_FIELDS:
+                if data.get(field) is not None:
+                    h = zlib.crc32(str(data[field]).encode('utf8'))
+                    return self.ordering_locks[h % len(self.ordering_locks)]
+        h = zlib.crc32(str(data).encode('utf8'))
+        return self.ordering_locks[h % len(self.ordering_locks)]
+
+    async def process(self, key, data):
+        async with self.get_ordering_lock(data):
+            breaker = self.pymisphelper.circuit_breaker
+            if breaker is not None:
+                while not breaker.try_acquire():
+                    await asyncio.sleep(min(max(breaker.wait_time(), 0.05), self.sleep))
+            try:
+                await self.perform_action(key, data)
+            except Exception as error:
+                await self.save_error_to_redis(error, data, key=key)
+            finally:
+                if breaker is not None:
+                    breaker.release()
+
+    async def perform_action(self, key, data):
+        if key.endswith(self.SUFFIX_SIGH):
+            r = await self.pymisphelper.add_sighting_per_json(data)
+        elif key.endswith(self.SUFFIX_ATTR):
+            r = await self.pymisphelper.add_attribute_per_json(data, event_id=self.event_id)
+        elif key.endswith(self.SUFFIX_OBJ):
+            r = await self.pymisphelper.add_object_per_json(data, event_id=self.event_id)
+        else:
+            raise NoValidKey("Can't define action to perform")
+
+        if r is not None and PyMISPHelper._has_errors(r):
+            await self.save_error_to_redis(r, data, key=key)
+
+    async def save_error_to_redis(self, error, item, key=None, suffix=None):
+        """
+        Buffer the error (see RedisToMISP.save_error_to_redis)
+        """
+        self._error_buffer.append((error, self.build_error(error, item, key, suffix)))
+        if len(self._error_buffer) >= self.error_batch:
+            await self.flush_errors()
+
+    async def flush_errors(self):
+        errors, self._error_buffer = self._error_buffer, []
+        if not errors:
+            return 0
+        await self.serv.lpush(self.keynameError, *[entry for error, entry in errors])
+        print('Error: {} item(s) saved in {}, last error: {}'.format(
+            len(errors), self.keynameError, errors[-1][0]))
+        return len(errors)
+
+    async def close(self):
+        await self.drain()
+        await self.flush_errors()
+        await self.serv.close()
+
+
+async def run(args):
+    """
+    Run the asyncio consumer from the arguments of RedisToMISP.py --asyncio
+    """
+    from AsyncPyMISPHelper import AsyncPyMISPHelper
+
+    helper = AsyncPyMISPHelper(args.url, args.mispkey, args.verifycert,
+                               max_concurrency=args.inFlight,
+                               timeout=args.httpTimeout, timezone=args.timezone)
+    for generator in args.objectGenerator:
+        name, path = generator.split('=', 1)
+        helper.dico_object.register(name, path)
+    if args.circuitBreaker:
+        helper.enable_circuit_breaker(error_threshold=args.breakerErrorRate,
+                                      latency_threshold=args.breakerLatency,
+                                      cooldown=args.breakerCooldown,
+                                      max_concurrency=args.inFlight)
+    if args.sharedEventCache:
+        helper.enable_shared_event_cache(
+            redis.asyncio.StrictRedis(host=args.host, port=args.port, db=args.db))
+    consumer = AsyncRedisToMISP(args.host, args.port, args.db,
+                                args.keynamePop, helper, sleep=args.sleep,
+                                event_id=args.eventid,
+                                daily_event_name=args.eventname,
+                                keynameError=args.keynameError,
+                                pop_batch=max(args.popBatch, args.inFlight),
+                                max_in_flight=args.inFlight,
+                                error_batch=args.errorBatch,
+                                key_weights=parse_key_settings(args.keyWeight),
+                                key_priorities=parse_key_settings(args.keyPriority),
+                                key_quotas=parse_key_settings(args.keyQuota, int),
+                                round_weight=args.roundWeight)
+    try:
+        await consumer.consume()
+    finally:
+        await consumer.close()
+        await helper.close()
@@ -0,0 +1,347 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import gzip
+import time
+import datetime
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from pymisp import PyMISP, PyMISPError
+from PyMISPHelper import PyMISPHelper
+from CowrieMISPObject import CowrieSessionizer
+
+try:
+    from MISPKeys import misp_url, misp_key
+    flag_MISPKeys = True
+except ImportError:
+    misp_url = misp_key = None
+    flag_MISPKeys = False
+
+
+def open_log(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf8', errors='replace')
+    return open(path, 'r', encoding='utf8', errors='replace')
+
+
+def read_records(path, skip=0):
+    """
+    Yield the (line number, record) of a cowrie JSON log, gzipped or not,
+    starting after the line skip. record is None for invalid lines
+    """
+    with open_log(path) as f:
+        for number, line in enumerate(f, 1):
+            if number <= skip:
+                continue
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield number, json.loads(line)
+            except ValueError:
+                print('{}:{}: invalid JSON, skipped'.format(path, number))
+                yield number, None
+
+
+class CowrieLogImporter:
+    def __init__(self, helper, event_name, batch_size=2000, workers=4,
+                 checkpoint_file=None, sessions=False, max_records=100,
+                 attribute_fields=None, error_file=None,
+                 attribute_error_file=None):
+        """
+        Import cowrie JSON logs into the daily events of helper
+        ("event_name YYYY-MM-DD", the day of the record timestamp in the
+        timezone of the helper). Records are read as a stream and sent by
+        batch of batch_size objects, each batch being a single edit of its
+        event, from `workers` threads. Only the records read since the last
+        flush are in memory.
+
+        Parameters:
+        -----------
+        batch_size : int
+            Number of objects (or attributes) sent in a single request
+        workers : int
+            Number of requests sent to MISP concurrently
+        checkpoint_file : str
+            JSON file recording, after each flush, how far each log file
+            was imported. An interrupted import restarts from there: at
+            most the records of one flush are sent twice
+        sessions : bool
+            Merge the records of a same session into a single object (see
+            CowrieSessionizer). Open sessions are pushed at each flush, so
+            a session may be split across flushes
+        max_records : int
+            Maximum number of records merged in a single object
+        attribute_fields : dict
+            Also add the distinct values of these fields as attributes of
+            the daily event, e.g. {'src_ip': 'ip-src'}
+        error_file : str
+            Records MISP did not accept are appended to this file, which
+            can be imported again
+        attribute_error_file : str
+            Attributes MISP did not accept are appended to this file, as
+            JSON lines with their date (default: error_file.attributes)
+        """
+        self.helper = helper
+        if helper.mode_type != PyMISPHelper.MODE_DAILY:
+            helper.daily_mode(event_name, resolve=False)
+        self.batch_size = max(1, batch_size)
+        self.workers = max(1, workers)
+        self.checkpoint_file = checkpoint_file
+        self.sessionizer = CowrieSessionizer(max_records=max_records) if sessions else None
+        self.attribute_fields = attribute_fields or {}
+        self.error_file = error_file
+        if attribute_error_file is None and error_file is not None:
+            attribute_error_file = error_file + '.attributes'
+        self.attribute_error_file = attribute_error_file
+        self.checkpoint = self.load_checkpoint()
+        self.executor = ThreadPoolExecutor(max_workers=self.workers)
+
+        self.event_ids = {}  # date -> event id
+        self.records = {}  # date -> [records]
+        self.attributes = {}  # date -> [attributes]
+        self.seen_values = {}  # date -> set of (type, value) added as attribute
+        self.buffered = 0
+        self._dates = {}  # 'YYYY-MM-DDTHH' -> date, in the helper timezone
+        self.stats = {'records': 0, 'invalid': 0, 'objects': 0,
+                      'attributes': 0, 'requests': 0, 'errors': 0}
+        self.start_time = None
+
+    # CHECKPOINT
+    def load_checkpoint(self):
+        if self.checkpoint_file is None or not os.path.exists(self.checkpoint_file):
+            return {'files': {}}
+        with open(self.checkpoint_file) as f:
+            return json.load(f)
+
+    def save_checkpoint(self, path, line, done=False):
+        self.checkpoint['files'][os.path.abspath(path)] = {'line': line, 'done': done}
+        if self.checkpoint_file is None:
+            return
+        tmp = self.checkpoint_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.checkpoint, f, indent=1)
+        # a crash never leaves a truncated checkpoint
+        os.replace(tmp, self.checkpoint_file)
+
+    def get_progress(self, path):
+        return self.checkpoint['files'].get(os.path.abspath(path), {'line': 0, 'done': False})
+
+    # RECORDS
+    def get_date(self, record):
+        """
+        Return the day of the record in the timezone of the daily events
+        """
+        timestamp = record.get('timestamp')
+        if not timestamp or not isinstance(timestamp, str):
+            return None
+        hour = timestamp[:13]
+        date = self._dates.get(hour)
+        if date is None:
+            try:
+                utc = datetime.datetime.strptime(hour, '%Y-%m-%dT%H')
+            except ValueError:
+                return None
+            date = utc.replace(tzinfo=datetime.timezone.utc).astimezone(self.helper.timezone).date()
+            if len(self._dates) > 100000:
+                self._dates = {}
+            self._dates[hour] = date
+        return date
+
+    def add(self, record):
+        date = self.get_date(record) if isinstance(record, dict) else None
+        if date is None:
+            self.stats['invalid'] += 1
+            return
+        self.stats['records'] += 1
+        for field, type_value in self.attribute_fields.items():
+            value = record.get(field)
+            if value is None:
+                continue
+            seen = self.seen_values.setdefault(date, set())
+            if (type_value, value) not in seen:
+                seen.add((type_value, value))
+                self.attributes.setdefault(date, []).append({'type': type_value, 'value': value})
+                self.buffered += 1
+
+        if self.sessionizer is not None and 'session' in record:
+            ready = self.sessionizer.add(record, key=(date, record['session']), context=date)
+        else:
+            ready = [(record, date)]
+        for merged, merged_date in ready:
+            self.records.setdefault(merged_date, []).append(merged)
+            self.buffered += 1
+
+    def flush(self):
+        """
+        Send everything buffered, one request per batch_size objects or
+        attributes of a same day, and wait for MISP to accept them
+        """
+        if self.sessionizer is not None:
+            for merged, date in self.sessionizer.flush(only_expired=False):
+                self.records.setdefault(date, []).append(merged)
+        records, self.records = self.records, {}
+        attributes, self.attributes = self.attributes, {}
+        self.buffered = 0
+        # logs are chronological, only remember the values of the last days
+        for date in sorted(self.seen_values)[:-2]:
+            del self.seen_values[date]
+
+        futures = []
+        for date in sorted(set(records) | set(attributes)):
+            event_id = self.get_event_id(date)
+            day_records = records.get(date, [])
+            for i in range(0, len(day_records), self.batch_size):
+                batch = day_records[i:i + self.batch_size]
+                futures.append((date, batch, 'objects', self.executor.submit(
+                    self.helper.add_objects_bulk, 'cowrie', batch, event_id=event_id)))
+            day_attributes = attributes.get(date, [])
+            for i in range(0, len(day_attributes), self.batch_size):
+                batch = day_attributes[i:i + self.batch_size]
+                futures.append((date, batch, 'attributes', self.executor.submit(
+                    self.helper.add_attributes_bulk, batch, event_id=event_id)))
+
+        failed = []
+        failed_attributes = []
+        for date, batch, kind, future in futures:
+            self.stats['requests'] += 1
+            try:
+                r = future.result()
+            except Exception as e:
+                r = {'errors': str(e)}
+            if r is None:
+                self.stats[kind] += len(batch)
+                continue
+            self.stats['errors'] += 1
+            print('Error: {} {} not added: {}'.format(len(batch), kind, r))
+            if kind == 'objects':
+                failed += batch
+                continue
+            # let the next records of the day add them again
+            seen = self.seen_values.get(date, set())
+            for attribute in batch:
+                seen.discard((attribute['type'], attribute['value']))
+                failed_attributes.append(dict(attribute, date=str(date)))
+        if failed:
+            self.save_errors(self.error_file, failed)
+        if failed_attributes:
+            self.save_errors(self.attribute_error_file, failed_attributes)
+
+    def get_event_id(self, date):
+        if date not in self.event_ids:
+            self.event_ids[date] = self.helper.fetch_daily_event_id(date)
+        return self.event_ids[date]
+
+    @staticmethod
+    def save_errors(path, records):
+        if path is None:
+            return
+        with open(path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    # IMPORT
+    def import_files(self, paths):
+        """
+        Import the log files in order, skipping what the checkpoint records
+        as already imported. Returns the stats
+        """
+        self.start_time = time.time()
+        for path in paths:
+            progress = self.get_progress(path)
+            if progress['done']:
+                print('{}: already imported'.format(path))
+                continue
+            line = progress['line']
+            for line, record in read_records(path, skip=progress['line']):
+                self.add(record)
+                # enough for one batch per worker
+                if self.buffered >= self.batch_size * self.workers:
+                    self.flush()
+                    self.save_checkpoint(path, line)
+                    self.print_progress(path, line)
+            self.flush()
+            self.save_checkpoint(path, line, done=True)
+            self.print_progress(path, line)
+        self.executor.shutdown()
+        return self.stats
+
+    def print_progress(self, path, line):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        print('{}: line {}, {} records ({:.0f}/s), {} objects, {} attributes, {} errors'.format(
+            path, line, self.stats['records'], self.stats['records'] / elapsed,
+            self.stats['objects'], self.stats['attributes'], self.stats['errors']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Import cowrie JSON logs (gzipped or not) into the daily"
+        + " events of MISP, in bulk")
+    parser.add_argument("files", nargs='+', help="The cowrie log files, imported in this order")
+    parser.add_argument("--eventname", type=str, required=True,
+                        help="The daily event name (e.g. honeypot_1, records"
+                        + " go to the events 'honeypot_1 yyyy-mm-dd')")
+    parser.add_argument("--batchSize", type=int, default=2000,
+                        help="Number of objects sent in a single request")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Number of requests sent to MISP concurrently")
+    parser.add_argument("--checkpoint", type=str, default=None,
+                        help="File recording the progress of the import, to"
+                        + " resume it when interrupted")
+    parser.add_argument("--sessions", action="store_true", default=False,
+                        help="Merge the records of a same session into a"
+                        + " single object")
+    parser.add_argument("--sessionMaxRecords", type=int, default=100,
+                        help="Maximum number of records merged in a single"
+                        + " object")
+    parser.add_argument("--attribute", nargs='+', default=[],
+                        metavar="FIELD=TYPE",
+                        help="Also add the distinct values of FIELD as"
+                        + " attributes of type TYPE (e.g. src_ip=ip-src)")
+    parser.add_argument("--errorFile", type=str, default=None,
+                        help="Append the records MISP did not accept to this"
+                        + " file")
+    parser.add_argument("--attributeErrorFile", type=str, default=None,
+                        help="Append the attributes MISP did not accept to"
+                        + " this file (default: ERRORFILE.attributes)")
+    parser.add_argument("--timezone", type=str, default=None,
+                        help="Timezone in which the daily events start"
+                        + " (e.g. Europe/Luxembourg, local time by default)")
+
+    parser.add_argument("-u", "--url", type=str, required=not flag_MISPKeys,
+                        default=misp_url, help="The MISP URL to connect to")
+    parser.add_argument("--mispkey", type=str, required=not flag_MISPKeys,
+                        default=misp_key, help="The MISP API key")
+    parser.add_argument("--verifycert", action="store_true", default=True,
+                        help="Should the certificate be verified")
+    parser.add_argument("--httpTimeout", type=float, default=300,
+                        help="Timeout in seconds of the MISP requests")
+    args = parser.parse_args()
+
+    try:
+        pymisp = PyMISP(args.url, args.mispkey, args.verifycert)
+    except PyMISPError as e:
+        print(e)
+        sys.exit(1)
+    helper = PyMISPHelper(pymisp, timezone=args.timezone)
+    helper.configure_http(pool_maxsize=max(10, args.workers),
+                          timeout=(10, args.httpTimeout))
+    importer = CowrieLogImporter(helper, args.eventname,
+                                 batch_size=args.batchSize,
+                                 workers=args.workers,
+                                 checkpoint_file=args.checkpoint,
+                                 sessions=args.sessions,
+                                 max_records=args.sessionMaxRecords,
+                                 attribute_fields=dict(a.split('=', 1) for a in args.attribute),
+                                 error_file=args.errorFile,
+                                 attribute_error_file=args.attributeErrorFile)
+    try:
+        stats = importer.import_files(args.files)
+    except KeyboardInterrupt:
+        print('Interrupted, run the same command to resume from the checkpoint')
+        sys.exit(1)
+    print('Done: {records} records, {objects} objects, {attributes} attributes'
+          ' in {requests} requests, {errors} errors, {invalid} invalid lines'.format(**stats))
@@ -1,30 +1,150 @@
 #!/usr/bin/env python3
 
-from pymisp.tools.abstractgenerator import AbstractMISPObjectGenerator
-from pymisp import PyMISP
+import time
+from collections import OrderedDict
 
-import datetime
+from MISPObjectGenerators import GenericMispObject
+
+
+def strip_zulu(value):
+    # Date already in ISO format, removing trailing Z
+    return value.rstrip('Z')
+
+
+class CowrieMispObject(GenericMispObject):
+    SKIP_LIST = ['time', 'duration', 'isError', 'ttylog']
+    SKIP_SUBSTRINGS = ['log_']
+    CASTS = {'timestamp': strip_zulu}
 
-class CowrieMispObject(AbstractMISPObjectGenerator):
     def __init__(self, dico_val, **kargs):
-        self._dico_val = dico_val
-        self.name = "cowrie"
+        kargs.setdefault('strict', False)
+        super(CowrieMispObject, self).__init__('cowrie', dico_val, **kargs)
 
-        super(CowrieMispObject, self).__init__('cowrie', **kargs)
-        self.generate_attributes()
 
-    def generate_attributes(self):
-        skip_list = ['time', 'duration', 'isError', 'ttylog']
-        for object_relation, value in self._dico_val.items():
-            if object_relation in skip_list or 'log_' in object_relation:
-                continue
+class CowrieSessionizer:
+    # Relations describing a single record, not kept in the session
+    SKIP_LIST = ['eventid']
+    # Single valued relations joining the distinct values of the session
+    JOINED = ['input', 'message']
+    JOIN_SEPARATOR = '\n'
+    # Cowrie eventid ending a session
+    CLOSING_EVENTS = ['cowrie.session.closed']
+    # relations of the cowrie template accepting several values
+    _multiple = None
+
+    def __init__(self, idle_timeout=60, max_records=100, max_sessions=10000):
+        """
+        Group cowrie records by session so that a single MISP object is
+        created per session. Relations accepting several values in the
+        cowrie template (password, keyAlgs, ...) are lists of the distinct
+        values seen, JOINED ones are the distinct values joined in a text
+        and the others keep the value of the first record
 
-            # cast to datetime
-            if object_relation == 'timestamp':
-                # Date already in ISO format, removing trailing Z
-                value = value.rstrip('Z')
+        Parameters:
+        -----------
+        idle_timeout : float
+            A session is emitted after this many seconds without records
+        max_records : int
+            A session is emitted once it gathered this many records
+        max_sessions : int
+            Maximum number of open sessions, the oldest one is emitted when
+            exceeded
+        """
+        self.idle_timeout = idle_timeout
+        self.max_records = max_records
+        self.max_sessions = max_sessions
+        # session key -> {'record', 'count', 'last_seen', 'first_seq', 'context'}
+        self.sessions = OrderedDict()
 
-            if isinstance(value, dict):
-                self.add_attribute(object_relation, **value)
+    def add(self, record, key=None, context=None, seq=None):
+        """
+        Merge the record in its session
+        Returns the list of (merged record, context) ready to be pushed
+        Parameters:
+        -----------
+        record : dict
+            The cowrie log record, must contain 'session'
+        key : hashable
+            Session key, the 'session' field by default
+        context : any
+            Value returned along with the merged record (e.g. the event id)
+        seq : int
+            Sequence number of the record, see `first_seq`
+        """
+        if key is None:
+            key = record['session']
+        session = self.sessions.get(key)
+        if session is None:
+            session = self.sessions[key] = {'record': OrderedDict(), 'count': 0,
+                                            'first_seq': seq, 'context': context}
+        else:
+            self.sessions.move_to_end(key)
+        merged = session['record']
+        multiple = self.multiple_relations()
+        for relation, value in record.items():
+            if relation in self.SKIP_LIST:
+                continue
+            if relation not in multiple and relation not in self.JOINED:
+                merged.setdefault(relation, value)
             else:
-                self.add_attribute(object_relation, value=value)
+                values = merged.setdefault(relation, [])
+                # records can be merged sessions themselves (e.g. replayed)
+                for v in (value if isinstance(value, list) else [value]):
+                    if v not in values:
+                        values.append(v)
+        session['count'] += 1
+        session['last_seen'] = time.time()
+
+        ready = []
+        if session['count'] >= self.max_records or \
+                record.get('eventid') in self.CLOSING_EVENTS:
+            ready.append(self._pop(key))
+        while len(self.sessions) > self.max_sessions:
+            ready.append(self._pop(next(iter(self.sessions))))
+        return ready
+
+    def flush(self, only_expired=True):
+        """
+        Return the (merged record, context) of the idle sessions, or of all
+        of them
+        """
+        now = time.time()
+        ready = []
+        # sessions are ordered by last activity
+        for key in list(self.sessions.keys()):
+            if only_expired and now - self.sessions[key]['last_seen'] < self.idle_timeout:
+                break
+            ready.append(self._pop(key))
+        return ready
+
+    def first_seq(self):
+        """
+        Return the lowest sequence number of the records still waiting
+        """
+        seqs = [s['first_seq'] for s in self.sessions.values() if s['first_seq'] is not None]
+        return min(seqs) if seqs else None
+
+    def __len__(self):
+        return len(self.sessions)
+
+    @classmethod
+    def multiple_relations(cls):
+        """
+        Return the relations of the cowrie template accepting several
+        values, the template is only read once
+        """
+        if cls._multiple is None:
+            template = CowrieMispObject({})
+            definition = template._definition if template._known_template else {}
+            cls._multiple = frozenset(
+                relation for relation, attribute in definition.get('attributes', {}).items()
+                if attribute.get('multiple'))
+        return cls._multiple
+
+    def _pop(self, key):
+        session = self.sessions.pop(key)
+        record = session['record']
+        for relation in self.JOINED:
+            if relation in record:
+                record[relation] = self.JOIN_SEPARATOR.join(str(v) for v in record[relation])
+        return record, session['context']
@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+
+import copy
+import uuid
+import importlib
+import threading
+from functools import partial
+from collections import defaultdict
+
+from pymisp.tools.abstractgenerator import AbstractMISPObjectGenerator
+from pymisp.mispevent import MISPObjectAttribute
+
+
+class FieldPlan:
+    """
+    Decisions taken once per object template instead of once per record:
+    relations to skip, value casts and a prototype attribute per relation,
+    copied instead of being validated against the template again
+    """
+    # template key -> FieldPlan
+    _plans = {}
+
+    def __init__(self, name, definition, skip=(), skip_substrings=(), casts=None):
+        self.name = name
+        self.relations = definition.get('attributes', {}) if definition else {}
+        self.skip = frozenset(skip)
+        self.skip_substrings = tuple(skip_substrings)
+        self.casts = casts if casts is not None else {}
+        # relation -> cast function (None for no cast), or SKIP
+        self._decisions = {}
+        # relation -> MISPObjectAttribute
+        self._prototypes = {}
+
+    SKIP = object()
+
+    @classmethod
+    def get(cls, misp_object, **kargs):
+        """
+        Return the plan of the template of misp_object, compiled on first use
+        """
+        key = (type(misp_object), misp_object.name,
+               getattr(misp_object, 'template_uuid', None),
+               getattr(misp_object, 'template_version', None))
+        plan = cls._plans.get(key)
+        if plan is None:
+            definition = misp_object._definition if misp_object._known_template else None
+            plan = cls._plans[key] = cls(misp_object.name, definition, **kargs)
+        return plan
+
+    def decision(self, relation):
+        try:
+            return self._decisions[relation]
+        except KeyError:
+            pass
+        if relation in self.skip or any(x in relation for x in self.skip_substrings):
+            decision = self.SKIP
+        elif self.relations and relation not in self.relations:
+            print('Skipping {}: not a relation of the {} template'.format(relation, self.name))
+            decision = self.SKIP
+        else:
+            decision = self.casts.get(relation)
+        self._decisions[relation] = decision
+        return decision
+
+    def new_attribute(self, relation, value):
+        """
+        Return a new MISPObjectAttribute, copied from the prototype of the
+        relation
+        """
+        prototype = self._prototypes.get(relation)
+        if prototype is None:
+            prototype = MISPObjectAttribute(self.relations.get(relation, {}))
+            prototype.from_dict(object_relation=relation, value='')
+            self._prototypes[relation] = prototype
+        attribute = copy.copy(prototype)
+        # bypass AbstractMISP.__setattr__, the copy is left not edited as
+        # an attribute loaded with from_dict
+        attribute.__dict__.update(uuid=str(uuid.uuid4()), value=value,
+                                  ShadowAttribute=[])
+        if 'Tag' in prototype.__dict__:
+            attribute.__dict__['Tag'] = []
+        return attribute
+
+
+class GenericMispObject(AbstractMISPObjectGenerator):
+    """
+    MISP object generator driven by the object template: every key of the
+    dict is an object relation. Values can be a list (one attribute per
+    element) or a dict of MISPAttribute fields
+    """
+    SKIP_LIST = []
+    SKIP_SUBSTRINGS = []
+    CASTS = {}
+
+    def __init__(self, name, dico_val, **kargs):
+        self._dico_val = dico_val
+        self.name = name
+
+        # fail early when the template is unknown
+        kargs.setdefault('strict', True)
+        super(GenericMispObject, self).__init__(name, **kargs)
+        self.generate_attributes()
+
+    @classmethod
+    def from_records(cls, records, *args, **kargs):
+        """
+        Build an object per record (dict) of records. The template is only
+        loaded once, the objects are copied from an empty one
+        """
+        empty = cls(*(args + ({},)), **kargs)
+        has_fast_access = hasattr(empty, '_MISPObject__fast_attribute_access')
+        misp_objects = []
+        for record in records:
+            misp_object = copy.copy(empty)
+            misp_object.uuid = str(uuid.uuid4())
+            misp_object.Attribute = []
+            misp_object.ObjectReference = []
+            if has_fast_access:
+                misp_object._MISPObject__fast_attribute_access = defaultdict(list)
+            misp_object._dico_val = record
+            misp_object.generate_attributes()
+            misp_objects.append(misp_object)
+        return misp_objects
+
+    def generate_attributes(self):
+        plan = FieldPlan.get(self, skip=self.SKIP_LIST,
+                             skip_substrings=self.SKIP_SUBSTRINGS,
+                             casts=self.CASTS)
+        # prototypes do not carry the default parameters of this object
+        fast = not self._default_attributes_parameters
+        for object_relation, value in self._dico_val.items():
+            cast = plan.decision(object_relation)
+            if cast is FieldPlan.SKIP:
+                continue
+
+            # multi-valued relation, e.g. built by CowrieSessionizer
+            values = value if isinstance(value, list) else [value]
+            for value in values:
+                if value is None:
+                    continue
+                if isinstance(value, dict):
+                    self.add_attribute(object_relation, **value)
+                    continue
+                if cast is not None:
+                    value = cast(value)
+                if fast:
+                    self._append_attribute(plan.new_attribute(object_relation, value))
+                else:
+                    self.add_attribute(object_relation, value=value)
+
+    def _append_attribute(self, attribute):
+        self.Attribute.append(attribute)
+        fast_access = getattr(self, '_MISPObject__fast_attribute_access', None)
+        if fast_access is not None:
+            fast_access[attribute.object_relation].append(attribute)
+        self.edited = True
+
+
+class ObjectGeneratorRegistry:
+    """
+    Map object names with their generator, a callable taking the dict of
+    values (usually an AbstractMISPObjectGenerator class).
+    Generators given as a module path ('module:Class') or declared by an
+    installed package under the ENTRY_POINT_GROUP entry point group are
+    only imported when first used. Names without generator are handled by
+    GenericMispObject
+    """
+    ENTRY_POINT_GROUP = 'pymisp_wrapper.object_generators'
+    DEFAULT_GENERATORS = {
+        'cowrie': 'CowrieMISPObject:CowrieMispObject'
+    }
+
+    def __init__(self, generators=None, entry_points=True, generic=True):
+        """
+        Parameters:
+        -----------
+        generators : dict
+            Object name -> generator or module path, DEFAULT_GENERATORS by default
+        entry_points : bool
+            Look for generators declared by installed packages
+        generic : bool
+            Use GenericMispObject for the names without generator, otherwise
+            raise a KeyError
+        """
+        self._paths = {}  # name -> module path | EntryPoint
+        self._generators = {}  # name -> loaded generator
+        self._entry_points_loaded = not entry_points
+        # generators are imported by the consumer threads
+        self._lock = threading.RLock()
+        self.generic = generic
+        for name, generator in (generators if generators is not None else self.DEFAULT_GENERATORS).items():
+            self.register(name, generator)
+
+    def register(self, name, generator):
+        """
+        Register the generator of the object name
+        Parameters:
+        -----------
+        name : str
+            The MISP object name
+        generator : callable | str
+            The generator or its path, either 'module:attribute' or
+            'module.attribute'
+        """
+        with self._lock:
+            self._generators.pop(name, None)
+            self._paths.pop(name, None)
+            if isinstance(generator, str):
+                self._paths[name] = generator
+            else:
+                self._generators[name] = generator
+
+    def __setitem__(self, name, generator):
+        self.register(name, generator)
+
+    def __getitem__(self, name):
+        generator = self._generators.get(name)
+        if generator is not None:
+            return generator
+        if name not in self._paths:
+            self.load_entry_points()
+        with self._lock:
+            generator = self._generators.get(name)
+            if generator is not None:  # imported by another thread
+                return generator
+            if name in self._paths:
+                # a failing import is raised again by the next lookups
+                generator = self._import(self._paths[name])
+                self._generators[name] = generator
+                del self._paths[name]
+                return generator
+        if self.generic:
+            return partial(GenericMispObject, name)
+        raise KeyError(name)
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def __contains__(self, name):
+        if name not in self._generators and name not in self._paths:
+            self.load_entry_points()
+        return name in self._generators or name in self._paths
+
+    def keys(self):
+        self.load_entry_points()
+        return list(self._generators.keys()) + list(self._paths.keys())
+
+    def load_entry_points(self):
+        """
+        Register (without importing them) the generators declared by the
+        installed packages
+        """
+        if self._entry_points_loaded:
+            return
+        with self._lock:
+            if self._entry_points_loaded:
+                return
+            try:
+                from importlib import metadata
+            except ImportError:  # python < 3.8
+                self._entry_points_loaded = True
+                return
+            entry_points = metadata.entry_points()
+            if hasattr(entry_points, 'select'):
+                entry_points = entry_points.select(group=self.ENTRY_POINT_GROUP)
+            else:
+                entry_points = entry_points.get(self.ENTRY_POINT_GROUP, [])
+            for entry_point in entry_points:
+                # explicit registrations take precedence
+                if entry_point.name not in self._generators and entry_point.name not in self._paths:
+                    self._paths[entry_point.name] = entry_point
+            self._entry_points_loaded = True
+
+    @staticmethod
+    def _import(path):
+        if not isinstance(path, str):  # EntryPoint
+            return path.load()
+        if ':' in path:
+            module_name, attribute = path.split(':', 1)
+        else:
+            module_name, attribute = path.rsplit('.', 1)
+        module = importlib.import_module(module_name)
+        return getattr(module, attribute)
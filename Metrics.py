@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import time
+import bisect
+import threading
+from contextlib import contextmanager
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+
+class Metrics:
+    """
+    Minimal registry of Prometheus-style counters, gauges and histograms.
+    Updating a metric is a dict lookup under a lock, so it can be left
+    enabled in production. The metrics can be exposed on an HTTP endpoint
+    (`start_http_server`) or written to a redis hash (`push_to_redis`)
+
+    Examples:
+    ---------
+    >>> metrics = Metrics()
+    >>> metrics.inc('items_popped_total', suffix='_attribute')
+    >>> with metrics.time('misp_request_seconds', operation='attribute'):
+    ...     pass
+    >>> metrics.start_http_server(9100)
+    """
+    LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    SIZE_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)
+
+    def __init__(self, prefix='pymisp_wrapper_'):
+        self.prefix = prefix
+        self._counters = {}  # (name, labels) -> value
+        self._gauges = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [bucket counts..., sum, count]
+        self._buckets = {}  # name -> buckets
+        self._help = {}
+        self._collectors = []
+        self._lock = threading.Lock()
+        self.http_server = None
+
+    @staticmethod
+    def _key(name, labels):
+        return (name, tuple(sorted(labels.items())) if labels else ())
+
+    def describe(self, name, help_text, buckets=None):
+        """
+        Set the HELP text of a metric, and the buckets of a histogram
+        """
+        self._help[name] = help_text
+        if buckets is not None:
+            self._buckets[name] = tuple(buckets)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def set_gauge(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        buckets = self._buckets.get(name, self.LATENCY_BUCKETS)
+        index = bisect.bisect_left(buckets, value)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(buckets) + 3)
+            histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, name, **labels):
+        """
+        Observe the duration of the `with` block in the histogram name
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def register_collector(self, collector):
+        """
+        collector is called with this registry before the metrics are
+        exported, to refresh the gauges that are costly to keep up to date
+        (e.g. the queue depths)
+        """
+        self._collectors.append(collector)
+
+    def collect(self):
+        for collector in self._collectors:
+            try:
+                collector(self)
+            except Exception as e:
+                print('Metrics collector failed:', e)
+
+    def get_value(self, name, **labels):
+        """
+        Return the value of a counter or gauge, or the count of a histogram
+        """
+        key = self._key(name, labels)
+        with self._lock:
+            if key in self._counters:
+                return self._counters[key]
+            if key in self._gauges:
+                return self._gauges[key]
+            if key in self._histograms:
+                return self._histograms[key][-1]
+        return None
+
+    def samples(self):
+        """
+        Return the list of (metric type, name, sample name, labels, value)
+        """
+        self.collect()
+        samples = []
+        with self._lock:
+            for (name, labels), value in sorted(self._counters.items()):
+                samples.append(('counter', name, name, labels, value))
+            for (name, labels), value in sorted(self._gauges.items()):
+                samples.append(('gauge', name, name, labels, value))
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                buckets = self._buckets.get(name, self.LATENCY_BUCKETS)
+                cumulated = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], histogram):
+                    cumulated += count
+                    samples.append(('histogram', name, name + '_bucket',
+                                    labels + (('le', str(bound)), ), cumulated))
+                samples.append(('histogram', name, name + '_sum', labels, histogram[-2]))
+                samples.append(('histogram', name, name + '_count', labels, histogram[-1]))
+        return samples
+
+    def total(self, name):
+        """
+        Return the sum of a counter over all its labels
+        """
+        with self._lock:
+            return sum(value for (n, labels), value in self._counters.items() if n == name)
+
+    def snapshot(self):
+        """
+        Return a picklable copy of the metrics, e.g. to send them to another
+        process (see `merge`)
+        """
+        self.collect()
+        with self._lock:
+            return {'counters': dict(self._counters),
+                    'gauges': dict(self._gauges),
+                    'histograms': {k: list(v) for k, v in self._histograms.items()},
+                    'buckets': dict(self._buckets),
+                    'help': dict(self._help)}
+
+    def reset(self):
+        with self._lock:
+            self._counters = {}
+            self._gauges = {}
+            self._histograms = {}
+
+    def merge(self, snapshot, **labels):
+        """
+        Add the counters and histograms of a snapshot to these ones. The
+        gauges are copied with the extra labels, as summing them would not
+        make sense (e.g. the depth of a queue shared by several consumers)
+        """
+        extra = tuple(sorted(labels.items()))
+        with self._lock:
+            self._buckets.update(snapshot['buckets'])
+            for name, help_text in snapshot['help'].items():
+                self._help.setdefault(name, help_text)
+            for key, value in snapshot['counters'].items():
+                self._counters[key] = self._counters.get(key, 0) + value
+            for (name, key_labels), value in snapshot['gauges'].items():
+                self._gauges[(name, tuple(sorted(key_labels + extra)))] = value
+            for key, histogram in snapshot['histograms'].items():
+                current = self._histograms.get(key)
+                if current is None:
+                    self._histograms[key] = list(histogram)
+                else:
+                    self._histograms[key] = [a + b for a, b in zip(current, histogram)]
+
+    def _format_name(self, sample_name, labels):
+        if not labels:
+            return self.prefix + sample_name
+        return '{}{}{{{}}}'.format(self.prefix, sample_name, ','.join(
+            '{}="{}"'.format(k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+            for k, v in labels))
+
+    def render(self):
+        """
+        Return the metrics in the Prometheus text exposition format
+        """
+        lines = []
+        described = set()
+        for metric_type, name, sample_name, labels, value in self.samples():
+            if name not in described:
+                described.add(name)
+                if name in self._help:
+                    lines.append('# HELP {}{} {}'.format(self.prefix, name, self._help[name]))
+                lines.append('# TYPE {}{} {}'.format(self.prefix, name, metric_type))
+            lines.append('{} {}'.format(self._format_name(sample_name, labels), value))
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """
+        Return the samples as a flat dict, e.g. for a redis hash
+        """
+        return {self._format_name(sample_name, labels): value
+                for metric_type, name, sample_name, labels, value in self.samples()}
+
+    # EXPORT
+    def start_http_server(self, port, addr='127.0.0.1'):
+        """
+        Serve the metrics on http://addr:port/metrics from a daemon thread
+        """
+        metrics = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.render().encode('utf8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = HTTPServer((addr, port), MetricsHandler)
+        thr = threading.Thread(name="metrics-http", target=self.http_server.serve_forever)
+        thr.daemon = True
+        thr.start()
+        return self.http_server
+
+    def push_to_redis(self, serv, key):
+        """
+        Replace the redis hash key with the current samples
+        """
+        samples = self.to_dict()
+        pipe = serv.pipeline(transaction=True)
+        pipe.delete(key)
+        if samples:
+            pipe.hset(key, mapping=samples)
+        pipe.execute()
+
+    def start_redis_reporter(self, serv, key, interval=10):
+        """
+        Call `push_to_redis` every interval seconds from a daemon thread
+        """
+        def report():
+            while True:
+                try:
+                    self.push_to_redis(serv, key)
+                except Exception as e:
+                    print('Could not push the metrics to redis:', e)
+                time.sleep(interval)
+
+        thr = threading.Thread(name="metrics-redis", target=report)
+        thr.daemon = True
+        thr.start()
+        return thr
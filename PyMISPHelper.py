@@ -1,10 +1,23 @@
 #!/usr/bin/env python3
 
 import json
+import time
 import datetime
+import threading
+import socket
+import functools
+from collections import OrderedDict, deque
 
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from urllib3.connection import HTTPConnection
+
+import pymisp.api
 from pymisp.tools.abstractgenerator import AbstractMISPObjectGenerator
-from CowrieMISPObject import CowrieMispObject
+from CowrieMISPObject import CowrieMispObject, CowrieSessionizer
+from MISPObjectGenerators import ObjectGeneratorRegistry
+from Metrics import Metrics
 
 
 class PyMISPHelperError(Exception):
@@ -25,12 +38,331 @@ class MISPObjectHasNoName(PyMISPHelperError):
     pass
 
 
+def instrumented(method):
+    """
+    Observe the duration of the calls of a PyMISPHelper method in the
+    helper_call_seconds histogram, when the metrics are enabled
+    """
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(self, *args, **kargs):
+        metrics = self.metrics
+        if metrics is None:
+            return method(self, *args, **kargs)
+        start = time.time()
+        try:
+            return method(self, *args, **kargs)
+        finally:
+            metrics.observe('helper_call_seconds', time.time() - start, method=name)
+    return wrapper
+
+
+def get_misp_operation(method, url):
+    """
+    Return the kind of MISP request, used as metric label
+    """
+    path = url.split('://', 1)[-1].split('/', 1)[-1]
+    if path.startswith('attributes'):
+        return 'attribute'
+    if path.startswith('objectTemplates'):
+        return 'template_lookup'
+    if path.startswith('objects'):
+        return 'object'
+    if path.startswith('sightings'):
+        return 'sighting'
+    if path.startswith('events/index') or path.startswith('events/restSearch'):
+        return 'event_lookup'
+    if path.startswith('events') and method == 'POST':
+        # events/<id> edits an existing event (see add_objects_bulk)
+        if path.split('/')[-1].isdigit():
+            return 'event_update'
+        return 'event_create'
+    return 'other'
+
+
+class MISPRetry(Retry):
+    """
+    Retry that never resends a non-idempotent request (POST) MISP may have
+    applied: only connection errors and the statuses of UNPROCESSED_STATUSES
+    are retried for them
+    """
+    IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE', 'TRACE'])
+    # MISP (or its proxy) did not process the request
+    UNPROCESSED_STATUSES = frozenset([429, 503])
+
+    def is_retry(self, method, status_code, has_retry_after=False):
+        if method.upper() not in self.IDEMPOTENT_METHODS and \
+                status_code not in self.UNPROCESSED_STATUSES:
+            return False
+        return super(MISPRetry, self).is_retry(method, status_code, has_retry_after)
+
+
+class PooledHTTPAdapter(HTTPAdapter):
+    """
+    HTTPAdapter applying a default timeout and enabling TCP keep-alive on
+    the pooled connections
+    """
+
+    def __init__(self, timeout=None, tcp_keepalive=True, **kargs):
+        self.timeout = timeout
+        self.tcp_keepalive = tcp_keepalive
+        super(PooledHTTPAdapter, self).__init__(**kargs)
+
+    def init_poolmanager(self, *args, **kargs):
+        if self.tcp_keepalive:
+            kargs['socket_options'] = HTTPConnection.default_socket_options + \
+                [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+        super(PooledHTTPAdapter, self).init_poolmanager(*args, **kargs)
+
+    def send(self, request, **kargs):
+        if kargs.get('timeout') is None:
+            kargs['timeout'] = self.timeout
+        breaker = self.circuit_breaker
+        metrics = self.metrics
+        if breaker is None and metrics is None:
+            return super(PooledHTTPAdapter, self).send(request, **kargs)
+        start = time.time()
+        status = 'error'
+        try:
+            response = super(PooledHTTPAdapter, self).send(request, **kargs)
+            status = response.status_code
+        finally:
+            latency = time.time() - start
+            if breaker is not None:
+                breaker.record(status != 'error' and not breaker.is_failure_status(status), latency)
+            if metrics is not None:
+                operation = get_misp_operation(request.method, request.url)
+                metrics.observe('misp_request_seconds', latency, operation=operation)
+                metrics.inc('misp_requests_total', operation=operation, status=status)
+        return response
+
+    # see PyMISPHelper.enable_circuit_breaker and enable_metrics
+    circuit_breaker = None
+    metrics = None
+
+
+class _PooledSessionLookup:
+    """
+    Stands for the `requests` module in pymisp.api, whose
+    PyMISP._prepare_request (PyMISP <= 2.4.119) opens a new requests.Session
+    for every request: while a pooled session is set for the current thread
+    (see PyMISPHelper._make_pooled_prepare_request) that session is used, and
+    left open, instead
+    """
+    local = threading.local()
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def Session(self):
+        session = getattr(self.local, 'session', None)
+        if session is None:
+            return requests.Session()
+        return _KeptOpenSession(session)
+
+
+class _KeptOpenSession:
+    def __init__(self, session):
+        self.session = session
+
+    def __enter__(self):
+        return self.session
+
+    def __exit__(self, *args):
+        return False
+
+
+class CircuitBreaker:
+    """
+    Track the outcome and latency of the requests to MISP.
+    - closed: requests are allowed, up to `limit` at the same time. The
+      limit grows by 1/limit on each good request and is halved on each bad
+      one (AIMD), between min_concurrency and max_concurrency
+    - open: too many requests were bad (failed or slower than
+      latency_threshold) over the last `window` seconds, nothing is allowed
+      for `cooldown` seconds (doubled each time the circuit opens again)
+    - half-open: a single probe request is allowed, the circuit closes on
+      success, with the limit restarting from min_concurrency
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    FAILURE_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, window=30, min_requests=10, error_threshold=0.5,
+                 latency_threshold=None, cooldown=10, max_cooldown=300,
+                 min_concurrency=1, max_concurrency=10):
+        """
+        Parameters:
+        -----------
+        window : float
+            Number of seconds over which the error rate is computed
+        min_requests : int
+            Minimum number of requests in the window before opening
+        error_threshold : float
+            Rate of bad requests opening the circuit
+        latency_threshold : float
+            Requests slower than this many seconds count as bad (disabled by
+            default)
+        cooldown : float
+            Number of seconds the circuit stays open the first time
+        max_cooldown : float
+            Maximum number of seconds the circuit stays open
+        min_concurrency : int
+        max_concurrency : int
+            Bounds of the adaptive concurrency limit
+        """
+        self.window = window
+        self.min_requests = min_requests
+        self.error_threshold = error_threshold
+        self.latency_threshold = latency_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.min_concurrency = max(1, min_concurrency)
+        self.max_concurrency = max(self.min_concurrency, max_concurrency)
+
+        self.state = self.CLOSED
+        self.limit = float(self.max_concurrency)
+        self.in_flight = 0
+        self.cooldown = cooldown
+        self.opened_at = None
+        self.times_opened = 0
+        self._outcomes = deque()  # (time, bad)
+        self._bad = 0
+        self._latency_sum = 0.0
+        self._latency_count = 0
+        self._cond = threading.Condition()
+
+    def is_failure_status(self, status_code):
+        return status_code in self.FAILURE_STATUSES
+
+    def record(self, ok, latency):
+        """
+        Record the outcome of a request
+        """
+        bad = not ok or (self.latency_threshold is not None and
+                         latency > self.latency_threshold)
+        now = time.time()
+        with self._cond:
+            self._latency_sum += latency
+            self._latency_count += 1
+            self._outcomes.append((now, bad))
+            self._bad += bad
+            self._trim(now)
+            if self.state == self.HALF_OPEN:
+                if bad:
+                    self._open(now)
+                else:
+                    self._close()
+            elif self.state == self.CLOSED:
+                if bad:
+                    self.limit = max(self.min_concurrency, self.limit / 2.0)
+                else:
+                    self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+                if len(self._outcomes) >= self.min_requests and \
+                        self._bad >= self.error_threshold * len(self._outcomes):
+                    self._open(now)
+            self._cond.notify_all()
+
+    def acquire(self):
+        """
+        Block until a request can be sent to MISP
+        """
+        with self._cond:
+            while True:
+                wait = self._wait_time(time.time(), in_flight=True)
+                if wait == 0:
+                    self.in_flight += 1
+                    return
+                # woken up by `release` or `record`
+                self._cond.wait(wait if wait is not None else 1)
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def try_acquire(self):
+        """
+        Non blocking `acquire`, returns True if the request can be sent
+        """
+        with self._cond:
+            if self._wait_time(time.time(), in_flight=True) == 0:
+                self.in_flight += 1
+                return True
+            return False
+
+    def wait_time(self):
+        """
+        Return the number of seconds before MISP can be tried again, 0 if
+        the circuit is not open
+        """
+        with self._cond:
+            return self._wait_time(time.time())
+
+    def get_stats(self):
+        with self._cond:
+            self._trim(time.time())
+            return {
+                'state': self.state,
+                'limit': round(self.limit, 2),
+                'in_flight': self.in_flight,
+                'requests': len(self._outcomes),
+                'error_rate': float(self._bad) / len(self._outcomes) if self._outcomes else 0.0,
+                'mean_latency': self._latency_sum / self._latency_count if self._latency_count else 0.0,
+                'times_opened': self.times_opened
+            }
+
+    def _wait_time(self, now, in_flight=False):
+        if self.state == self.OPEN:
+            remaining = self.opened_at + self.cooldown - now
+            if remaining > 0:
+                return remaining
+            self.state = self.HALF_OPEN
+            print('MISP circuit half-open, sending a probe request')
+        if not in_flight:
+            return 0
+        if self.state == self.HALF_OPEN:
+            return 0 if self.in_flight == 0 else None
+        return 0 if self.in_flight < int(self.limit) else None
+
+    def _trim(self, now):
+        while self._outcomes and self._outcomes[0][0] < now - self.window:
+            self._bad -= self._outcomes.popleft()[1]
+
+    def _open(self, now):
+        if self.state == self.HALF_OPEN:
+            self.cooldown = min(self.max_cooldown, self.cooldown * 2)
+        else:
+            self.cooldown = self.base_cooldown
+        self.state = self.OPEN
+        self.opened_at = now
+        self.times_opened += 1
+        print('MISP unhealthy ({} of the last {} requests failed), pausing for {}s'.format(
+            self._bad, len(self._outcomes), self.cooldown))
+        self._outcomes.clear()
+        self._bad = 0
+
+    def _close(self):
+        self.state = self.CLOSED
+        self.limit = float(self.min_concurrency)
+        self.cooldown = self.base_cooldown
+        print('MISP healthy again, resuming')
+
+
 class PyMISPHelper:
     MODE_NORMAL = 1
     MODE_DAILY = 2
+    # Minimum number of seconds between two downloads of the template index
+    # triggered by an unknown object name
+    TEMPLATE_MISS_INTERVAL = 60
 
     def __init__(self, pymisp, mode_type=MODE_NORMAL,
-                 daily_event_name='unset_daily_event_name', verbose=False):
+                 daily_event_name='unset_daily_event_name', verbose=False,
+                 template_cache_ttl=3600, template_cache_file=None,
+                 timezone=None):
         """
         Create a PyMISP interface to easily add attributes, objects or
         sightings to events especially for events that should be generated
@@ -49,6 +381,15 @@ class PyMISPHelper:
             The name of the daily event.
             It will have the following format on MISP:
                 daily_event_name YYYY-MM-DD
+        template_cache_ttl : int
+            Number of seconds the object template index is kept before being
+            downloaded again from MISP. None keeps it forever
+        template_cache_file : str
+            Optional path where the object template index is persisted, so
+            that a new process does not have to download it
+        timezone : tzinfo | str
+            The timezone in which the days of the daily events start
+            (e.g. 'Europe/Luxembourg'). Local time by default
 
         Examples:
         ---------
@@ -57,8 +398,14 @@ class PyMISPHelper:
         >>> pm.daily_mode("honeypot_1")
         >>> pm.add_attribute("ip-src", "9.9.9.9", category="Network activity")
         >>> pm.add_attribute_per_json(json.dumps({"type": "ip-src", "value": "8.9.9.9", "category": "Network activity"}))
+        >>> pm.add_attributes_bulk([{"type": "ip-src", "value": "7.7.7.7"}, {"type": "ip-src", "value": "6.6.6.6"}])
+        >>> pm.attribute_buffering(batch_size=500, max_linger=10)
+        >>> pm.enable_deduplication(max_size=100000, as_sighting=True)
+        >>> pm.sighting_aggregation(window=10, max_batch=1000)
+        >>> pm.enable_cowrie_sessions(idle_timeout=60, max_records=100)
         >>> pm.add_object("cowrie", {"session": "session_id", "username": "admin", "password": "admin", "protocol": "telnet"})
         >>> pm.add_object_per_json(json.dumps({"name": "cowrie", "session": "session_id", "username": "root", "password": "root", "protocol": "ssh"}))
+        >>> pm.register_object_generator("dionaea", "sensors:DionaeaMispObject")
         >>> pm.add_sighting(uuid="5a9e6785-2400-4b6a-a707-4581950d210f")
         >>> pm.add_sighting_per_json({"uuid": "5a9e6bdf-9220-4b8f-ad23-4703950d210f"})
         """
@@ -67,14 +414,61 @@ class PyMISPHelper:
         self.mode_type = mode_type
         # Avoid querying MISP every time an attribute is added
         self.current_date = None
+        self.timezone = self._get_timezone(timezone)
+        # time.monotonic() of the next midnight, see `get_daily_event_id`
+        self._rollover_deadline = 0
+        # Event of the next day created ahead, see `enable_event_precreation`
+        self.precreation_lead_time = None
+        self._precreation_timer = None
+        self._next_event = None  # (date, event_id)
         self.verbose = verbose
+        # The helper can be shared between threads, guards the cached states
+        self._lock = threading.RLock()
+        # Attribute buffering, see `attribute_buffering`
+        self.attribute_batch_size = None
+        self.attribute_max_linger = None
+        self._attribute_buffer = {}  # event_id -> [MISPAttribute]
+        self._attribute_buffer_items = {}  # event_id -> [dict]
+        self._attribute_buffer_since = {}  # event_id -> time of first buffered item
+        self._attribute_buffer_first_seq = {}  # event_id -> seq of first buffered item
+        # Every buffered attribute or sighting gets a sequence number,
+        # see `buffer_watermark`
+        self._buffer_seq = 0
+        # Shared daily event ids, see `enable_shared_event_cache`
+        self.event_cache_redis = None
+        # Pooled HTTP session, see `configure_http`
+        self.http_session = None
+        self.http_adapter = None
+        # see `enable_circuit_breaker`
+        self.circuit_breaker = None
+        # see `enable_metrics`
+        self.metrics = None
+        # Object template index, see `get_object_template`
+        self.template_cache_ttl = template_cache_ttl
+        self.template_cache_file = template_cache_file
+        self._template_index = None  # template name -> template id
+        self._template_index_time = None
+        self._template_download_time = None  # last download from MISP
+        # Deduplication of attributes, see `enable_deduplication`
+        self.dedup_enabled = False
+        self.dedup_hits = 0
+        self.dedup_misses = 0
+        self._dedup_cache = OrderedDict()  # LRU of (event_id, type, value)
+        self._dedup_pending = set()  # being pushed, not yet accepted by MISP
+        # Sighting aggregation, see `sighting_aggregation`
+        self.sighting_window = None
+        self.sighting_max_batch = None
+        self._sighting_buffer = OrderedDict()  # (field, id, source, type) -> {timestamp: count}
+        self._sighting_buffer_count = 0
+        self._sighting_buffer_since = None
+        self._sighting_buffer_first_seq = None
+        # Cowrie session aggregation, see `enable_cowrie_sessions`
+        self.cowrie_sessions = None
         if self.mode_type == self.MODE_DAILY:
             self.daily_mode(daily_event_name)
 
-        # Map object_name with their constructor
-        self.dico_object = {
-                'cowrie': CowrieMispObject
-        }
+        # Map object_name with their constructor, imported on first use
+        self.dico_object = ObjectGeneratorRegistry()
 
     def log(self, msg):
         if self.verbose:
@@ -87,7 +481,7 @@ class PyMISPHelper:
         self.mode_type = self.MODE_NORMAL
 
     # DAILY
-    def daily_mode(self, daily_event_name):
+    def daily_mode(self, daily_event_name, resolve=True):
         """
         Switch to daily mode
         Daily mode can be use to automatically create and get daily event
@@ -98,12 +492,19 @@ class PyMISPHelper:
             The name of the daily event.
             It will have the following format on MISP:
                 daily_event_name YYYY-MM-DD
+        resolve : bool
+            Fetch (or create) the event of today right away. Otherwise it
+            is only done when first needed, e.g. never when importing old
+            logs with `fetch_daily_event_id(date)`
         """
         self.current_date = None
+        self._rollover_deadline = 0
+        self._next_event = None
         self.daily_event_name = daily_event_name+' {}'  # used by format
         self.mode_type = self.MODE_DAILY
-        self.eventID_to_push = self.get_daily_event_id()
+        self.eventID_to_push = self.get_daily_event_id() if resolve else None
 
+    @instrumented
     def get_all_related_events(self):
         """
         Fetch all the event info fom MISP matching the daily event name
@@ -119,43 +520,101 @@ class PyMISPHelper:
             })
         return events
 
-    def fetch_daily_event_id(self):
+    def enable_shared_event_cache(self, redis_serv,
+                                  prefix='PyMISPHelper:daily_event',
+                                  ttl=2*24*3600, lock_timeout=60):
+        """
+        Share the daily event ids between processes through redis
+        The id is stored under prefix:<event info>, and the lookup/creation
+        of a missing event is protected by a redis lock so that concurrent
+        consumers never create the same daily event twice
+        Parameters:
+        -----------
+        redis_serv : StrictRedis
+            The redis connection used to store the ids and the lock
+        prefix : str
+            Prefix of the redis keys
+        ttl : int
+            Expiration of the cached ids in seconds
+        lock_timeout : int
+            Maximum time in seconds to hold and to wait for the lock
+        """
+        self.event_cache_redis = redis_serv
+        self.event_cache_prefix = prefix
+        self.event_cache_ttl = ttl
+        self.event_cache_lock_timeout = lock_timeout
+
+    @instrumented
+    def fetch_daily_event_id(self, date=None):
         """
-        Query MISP to get the correct event id
+        Get the correct event id from the shared cache, or from MISP
+        Parameters:
+        -----------
+        date : datetime.date
+            The day of the event. Today by default
         """
         if self.mode_type != self.MODE_DAILY:
             raise NotInEventMode('Daily mode is disabled. Switch to daily mode required to access this function')
-        to_match = self.daily_event_name.format(datetime.date.today())
-        events = self.get_all_related_events()
-        for dic in events:
-            info = dic['info']
-            e_id = dic['id']
-            if info == to_match:
-                self.log('Found: ' + info + '->' + e_id)
-                self.current_date = datetime.date.today()
-                return int(e_id)
-        created_event = self.create_daily_event()['Event']
+        is_today = date is None
+        if is_today:
+            date = self.today()
+        serv = self.event_cache_redis
+        if serv is None:
+            e_id = self.find_or_create_daily_event(date)
+        else:
+            cache_key = '{}:{}'.format(self.event_cache_prefix, self.daily_event_name.format(date))
+            cached = serv.get(cache_key)
+            if cached is None:
+                with serv.lock(cache_key + ':lock', timeout=self.event_cache_lock_timeout,
+                               blocking_timeout=self.event_cache_lock_timeout):
+                    # another process may have created it while we waited
+                    cached = serv.get(cache_key)
+                    if cached is None:
+                        e_id = self.find_or_create_daily_event(date)
+                        serv.set(cache_key, e_id, ex=self.event_cache_ttl)
+            if cached is not None:
+                e_id = int(cached)
+                self.log('Found in cache: {}->{}'.format(cache_key, e_id))
+        if is_today:
+            self.current_date = date
+        return e_id
+
+    @instrumented
+    def find_or_create_daily_event(self, date):
+        """
+        Search MISP for the daily event of the given day (exact info, event
+        date of that day), and create it if it does not exist
+        """
+        to_match = self.daily_event_name.format(date)
+        results = self.pymisp.search_index(eventinfo=to_match,
+                                           datefrom=str(date), dateuntil=str(date))
+        for e in results.get('response', []):
+            if e['info'] == to_match:
+                self.log('Found: ' + e['info'] + '->' + e['id'])
+                return int(e['id'])
+        created_event = self.create_daily_event(date=date)['Event']
         new_id = created_event['id']
         self.log('New event created: ' + new_id)
-        self.current_date = datetime.date.today()
         return int(new_id)
 
+    @instrumented
     def create_daily_event(self, distribution=0, threat_level_id=3,
                            analysis=0, date=None, published=False,
                            orgc_id=None, org_id=None, sharing_group_id=None):
         """
         Create the daily event id on MISP
+        The event is created for the given date, today by default
         """
-        today = datetime.date.today()
+        day = date if date is not None else self.today()
         distribution = distribution  # [0-3]
-        info = self.daily_event_name.format(today)
+        info = self.daily_event_name.format(day)
         analysis = analysis  # [0-2]
         threat_level_id = threat_level_id  # [1-4]
         published = published
         org_id = org_id
         orgc_id = orgc_id
         sharing_group_id = sharing_group_id
-        date = date
+        date = str(date) if date is not None else None
         event = self.pymisp.new_event(distribution=distribution,
                     threat_level_id=threat_level_id,
                     analysis=analysis, info=info, date=date,
@@ -166,16 +625,92 @@ class PyMISPHelper:
     def get_daily_event_id(self):
         """
         Return the correct event id if daily mode is activated
+        The id is only refreshed once the next midnight is passed
         """
         if self.mode_type == self.MODE_DAILY:
-            if self.current_date != datetime.date.today():  # refresh id
-                self.eventID_to_push = self.fetch_daily_event_id()
+            if time.monotonic() >= self._rollover_deadline:  # refresh id
+                if self.metrics is not None:
+                    self.metrics.inc('event_id_rollovers_total')
+                with self._lock:
+                    if time.monotonic() >= self._rollover_deadline:
+                        self._rollover()
             return self.eventID_to_push
         else:
             raise NotInEventMode('Daily mode not activated')
 
+    def today(self):
+        """
+        Return the current date in the configured timezone
+        """
+        return datetime.datetime.now(self.timezone).date()
+
+    def seconds_until_midnight(self):
+        now = datetime.datetime.now(self.timezone)
+        midnight = datetime.datetime.combine(now.date() + datetime.timedelta(days=1),
+                                             datetime.time(), tzinfo=now.tzinfo)
+        return midnight.timestamp() - now.timestamp()
+
+    def enable_event_precreation(self, lead_time=300):
+        """
+        Create the event of the next day `lead_time` seconds before midnight
+        in a background thread, so that the first item of the day does not
+        wait for MISP
+        """
+        self.precreation_lead_time = lead_time
+        self._schedule_precreation()
+
+    def disable_event_precreation(self):
+        self.precreation_lead_time = None
+        if self._precreation_timer is not None:
+            self._precreation_timer.cancel()
+            self._precreation_timer = None
+
+    def _rollover(self):
+        today = self.today()
+        if self._next_event is not None and self._next_event[0] == today:
+            self.eventID_to_push = self._next_event[1]
+            self.current_date = today
+            self.log('Using the pre-created event {}'.format(self.eventID_to_push))
+        else:
+            self.eventID_to_push = self.fetch_daily_event_id()
+        self._next_event = None
+        self._rollover_deadline = time.monotonic() + self.seconds_until_midnight()
+        # a new event has no attributes yet
+        self._dedup_cache.clear()
+        if self.precreation_lead_time is not None:
+            self._schedule_precreation()
+
+    def _schedule_precreation(self):
+        if self._precreation_timer is not None:
+            self._precreation_timer.cancel()
+        next_date = self.today() + datetime.timedelta(days=1)
+        delay = max(0, self.seconds_until_midnight() - self.precreation_lead_time)
+        self._precreation_timer = threading.Timer(delay, self._precreate_event, args=(next_date, ))
+        self._precreation_timer.daemon = True
+        self._precreation_timer.start()
+
+    def _precreate_event(self, date):
+        if self.mode_type != self.MODE_DAILY:
+            return
+        try:
+            self._next_event = (date, self.fetch_daily_event_id(date=date))
+            self.log('Event of {} ready: {}'.format(date, self._next_event[1]))
+        except Exception as e:
+            print('Could not create the event of {}: {}'.format(date, e))
+
+    @staticmethod
+    def _get_timezone(timezone):
+        if timezone is None or isinstance(timezone, datetime.tzinfo):
+            return timezone
+        try:
+            from zoneinfo import ZoneInfo
+        except ImportError:
+            raise PyMISPHelperError('Timezone names require python >= 3.9, pass a tzinfo instead')
+        return ZoneInfo(timezone)
+
 
     # OBJECT
+    @instrumented
     def add_object(self, name, dict_values, event_id=None):
         """
         Add an object to MISP
@@ -184,7 +719,9 @@ class PyMISPHelper:
         name : str
             The MISP object name (also name of the object template)
         dict_values : dict | AbstractMISPObjectGenerator
-            The values to populate the MISP object or the MISPObject itself
+            The values to populate the MISP object or the MISPObject itself.
+            Dicts are converted by the generator registered for name, or by
+            GenericMispObject (see `register_object_generator`)
         event_id : int
             The event id where the object will be added to. If not provided and the MODE_DAILY is not enable it will throw an error
         """
@@ -194,6 +731,16 @@ class PyMISPHelper:
         elif self.mode_type == self.MODE_DAILY and event_id is None:
             event_id = self.get_daily_event_id()
 
+        if self.cowrie_sessions is not None and name == 'cowrie' and \
+                type(dict_values) is dict and 'session' in dict_values:
+            with self._lock:
+                self._buffer_seq += 1
+                ready = self.cowrie_sessions.add(dict_values,
+                                                 key=(event_id, dict_values['session']),
+                                                 context=event_id,
+                                                 seq=self._buffer_seq)
+            return self._push_sessions(ready)
+
         templateID = self.get_object_template(name)
 
         if type(dict_values) is dict:
@@ -210,6 +757,7 @@ class PyMISPHelper:
             print(r)
             return r
 
+    @instrumented
     def add_object_per_json(self, data, event_id=None):
         """
         Add an object to MISP from a JSON or dict
@@ -223,7 +771,7 @@ class PyMISPHelper:
         if type(data) is str:
             dict_data = json.loads(data)
         elif type(data) is dict:
-            dict_data = data
+            dict_data = dict(data)
         else:
             self.log('Type error!')
             return 'error'
@@ -237,8 +785,120 @@ class PyMISPHelper:
 
         return self.add_object(name, dict_data, event_id=event_id)
 
+    @instrumented
+    def add_objects_bulk(self, name, objects, event_id=None):
+        """
+        Add several objects to an event in a single request, an edit of the
+        event carrying the new objects
+        Parameters:
+        -----------
+        name : str
+            The MISP object name of all the objects
+        objects : list of dict | list of AbstractMISPObjectGenerator
+            The values of the objects (converted by the generator of name,
+            in bulk if it supports it, see GenericMispObject.from_records)
+            or the MISPObjects themselves
+        event_id : int
+            The event id where the objects will be added to
+        """
+        if self.mode_type == self.MODE_NORMAL and event_id is None:
+            raise MissingID("Trying to push objects without supplying an event id")
+        elif self.mode_type == self.MODE_DAILY and event_id is None:
+            event_id = self.get_daily_event_id()
+        if not objects:
+            return None
+
+        # records can be OrderedDict (e.g. merged cowrie sessions)
+        records = [o for o in objects if not hasattr(o, 'to_json')]
+        misp_objects = [o for o in objects if hasattr(o, 'to_json')]
+        if records:
+            constructor = self.dico_object[name]
+            if hasattr(constructor, 'from_records'):
+                misp_objects += constructor.from_records(records)
+            else:
+                misp_objects += [constructor(record) for record in records]
+        if self.metrics is not None:
+            self.metrics.observe('batch_size', len(misp_objects), kind='object')
+        # to_json is available in every PyMISP version
+        event = '{{"Event": {{"id": {}, "Object": [{}]}}}}'.format(
+            json.dumps(str(event_id)), ', '.join(o.to_json() for o in misp_objects))
+        r = self.pymisp.update_event(event_id, event)
+        if self._has_errors(r):
+            print(r)
+            return r if isinstance(r, dict) else {'errors': r}
+
+    def register_object_generator(self, name, generator):
+        """
+        Use generator to build the objects name from a dict
+        Parameters:
+        -----------
+        name : str
+            The MISP object name
+        generator : callable | str
+            The generator (e.g. an AbstractMISPObjectGenerator class taking
+            the dict of values) or its path 'module:Class', only imported
+            when first used
+        """
+        self.dico_object.register(name, generator)
+
+    def enable_cowrie_sessions(self, idle_timeout=60, max_records=100,
+                               max_sessions=10000):
+        """
+        Merge the cowrie records of a same session into a single MISP object
+        instead of creating one object per log line. A session is pushed when
+        cowrie closes it, when it reached max_records, after idle_timeout
+        seconds without records or when flushed, see `flush_sessions`
+        Parameters:
+        -----------
+        idle_timeout : float
+            Number of seconds without records after which a session is pushed
+        max_records : int
+            Maximum number of records merged in a single object
+        max_sessions : int
+            Maximum number of sessions kept in memory, the least recently
+            active one is pushed when exceeded
+        """
+        with self._lock:
+            self.cowrie_sessions = CowrieSessionizer(idle_timeout=idle_timeout,
+                                                     max_records=max_records,
+                                                     max_sessions=max_sessions)
+
+    @instrumented
+    def flush_sessions(self, only_expired=False):
+        """
+        Push the merged cowrie sessions to MISP, only the idle ones if
+        only_expired is set
+        Returns the list of errors
+        """
+        if self.cowrie_sessions is None:
+            return []
+        with self._lock:
+            ready = self.cowrie_sessions.flush(only_expired=only_expired)
+        return self._push_sessions(ready, collect=True)
+
+    def buffered_sessions(self):
+        """
+        Return the number of cowrie sessions waiting to be pushed
+        """
+        return 0 if self.cowrie_sessions is None else len(self.cowrie_sessions)
+
+    def _push_sessions(self, ready, collect=False):
+        errors = []
+        misp_objects = CowrieMispObject.from_records([record for record, event_id in ready])
+        for misp_object, (record, event_id) in zip(misp_objects, ready):
+            r = self.add_object('cowrie', misp_object, event_id=event_id)
+            if r is not None:
+                errors.append({'errors': r, 'items': [dict(record, name='cowrie')]})
+        if collect:
+            return errors
+        # errors of sessions pushed while adding a record are reported to the
+        # caller, with the merged records
+        if errors:
+            return errors[0] if len(errors) == 1 else {'errors': errors}
+
 
     # SIGHTING
+    @instrumented
     def add_sighting(self, value=None, uuid=None, id=None, source=None, type=0, timestamp=None, **kargs):
         """
         Make a single sighting
@@ -258,11 +918,15 @@ class PyMISPHelper:
            Timestamp associated to the sighting
         """
 
+        if self.sighting_window is not None and not kargs:
+            return self._aggregate_sighting(value, uuid, id, source, type, timestamp)
+
         r = self.pymisp.sighting(value=value, uuid=uuid, id=id, source=source, type=type, timestamp=timestamp, **kargs)
-        if 'errors' in r:
+        if self._has_errors(r):
             print(r)
             return r
 
+    @instrumented
     def add_sighting_per_json(self, data):
         """
         Make a sighting
@@ -281,11 +945,140 @@ class PyMISPHelper:
 
         return self.add_sighting(**dict_data)
 
+    def sighting_aggregation(self, window=10, max_batch=1000):
+        """
+        Enable sighting aggregation
+        Sightings are merged over `window` seconds by (value or uuid or id,
+        source, type), keeping the count of each timestamp. Sightings on
+        values are then sent in bulk, with one request per (source, type,
+        timestamp) and per occurrence of the most sighted value, so that
+        every sighting is kept. MISP has no bulk call for the sightings on
+        an uuid or id, they are sent one by one
+        Parameters:
+        -----------
+        window : float
+            Number of seconds sightings are aggregated.
+            None disables aggregation (pending sightings are flushed)
+        max_batch : int
+            Number of aggregated sightings triggering a push, and maximum
+            number of values sent in a single request
+        """
+        if window is None:
+            errors = self.flush_sightings()
+            self.sighting_window = None
+            return errors
+        self.sighting_window = window
+        self.sighting_max_batch = max_batch
+
+    @instrumented
+    def flush_sightings(self):
+        """
+        Push the aggregated sightings to MISP
+        Returns the list of failed pushes (empty if everything went well)
+        """
+        with self._lock:
+            pending, self._sighting_buffer = self._sighting_buffer, OrderedDict()
+            self._sighting_buffer_count = 0
+            self._sighting_buffer_since = None
+            self._sighting_buffer_first_seq = None
+
+        # MISP adds a single sighting per attribute matching the values of a
+        # request, and only takes one timestamp: occurrences are sent in
+        # rounds per (source, type, timestamp), each value at most once per round
+        per_batch = OrderedDict()  # (source, type, timestamp) -> {value: count}
+        errors = []
+        for (field, identifier, source, type_sighting), timestamps in pending.items():
+            for timestamp, count in timestamps.items():
+                if field == 'value':
+                    counts = per_batch.setdefault((source, type_sighting, timestamp), OrderedDict())
+                    counts[identifier] = counts.get(identifier, 0) + count
+                    continue
+                # one request per occurrence, MISP has no count
+                for i in range(count):
+                    r = self.pymisp.sighting(source=source, type=type_sighting,
+                                             timestamp=timestamp,
+                                             **{field: identifier})
+                    if self._has_errors(r):
+                        errors.append({'errors': r, 'items': [self._sighting_item(
+                            field, identifier, source, type_sighting, timestamp)]})
+
+        max_batch = self.sighting_max_batch
+        for (source, type_sighting, timestamp), counts in per_batch.items():
+            while counts:
+                values = list(counts.keys())
+                for value in values:
+                    counts[value] -= 1
+                    if counts[value] == 0:
+                        del counts[value]
+                for i in range(0, len(values), max_batch or len(values)):
+                    chunk = values[i:i + (max_batch or len(values))]
+                    to_post = {'values': chunk, 'source': source,
+                               'type': type_sighting, 'timestamp': timestamp}
+                    if self.metrics is not None:
+                        self.metrics.observe('batch_size', len(chunk), kind='sighting')
+                    r = self.pymisp.set_sightings({k: v for k, v in to_post.items() if v is not None})
+                    if self._has_errors(r):
+                        print(r)
+                        # one item per sighting, as they were added
+                        errors.append({'errors': r, 'items': [
+                            self._sighting_item('value', value, source, type_sighting, timestamp)
+                            for value in chunk]})
+        return errors
+
+    def flush_due_sightings(self):
+        """
+        Push the aggregated sightings if the aggregation window is over
+        Returns the list of failed pushes (empty if everything went well)
+        """
+        since = self._sighting_buffer_since
+        if since is None or time.time() - since < self.sighting_window:
+            return []
+        return self.flush_sightings()
+
+    def buffered_sightings(self):
+        """
+        Return the number of sightings waiting to be aggregated
+        """
+        return self._sighting_buffer_count
+
+    @staticmethod
+    def _sighting_item(field, identifier, source, type_sighting, timestamp):
+        return {k: v for k, v in ((field, identifier), ('source', source), ('type', type_sighting),
+                                  ('timestamp', timestamp)) if v is not None}
+
+    def _aggregate_sighting(self, value, uuid, id, source, type_sighting, timestamp):
+        if value is not None:
+            field, identifier = 'value', value
+        elif uuid is not None:
+            field, identifier = 'uuid', uuid
+        else:
+            field, identifier = 'id', id
+        agg_key = (field, identifier, source, type_sighting)
+        if timestamp is not None:
+            timestamp = int(timestamp)
+        with self._lock:
+            # timestamp -> number of sightings
+            timestamps = self._sighting_buffer.setdefault(agg_key, {})
+            timestamps[timestamp] = timestamps.get(timestamp, 0) + 1
+            self._sighting_buffer_count += 1
+            self._buffer_seq += 1
+            if self._sighting_buffer_since is None:
+                self._sighting_buffer_since = time.time()
+                self._sighting_buffer_first_seq = self._buffer_seq
+            full = self._sighting_buffer_count >= self.sighting_max_batch
+
+        errors = self.flush_sightings() if full else self.flush_due_sightings()
+        if errors:
+            return errors[0] if len(errors) == 1 else {'errors': errors}
+
 
     # ATTRIBUTE
+    @instrumented
     def add_attribute(self, type_value, value, event_id=None, category=None, to_ids=False, comment=None, distribution=None, proposal=False, **kargs):
         """
         Add an attribute to MISP
+        If attribute buffering is enabled, the attribute is queued and sent
+        with the next batch (see `attribute_buffering`)
         Parameters:
         -----------
         type_value : str
@@ -299,15 +1092,35 @@ class PyMISPHelper:
             raise MissingID("Trying to push an object without supplying an event id")
         elif self.mode_type == self.MODE_DAILY and event_id is None:
             event_id = self.get_daily_event_id()
-        event = self.pymisp.get_event(event_id)
 
-        r = self.pymisp.add_named_attribute(event, type_value=type_value,
-            value=value, category=category, to_ids=to_ids, comment=comment,
-            distribution=distribution, proposal=proposal, **kargs)
-        if 'errors' in r:
+        if self.dedup_enabled and not proposal and \
+                self.is_duplicate(event_id, type_value, value):
+            if self.dedup_as_sighting:
+                return self.add_sighting(value=value, source=self.dedup_sighting_source)
+            return None
+
+        # Proposals are posted one by one by MISP, no need to buffer them
+        if self.attribute_batch_size is not None and not proposal:
+            item = dict(kargs, type=type_value, value=value, category=category,
+                        to_ids=to_ids, comment=comment, distribution=distribution)
+            return self._buffer_attribute(event_id, item)
+
+        # MISP only needs the event id, fetching the event is not required
+        try:
+            r = self.pymisp.add_named_attribute(event_id, type_value=type_value,
+                value=value, category=category, to_ids=to_ids, comment=comment,
+                distribution=distribution, proposal=proposal, **kargs)
+        except Exception:
+            self.forget_seen(event_id, [(type_value, value)])
+            raise
+        if self._has_errors(r):
             print(r)
+            # the attribute is not in the event, let a retry push it
+            self.forget_seen(event_id, [(type_value, value)])
             return r
+        self.mark_seen(event_id, [(type_value, value)])
 
+    @instrumented
     def add_attribute_per_json(self, data, event_id=None, proposal=False):
         """
         Push an attribute to MISP from a JSON or dict
@@ -329,7 +1142,7 @@ class PyMISPHelper:
         if type(data) is str:
             dict_data = json.loads(data)
         elif type(data) is dict:
-            dict_data = data
+            dict_data = dict(data)
         else:
             self.log('Type error!')
             return 'error'
@@ -340,24 +1153,561 @@ class PyMISPHelper:
         del dict_data['value']
         return self.add_attribute(type_value, value, event_id=event_id, **dict_data)
 
+    @instrumented
+    def add_attributes_bulk(self, attributes, event_id=None, proposal=False):
+        """
+        Add several attributes to MISP in a single request
+        The event is never fetched, only its id is used
+        Parameters:
+        -----------
+        attributes : list of dict | list of JSON (str)
+            The attributes to add (Required: type, value)
+        event_id : int
+            The event id where the attributes will be added to
+        proposal : bool
+            True or False based on whether the attributes should be proposed or directly save
+        """
+        if self.mode_type == self.MODE_NORMAL and event_id is None:
+            raise MissingID("Trying to push attributes without supplying an event id")
+        elif self.mode_type == self.MODE_DAILY and event_id is None:
+            event_id = self.get_daily_event_id()
+
+        items = []
+        for data in attributes:
+            if type(data) is str:
+                data = json.loads(data)
+            items.append(data)
+        return self._send_attributes(event_id, items, proposal=proposal)
+
+    def attribute_buffering(self, batch_size=100, max_linger=5):
+        """
+        Enable attribute buffering
+        Attributes added through `add_attribute` or `add_attribute_per_json`
+        are gathered per event id and sent with one request per batch
+        Parameters:
+        -----------
+        batch_size : int
+            Number of buffered attributes triggering a push for an event.
+            None disables buffering (remaining attributes are flushed)
+        max_linger : float
+            Maximum number of seconds an attribute can stay in the buffer.
+            Checked when adding attributes or calling `flush_due_attributes`
+        """
+        if batch_size is None:
+            errors = self.flush_attributes()
+            self.attribute_batch_size = None
+            return errors
+        self.attribute_batch_size = batch_size
+        self.attribute_max_linger = max_linger
+
+    @instrumented
+    def flush_attributes(self, event_id=None):
+        """
+        Push the buffered attributes to MISP
+        Returns the list of failed pushes (empty if everything went well)
+        Parameters:
+        -----------
+        event_id : int
+            Only flush the attributes buffered for this event. All by default
+        """
+        with self._lock:
+            event_ids = list(self._attribute_buffer.keys()) if event_id is None else [event_id]
+            batches = []
+            for e_id in event_ids:
+                if not self._attribute_buffer.get(e_id):
+                    continue
+                batches.append((e_id, self._attribute_buffer.pop(e_id),
+                                self._attribute_buffer_items.pop(e_id)))
+                self._attribute_buffer_since.pop(e_id, None)
+                self._attribute_buffer_first_seq.pop(e_id, None)
+
+        errors = []
+        for e_id, attributes, items in batches:
+            try:
+                r = self._send_attributes(e_id, attributes)
+            except Exception:
+                self.forget_seen(e_id, [(x['type'], x['value']) for x in items])
+                raise
+            if r is not None:
+                self.forget_seen(e_id, [(x['type'], x['value']) for x in items])
+                r['items'] = items
+                errors.append(r)
+            else:
+                self.mark_seen(e_id, [(x['type'], x['value']) for x in items])
+        return errors
+
+    def flush_due_attributes(self):
+        """
+        Push the buffered attributes that exceeded the maximum linger time
+        Returns the list of failed pushes (empty if everything went well)
+        """
+        if self.attribute_max_linger is None:
+            return []
+        now = time.time()
+        errors = []
+        for e_id, since in list(self._attribute_buffer_since.items()):
+            if now - since >= self.attribute_max_linger:
+                errors += self.flush_attributes(e_id)
+        return errors
+
+    def buffer_sequence(self):
+        """
+        Return the sequence number of the last buffered attribute or sighting
+        """
+        return self._buffer_seq
+
+    def buffer_watermark(self):
+        """
+        Return a sequence number such that every attribute or sighting
+        buffered with a lower number has been pushed to MISP
+        """
+        with self._lock:
+            first_seqs = list(self._attribute_buffer_first_seq.values())
+            if self._sighting_buffer_first_seq is not None:
+                first_seqs.append(self._sighting_buffer_first_seq)
+            if self.cowrie_sessions is not None and \
+                    self.cowrie_sessions.first_seq() is not None:
+                first_seqs.append(self.cowrie_sessions.first_seq())
+            return min(first_seqs) if first_seqs else self._buffer_seq + 1
+
+    def is_buffering(self):
+        """
+        Return True if added items may be kept in memory before being pushed
+        to MISP (see `buffer_watermark`)
+        """
+        return self.attribute_batch_size is not None or \
+            self.sighting_window is not None or self.cowrie_sessions is not None
+
+    def buffered_attributes(self):
+        """
+        Return the number of attributes waiting in the buffer
+        """
+        with self._lock:
+            return sum(len(x) for x in self._attribute_buffer.values())
+
+    def _buffer_attribute(self, event_id, item):
+        attribute = self._prepare_attribute(item)
+        with self._lock:
+            self._attribute_buffer.setdefault(event_id, []).append(attribute)
+            self._attribute_buffer_items.setdefault(event_id, []).append(item)
+            self._attribute_buffer_since.setdefault(event_id, time.time())
+            self._buffer_seq += 1
+            self._attribute_buffer_first_seq.setdefault(event_id, self._buffer_seq)
+            full = len(self._attribute_buffer[event_id]) >= self.attribute_batch_size
+
+        if full:
+            errors = self.flush_attributes(event_id)
+        else:
+            errors = self.flush_due_attributes()
+        if errors:
+            return errors[0] if len(errors) == 1 else {'errors': errors}
+
+    def _prepare_attribute(self, item):
+        item = dict(item)
+        type_value = item.pop('type')
+        value = item.pop('value')
+        category = item.pop('category', None)
+        to_ids = item.pop('to_ids', False)
+        return self.pymisp._prepare_full_attribute(category, type_value,
+                value, to_ids, **item)
+
+    def _send_attributes(self, event_id, items, proposal=False):
+        """
+        Send attributes with a single request on `attributes/add`, the same
+        endpoint used by `add_named_attribute`
+        """
+        if not items:
+            return None
+        attributes = [x if not isinstance(x, dict) else self._prepare_attribute(x) for x in items]
+        if self.metrics is not None:
+            self.metrics.observe('batch_size', len(attributes), kind='attribute')
+        r = self.pymisp._send_attributes(event_id, attributes, proposal=proposal)
+        errors = [resp for resp in r if self._has_errors(resp)]
+        if errors:
+            print(errors)
+            return {'errors': errors}
+
+    @staticmethod
+    def _has_errors(r):
+        if isinstance(r, list):
+            return any(PyMISPHelper._has_errors(x) for x in r)
+        if isinstance(r, dict):
+            return 'errors' in r or 'error' in r
+        # MISP answered with a non-JSON content
+        return isinstance(r, str)
+
+    # DEDUPLICATION
+    def enable_deduplication(self, max_size=100000, redis_serv=None,
+                             redis_prefix='PyMISPHelper:dedup',
+                             redis_ttl=2*24*3600, as_sighting=False,
+                             sighting_source=None):
+        """
+        Skip the attributes already added to the event
+        Attributes are identified by (event_id, type, value). The cache is
+        emptied when the daily event changes
+        Parameters:
+        -----------
+        max_size : int
+            Maximum number of attributes remembered in memory (LRU)
+        redis_serv : StrictRedis
+            If provided, the attributes accepted by MISP are also stored in redis sets
+            (one per event) so that several consumers share the same state
+        redis_prefix : str
+            Prefix of the redis sets: redis_prefix:event_id
+        redis_ttl : int
+            Expiration of the redis sets in seconds
+        as_sighting : bool
+            Add a sighting on the value instead of dropping the duplicate
+        sighting_source : str
+            Source of these sightings
+        """
+        self.dedup_enabled = True
+        self.dedup_max_size = max_size
+        self.dedup_redis = redis_serv
+        self.dedup_redis_prefix = redis_prefix
+        self.dedup_redis_ttl = redis_ttl
+        self.dedup_as_sighting = as_sighting
+        self.dedup_sighting_source = sighting_source
+
+    def disable_deduplication(self):
+        self.dedup_enabled = False
+        with self._lock:
+            self._dedup_cache.clear()
+            self._dedup_pending.clear()
+
+    @instrumented
+    def is_duplicate(self, event_id, type_value, value):
+        """
+        Return True if the attribute was already seen for this event, and
+        mark it as pending otherwise
+        A pending attribute is only remembered once MISP accepted it (see
+        `mark_seen`), and released if MISP refused it (see `forget_seen`), so
+        that an attribute lost before reaching MISP is not dropped later
+        """
+        entry = (str(event_id), type_value, value)
+        with self._lock:
+            if entry in self._dedup_cache:
+                self._dedup_cache.move_to_end(entry)
+                self.dedup_hits += 1
+                return True
+            if entry in self._dedup_pending:
+                self.dedup_hits += 1
+                return True
+            self._dedup_pending.add(entry)
+
+        if self.dedup_redis is not None:
+            set_key = '{}:{}'.format(self.dedup_redis_prefix, event_id)
+            if self.dedup_redis.sismember(set_key, '{}|{}'.format(type_value, value)):
+                # seen by another consumer
+                with self._lock:
+                    self._dedup_pending.discard(entry)
+                    self._remember(entry)
+                    self.dedup_hits += 1
+                return True
+
+        with self._lock:
+            self.dedup_misses += 1
+        return False
+
+    def _remember(self, entry):
+        self._dedup_cache[entry] = True
+        self._dedup_cache.move_to_end(entry)
+        if len(self._dedup_cache) > self.dedup_max_size:
+            self._dedup_cache.popitem(last=False)
+
+    def mark_seen(self, event_id, attributes):
+        """
+        Remember attributes accepted by MISP, so that the next occurrences
+        are reported by `is_duplicate`
+        Parameters:
+        -----------
+        attributes : list of (type, value)
+        """
+        if not self.dedup_enabled or not attributes:
+            return
+        with self._lock:
+            for type_value, value in attributes:
+                entry = (str(event_id), type_value, value)
+                self._dedup_pending.discard(entry)
+                self._remember(entry)
+        if self.dedup_redis is not None:
+            set_key = '{}:{}'.format(self.dedup_redis_prefix, event_id)
+            pipe = self.dedup_redis.pipeline(transaction=False)
+            pipe.sadd(set_key, *['{}|{}'.format(t, v) for t, v in attributes])
+            pipe.expire(set_key, self.dedup_redis_ttl)
+            pipe.execute()
+
+    def forget_seen(self, event_id, attributes):
+        """
+        Release attributes marked as pending by `is_duplicate` that MISP did
+        not accept, so that they are not dropped when retried or replayed
+        Parameters:
+        -----------
+        attributes : list of (type, value)
+        """
+        if not self.dedup_enabled or not attributes:
+            return
+        with self._lock:
+            for type_value, value in attributes:
+                self._dedup_pending.discard((str(event_id), type_value, value))
+
+    def get_dedup_stats(self):
+        """
+        Return the hit and miss counters of the deduplication cache
+        """
+        total = self.dedup_hits + self.dedup_misses
+        return {
+            'hits': self.dedup_hits,
+            'misses': self.dedup_misses,
+            'hit_rate': float(self.dedup_hits) / total if total else 0.0,
+            'size': len(self._dedup_cache)
+        }
+
     # FEED
+    @instrumented
     def feed_register(self):
         pass
 
 
+    # HTTP
+    def configure_http(self, pool_connections=10, pool_maxsize=10,
+                       keep_alive=True, timeout=(10, 120), retries=3,
+                       backoff_factor=0.5,
+                       retry_statuses=(429, 500, 502, 503, 504)):
+        """
+        Make the PyMISP object send its requests through a single pooled
+        requests session, so that connections are kept alive and reused
+        Parameters:
+        -----------
+        pool_connections : int
+            Number of hosts for which a connection pool is kept
+        pool_maxsize : int
+            Maximum number of connections kept per host. Should be at least
+            the number of threads pushing to MISP
+        keep_alive : bool
+            Enable TCP keep-alive on the connections
+        timeout : float | (float, float)
+            Default (connect, read) timeout in seconds
+        retries : int
+            Number of retries on connection errors and `retry_statuses`.
+            POST requests are only retried on 429 and 503, and read
+            timeouts are never retried (see MISPRetry)
+        backoff_factor : float
+            Retries wait backoff_factor * 2^(retry number) seconds
+            (or the Retry-After header of 429 answers)
+        retry_statuses : tuple
+            HTTP statuses triggering a retry
+        """
+        # a request timing out may have been applied by MISP: it is not sent
+        # again, as POST requests would create duplicates (see MISPRetry)
+        retry_kargs = dict(total=retries, read=0, backoff_factor=backoff_factor,
+                           status_forcelist=retry_statuses,
+                           respect_retry_after_header=True,
+                           raise_on_status=False)
+        try:
+            # MISP is mostly reached with POST requests
+            retry = MISPRetry(allowed_methods=None, **retry_kargs)
+        except TypeError:  # urllib3 < 1.26
+            retry = MISPRetry(method_whitelist=False, **retry_kargs)
+        adapter = PooledHTTPAdapter(timeout=timeout, tcp_keepalive=keep_alive,
+                                    pool_connections=pool_connections,
+                                    pool_maxsize=pool_maxsize, max_retries=retry)
+        adapter.circuit_breaker = self.circuit_breaker
+        adapter.metrics = self.metrics
+
+        # PyMISP >= 2.4.120 keeps a session for all its requests
+        session = getattr(self.pymisp, '_PyMISP__session', None)
+        if session is None:
+            session = requests.Session()
+            self.pymisp._prepare_request = self._make_pooled_prepare_request(session)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        self.http_session = session
+        self.http_adapter = adapter
+
+    def enable_metrics(self, metrics=None):
+        """
+        Record the latency of the MISP requests (per operation), of the calls
+        of the helper methods, the batch sizes and the cache hit rates
+        The HTTP pool is configured with its defaults if it is not yet
+        Parameters:
+        -----------
+        metrics : Metrics
+            The registry to use, a new one by default
+        """
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.metrics.describe('misp_request_seconds', 'Latency of the MISP requests per operation')
+        self.metrics.describe('misp_requests_total', 'MISP requests per operation and HTTP status')
+        self.metrics.describe('helper_call_seconds', 'Duration of the PyMISPHelper calls per method')
+        self.metrics.describe('batch_size', 'Number of items sent in a single MISP request',
+                              buckets=Metrics.SIZE_BUCKETS)
+        self.metrics.describe('cache_requests_total', 'Cache lookups per cache and result')
+        self.metrics.register_collector(self._collect_metrics)
+        if self.http_adapter is None:
+            self.configure_http()
+        self.http_adapter.metrics = self.metrics
+        return self.metrics
+
+    def _collect_metrics(self, metrics):
+        metrics.set_gauge('buffered_items', self.buffered_attributes(), kind='attribute')
+        metrics.set_gauge('buffered_items', self.buffered_sightings(), kind='sighting')
+        metrics.set_gauge('buffered_items', self.buffered_sessions(), kind='cowrie_session')
+        if self.dedup_enabled:
+            stats = self.get_dedup_stats()
+            metrics.set_gauge('dedup_hit_rate', stats['hit_rate'])
+            metrics.set_gauge('dedup_cache_size', stats['size'])
+        if self.circuit_breaker is not None:
+            stats = self.circuit_breaker.get_stats()
+            metrics.set_gauge('circuit_open', int(stats['state'] != CircuitBreaker.CLOSED))
+            metrics.set_gauge('concurrency_limit', stats['limit'])
+
+    def enable_circuit_breaker(self, **kargs):
+        """
+        Track the health of MISP (errors and latency of every request) with
+        a CircuitBreaker, used by RedisToMISP to stop popping items while
+        MISP is down and to adapt the number of concurrent requests.
+        The HTTP pool is configured with its defaults if it is not yet
+        Parameters:
+        -----------
+        **kargs
+            Parameters of CircuitBreaker
+        """
+        self.circuit_breaker = CircuitBreaker(**kargs)
+        if self.http_adapter is None:
+            self.configure_http()
+        self.http_adapter.circuit_breaker = self.circuit_breaker
+        return self.circuit_breaker
+
+    def get_http_stats(self):
+        """
+        Return, for each pooled host, the number of connections opened, of
+        requests sent and of idle connections
+        """
+        stats = {}
+        adapter = self.http_adapter
+        if adapter is None:
+            return stats
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            stats['{}://{}:{}'.format(pool.scheme, pool.host, pool.port)] = {
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': pool.pool.qsize() if pool.pool is not None else 0
+            }
+        return stats
+
+    def _make_pooled_prepare_request(self, session):
+        """
+        Wrap PyMISP._prepare_request (PyMISP 2.4.x up to 2.4.119, which opens
+        a new session for every request) so that it sends the requests
+        through `session`. Only the session lookup is replaced, the request
+        itself (headers, debug logging, asynch mode) is built by PyMISP
+        """
+        if not isinstance(pymisp.api.requests, _PooledSessionLookup):
+            pymisp.api.requests = _PooledSessionLookup()
+        prepare_request = self.pymisp._prepare_request
+        local = _PooledSessionLookup.local
+
+        @functools.wraps(prepare_request)
+        def _prepare_request(*args, **kargs):
+            previous = getattr(local, 'session', None)
+            local.session = session
+            try:
+                return prepare_request(*args, **kargs)
+            finally:
+                local.session = previous
+
+        return _prepare_request
+
     # OTHERS
+    @instrumented
     def get_object_template(self, name):
-            """
-            Get the template id for the given MISP object name
-            Parameters
-            ----------
-            name : str
-                The name of the MISP object
-            """
-            try:
-                templateID = [x['ObjectTemplate']['id'] for x in self.pymisp.get_object_templates_list() if x['ObjectTemplate']['name'] == name][0]
-                return templateID
+        """
+        Get the template id for the given MISP object name
+        The template index is kept in memory and refreshed once its TTL is
+        expired or when the name is unknown, at most every
+        TEMPLATE_MISS_INTERVAL seconds
+        Parameters
+        ----------
+        name : str
+            The name of the MISP object
+        """
+        if self._template_index_expired():
+            with self._lock:
+                if self._template_index_expired():
+                    self.refresh_object_templates(from_misp=False)
+
+        templateID = self._template_index.get(name)
+        if self.metrics is not None:
+            self.metrics.inc('cache_requests_total', cache='template',
+                             result='miss' if templateID is None else 'hit')
+        if templateID is None and self._template_miss_refresh_due():
+            # The template may have been added on MISP since the last refresh
+            with self._lock:
+                if self._template_miss_refresh_due():
+                    self.refresh_object_templates()
+            templateID = self._template_index.get(name)
+        if templateID is None:
+            valid_types = ", ".join(sorted(self._template_index.keys()))
+            print("Template for type %s not found! Valid types are: %s" % (name, valid_types))
+        return templateID
+
+    @instrumented
+    def refresh_object_templates(self, from_misp=True):
+        """
+        Reload the object template index
+        Parameters
+        ----------
+        from_misp : bool
+            If False, the index is loaded from `template_cache_file` when it
+            is still valid. It is downloaded from MISP otherwise
+        """
+        if not from_misp and self._load_template_index():
+            return
+        templates = self.pymisp.get_object_templates_list()
+        if isinstance(templates, dict):  # newer PyMISP wrap lists in 'response'
+            templates = templates.get('response', [])
+        self._template_index = {x['ObjectTemplate']['name']: x['ObjectTemplate']['id'] for x in templates}
+        self._template_index_time = self._template_download_time = time.time()
+        self.log('Object template index downloaded ({} templates)'.format(len(self._template_index)))
+        self._save_template_index()
+
+    def _template_miss_refresh_due(self):
+        # unknown names must not download the index for every item
+        return self._template_download_time is None or \
+            time.time() - self._template_download_time >= self.TEMPLATE_MISS_INTERVAL
+
+    def _template_index_expired(self):
+        if self._template_index is None:
+            return True
+        if self.template_cache_ttl is None:
+            return False
+        return time.time() - self._template_index_time > self.template_cache_ttl
 
-            except IndexError:
-                valid_types = ", ".join([x['ObjectTemplate']['name'] for x in self.pymisp.get_object_templates_list()])
-                print("Template for type %s not found! Valid types are: %s" % (self.name, valid_types))
+    def _load_template_index(self):
+        if self.template_cache_file is None:
+            return False
+        try:
+            with open(self.template_cache_file) as f:
+                cached = json.load(f)
+            index, timestamp = cached['templates'], cached['timestamp']
+        except (IOError, ValueError, KeyError, TypeError):
+            return False
+        if self.template_cache_ttl is not None and time.time() - timestamp > self.template_cache_ttl:
+            return False
+        self._template_index = index
+        self._template_index_time = timestamp
+        return True
+
+    def _save_template_index(self):
+        if self.template_cache_file is None:
+            return
+        try:
+            with open(self.template_cache_file, 'w') as f:
+                json.dump({'timestamp': self._template_index_time,
+                           'templates': self._template_index}, f)
+        except IOError as e:
+            self.log('Could not save the object template index: {}'.format(e))
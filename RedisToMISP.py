@@ -8,11 +8,25 @@ import time
 import json
 import threading
 import sys
+import zlib
+import os
+import socket
+import signal
+import contextlib
+import importlib.util
+import multiprocessing
 
-from pymisp import PyMISP
-from PyMISPHelper import PyMISPHelper, PyMISPError, flag_MISPKeys
+try:
+    import queue
+except ImportError:  # python2
+    import Queue as queue
 
-evtObj = thr = None  # animation thread
+from pymisp import PyMISP, PyMISPError
+from PyMISPHelper import PyMISPHelper
+from Metrics import Metrics
+import WireFormat
+
+flag_MISPKeys = importlib.util.find_spec('MISPKeys') is not None
 
 
 class RedisToMISPException(Exception):
@@ -29,22 +43,48 @@ class NoValidObject(RedisToMISPException):
     pass
 
 
-def processing_animation(evtObj, buffer_state, refresh_rate=5):
-    i = 0
-    buffer_state_str = 'attributes: {}, objects: {}, sightings: {}'.format(
-        buffer_state['attribute'],
-        buffer_state['object'],
-        buffer_state['sighting'])
-    while True:
-        if evtObj.is_set():
-            # overwrite last characters
-            print(" "*(len(buffer_state_str)+20), end="\r", sep="")
+class ProgressReporter(threading.Thread):
+    """
+    Single long-lived thread displaying the remaining items in the queues.
+    The queue depths are sampled every `sample_interval` seconds, so the
+    consumer does not pay anything per item
+    """
+
+    def __init__(self, get_buffer_state, refresh_rate=5, sample_interval=2):
+        super(ProgressReporter, self).__init__(name="processing-animation")
+        self.daemon = True
+        self.get_buffer_state = get_buffer_state
+        self.refresh_rate = refresh_rate
+        self.sample_interval = sample_interval
+        self.evtObj = threading.Event()
+
+    def run(self):
+        i = 0
+        last_sample = 0
+        buffer_state_str = ''
+        while not self.evtObj.is_set():
+            if time.time() - last_sample >= self.sample_interval:
+                last_sample = time.time()
+                try:
+                    buffer_state = self.get_buffer_state()
+                except redis.RedisError:
+                    buffer_state = None
+                if buffer_state is not None:
+                    buffer_state_str = 'attributes: {}, objects: {}, sightings: {}'.format(
+                        buffer_state['attribute'],
+                        buffer_state['object'],
+                        buffer_state['sighting'])
+            i += 1
+            print("Remaining: { %s }\t" % buffer_state_str + "/-\\|"[i%4], end="\r", sep="")
             sys.stdout.flush()
-            return
-        i += 1
-        print("Remaining: { %s }\t" % buffer_state_str + "/-\|"[i%4], end="\r", sep="")
+            self.evtObj.wait(1.0/float(self.refresh_rate))
+        # overwrite last characters
+        print(" "*(len(buffer_state_str)+20), end="\r", sep="")
         sys.stdout.flush()
-        time.sleep(1.0/float(refresh_rate))
+
+    def stop(self):
+        self.evtObj.set()
+        self.join()
 
 
 def beautyful_sleep_undefined(sleep):
@@ -68,15 +108,132 @@ def beautyful_sleep(sleep):
         time.sleep(sleeptime)
 
 
+def parse_key_settings(values, cast=float):
+    """
+    Return a dict from a list of KEY=VALUE strings (e.g. --keyWeight)
+    """
+    settings = {}
+    for value in values or []:
+        key, _, setting = value.rpartition('=')
+        if not key:
+            raise ValueError('Expected KEY=VALUE, got {}'.format(value))
+        settings[key] = cast(setting)
+    return settings
+
+
+class KeyScheduler:
+    def __init__(self, keys, weights=None, priorities=None, quotas=None,
+                 default_weight=100, default_quota=1):
+        """
+        Deficit round-robin over the redis keys: at each round, every key
+        receives `weight` credits and can give up to that many items, taken
+        by batch of at most `quota` items. Keys are visited by decreasing
+        priority. A busy key thus cannot starve the others: an item waits at
+        most one round, i.e. the sum of the weights of the other keys.
+        The credits of an empty key are dropped, and a fractional weight
+        (e.g. 0.1) lets a key give one item every few rounds.
+
+        Parameters:
+        -----------
+        weights, priorities, quotas : dict
+            Settings per key. A setting applies to the key with this exact
+            name, else to the keys ending with it (e.g. `_sighting` or
+            `sighting`), else to the keys starting with it (e.g. a keyname
+            given to --keynamePop)
+        default_weight : float
+            Number of items per round of the keys without weight
+        default_quota : int
+            Number of items per round trip of the keys without quota
+        """
+        self.weights = {k: self.get_setting(weights, k, default_weight) for k in keys}
+        self.quotas = {k: max(1, int(self.get_setting(quotas, k, default_quota))) for k in keys}
+        self.priorities = {k: self.get_setting(priorities, k, 0) for k in keys}
+        # sorted is stable, keys of a same priority keep their order
+        self.keys = sorted(keys, key=lambda k: -self.priorities[k])
+        self.deficits = dict.fromkeys(keys, 0)
+
+    @staticmethod
+    def get_setting(settings, key, default):
+        if not settings:
+            return default
+        if key in settings:
+            return settings[key]
+        for name, value in settings.items():
+            if key.endswith(name if name.startswith('_') else '_' + name):
+                return value
+        for name, value in settings.items():
+            if key.startswith(name):
+                return value
+        return default
+
+    def start_round(self):
+        """
+        Give their credits to the keys and return them in visiting order
+        """
+        for key in self.keys:
+            self.deficits[key] += self.weights[key]
+        return self.keys
+
+    def request(self, key):
+        """
+        Return the number of items to pop from key (0 once its credits are
+        spent for this round)
+        """
+        return min(int(self.deficits[key]), self.quotas[key])
+
+    def served(self, key, requested, popped):
+        self.deficits[key] -= popped
+        if popped < requested:
+            # the key is empty, it must not hoard credits while idle
+            self.deficits[key] = 0
+
+
+class FrameReceipt:
+    """
+    Receipt shared by the items of a frame (see WireFormat): the frame is
+    acked once all its items are processed
+    """
+
+    def __init__(self, receipt, count):
+        self.receipt = receipt
+        self.remaining = count
+        self._lock = threading.Lock()
+
+    def done(self):
+        """
+        Return the receipt of the frame once its last item is done, else None
+        """
+        with self._lock:
+            self.remaining -= 1
+            return self.receipt if self.remaining == 0 else None
+
+
 class RedisToMISP:
     SUFFIX_SIGH = '_sighting'
     SUFFIX_ATTR = '_attribute'
     SUFFIX_OBJ = '_object'
     SUFFIX_LIST = [SUFFIX_SIGH, SUFFIX_ATTR, SUFFIX_OBJ]
+    TRANSPORT_LIST = 'list'
+    TRANSPORT_STREAM = 'stream'
+    # With workers, items sharing the value of the first of these fields are
+    # handled in order by the same worker (e.g. a cowrie object and the
+    # sightings on its src_ip)
+    ORDERING_FIELDS = ['value', 'uuid', 'id', 'src_ip', 'session']
+    # Acks are written at least every ACK_INTERVAL seconds, so that the
+    # entries of a busy consumer are not claimed by its peers
+    ACK_INTERVAL = 1
+    # Producers ignore the wire formats advertised more than WIRE_TTL
+    # seconds ago, consumers renew theirs every WIRE_TTL / 3 seconds
+    WIRE_TTL = 300
 
     def __init__(self, host, port, db, keynames, PyMISPHelper, sleep=1,
                  event_id=None, daily_event_name=None, keynameError=None,
-                 allow_animation=True):
+                 allow_animation=True, blocking=False, pop_batch=1,
+                 workers=0, queue_size=100, reliable=False,
+                 consumer_name=None, ack_batch=50, heartbeat_ttl=60,
+                 transport=TRANSPORT_LIST, stream_group='RedisToMISP',
+                 claim_idle=60, claim_batch=100, error_batch=100, key_weights=None,
+                 key_priorities=None, key_quotas=None, round_weight=100):
         self.host = host
         self.port = port
         self.db = db
@@ -88,90 +245,825 @@ class RedisToMISP:
         self.event_id = event_id
         self.event_name = daily_event_name
         self.keynameError = keynameError
-        self.allow_animation = allow_animation
+        # Errors are written by batch of `error_batch` (see `save_error_to_redis`)
+        self.error_batch = max(1, error_batch)
+        self._error_buffer = []
+        self._error_lock = threading.Lock()
+        # The animation only makes sense on a terminal
+        self.allow_animation = allow_animation and sys.stdout.isatty()
+        self.reporter = None
+        # Block on all keys at once instead of polling them (see `consume_blocking`)
+        self.blocking = blocking
+        self.pop_batch = max(1, pop_batch)
+        # Push to MISP from a pool of threads (see `start_workers`)
+        self.workers = workers
+        self.queue_size = queue_size
+        self.worker_queues = []
+        self.worker_threads = []
+        # Keep popped items in a processing list until MISP accepted them
+        # (see `pop_raw` and `ack`)
+        self.reliable = reliable
+        self.consumer_name = consumer_name if consumer_name is not None else \
+            '{}:{}'.format(socket.gethostname(), os.getpid())
+        self.ack_batch = max(1, ack_batch)
+        self.heartbeat_ttl = heartbeat_ttl
+        self._pending_acks = []
+        self._unflushed_acks = []  # acks waiting for the attribute buffer
+        self._ack_lock = threading.Lock()
+        self._last_ack_flush = time.time()
+        self._block_index = 0
+        # Read redis streams through a consumer group instead of lists
+        # (see `consume_stream`)
+        self.transport = transport
+        self.stream_group = stream_group
+        self.claim_idle = claim_idle
+        self.claim_batch = max(1, claim_batch)
+        self._last_claim = 0
+        self._claim_cursors = {}  # stream -> XAUTOCLAIM cursor
+        # see `stop`
+        self.running = False
+        # Share the consumption between the keys (see `pop_scheduled`)
+        self.scheduler = KeyScheduler(self.keynames, weights=key_weights,
+                                      priorities=key_priorities,
+                                      quotas=key_quotas,
+                                      default_weight=round_weight,
+                                      default_quota=self.pop_batch)
 
+        # binary items (see WireFormat) are read without being mangled
         self.serv = redis.StrictRedis(self.host, self.port, self.db,
-                                      decode_responses=True)
+                                      decode_responses=True,
+                                      encoding_errors='surrogateescape')
         self.pymisphelper = PyMISPHelper
+        self._wire_keynames = keynames
+        self._last_advertisement = 0
+        self.advertise_wire_format()
+
+        if self.transport == self.TRANSPORT_STREAM:
+            self.create_stream_groups()
+        elif self.reliable:
+            self.register_consumer()
+
+        # see PyMISPHelper.enable_metrics
+        self.metrics = self.pymisphelper.metrics
+        if self.metrics is not None:
+            self.metrics.describe('items_popped_total', 'Items popped from redis per key suffix')
+            self.metrics.describe('items_processed_total', 'Items handed to the helper per key suffix')
+            self.metrics.describe('item_processing_seconds', 'Duration of perform_action per key suffix')
+            self.metrics.describe('errors_total', 'Items saved in the error list per key suffix')
+            self.metrics.describe('queue_depth', 'Number of items waiting in redis per key')
+            self.metrics.register_collector(self._collect_metrics)
 
         if event_id is None:
             self.pymisphelper.daily_mode(daily_event_name)
 
-        global evtObj, thr
-        self.evtObj = evtObj
-        self.thr = thr
-
     def consume(self):
+        self.running = True
+        if self.allow_animation and self.reporter is None:
+            self.reporter = ProgressReporter(self.get_buffer_state)
+            self.reporter.start()
+        if self.workers > 0 and not self.worker_threads:
+            self.start_workers()
+        if self.transport == self.TRANSPORT_STREAM:
+            return self.consume_stream()
+        if self.blocking:
+            return self.consume_blocking()
+
+        while self.running:
+            popped = [] if self.misp_unavailable() else self.pop_scheduled()
+            for key, data, raw in popped:
+                self.dispatch(key, data, raw)
+
+            self.flush_buffers(only_due=True)
+            self.advertise_wire_format(only_due=True)
+            if popped:
+                continue
+            self.flush_acks()
+            if self.allow_animation:
+                beautyful_sleep(self.sleep)
+            else:
+                time.sleep(self.sleep)
+
+    def consume_blocking(self):
+        """
+        Take a round of items from the keys (see `pop_scheduled`), and when
+        they are all empty, wait on all of them at once with BRPOP
+        """
+        while self.running:
+            if self.wait_for_misp():
+                continue
+            popped = self.pop_scheduled() or self.pop_blocking()
+            for key, data, raw in popped:
+                self.dispatch(key, data, raw)
+            self.flush_buffers(only_due=True)
+            self.advertise_wire_format(only_due=True)
+            if not popped:
+                self.flush_acks()
+
+    def consume_stream(self):
+        """
+        Read the streams as a member of the `stream_group` consumer group.
+        Every claim_idle / 2 seconds, whatever the load, entries left
+        pending by other consumers are claimed
+        """
+        while self.running:
+            if self.wait_for_misp():
+                continue
+            popped = self.pop_stream()
+            if time.time() - self._last_claim > self.claim_idle / 2.0:
+                self._last_claim = time.time()
+                popped += self.claim_stale_entries()
+            for key, data, entry_id in popped:
+                self.dispatch(key, data, entry_id)
+            self.flush_buffers(only_due=True)
+            self.advertise_wire_format(only_due=True)
+            if not popped:
+                self.flush_acks()
+
+    def stop(self):
+        """
+        Make `consume` return after its current iteration
+        """
+        self.running = False
+
+    def misp_unavailable(self):
+        """
+        True while the circuit breaker of the helper (if enabled) is open
+        """
+        breaker = self.pymisphelper.circuit_breaker
+        return breaker is not None and breaker.wait_time() > 0
+
+    def wait_for_misp(self):
+        """
+        Sleep (at most `sleep` seconds) if MISP is unhealthy, leaving the
+        items in redis. Returns True if it slept
+        """
+        breaker = self.pymisphelper.circuit_breaker
+        wait = breaker.wait_time() if breaker is not None else 0
+        if wait <= 0:
+            return False
+        self.flush_acks()
+        time.sleep(min(wait, self.sleep))
+        return True
+
+    def dispatch(self, key, data, receipt=None):
+        """
+        Process the item right away, or hand it to a worker if the pool is
+        running. Blocks while the queue of the selected worker is full.
+        `receipt` is what `ack` needs: the raw item for lists, the entry ID
+        for streams
+        """
+        if self.metrics is not None:
+            self.metrics.inc('items_popped_total', suffix=self.get_suffix(key))
+        if not self.worker_threads:
+            return self.process(key, data, receipt)
+        index = self.get_ordering_hash(key, data) % len(self.worker_queues)
+        self.worker_queues[index].put((key, data, receipt))
+
+    def get_ordering_hash(self, key, data):
+        if isinstance(data, dict):
+            for field in self.ORDERING_FIELDS:
+                if data.get(field) is not None:
+                    return zlib.crc32(str(data[field]).encode('utf8'))
+        return zlib.crc32(str(data).encode('utf8'))
+
+    def start_workers(self):
+        """
+        Start `workers` threads pushing to MISP, each fed by a queue of
+        `queue_size` items
+        """
+        for i in range(self.workers):
+            q = queue.Queue(maxsize=self.queue_size)
+            thr = threading.Thread(name="misp-worker-{}".format(i),
+                                   target=self.work, args=(q, ))
+            thr.daemon = True
+            self.worker_queues.append(q)
+            self.worker_threads.append(thr)
+            thr.start()
+
+    def stop_workers(self):
+        """
+        Wait for the queued items to be pushed and stop the workers
+        """
+        for q in self.worker_queues:
+            q.put(None)
+        for thr in self.worker_threads:
+            thr.join()
+        self.worker_queues = []
+        self.worker_threads = []
+
+    def work(self, q):
         while True:
-            for key in self.keynames:
-                while True:
-                    data = self.pop(key)
-                    if data is None:
-                        break
-                    try:
-                        self.perform_action(key, data)
-                    except Exception as error:
-                        self.save_error_to_redis(error, data)
-
-                    if self.allow_animation:
-                        self.evtObj.set()
-                        self.thr.join()
-
-            beautyful_sleep(5)
-
-    def pop(self, key):
-        popped = self.serv.rpop(key)
+            item = q.get()
+            if item is None:
+                return
+            self.process(*item)
+
+    def process(self, key, data, receipt=None):
+        # wait for MISP to be healthy, within the adaptive concurrency limit
+        breaker = self.pymisphelper.circuit_breaker
+        if breaker is not None:
+            breaker.acquire()
+        start = time.time()
+        try:
+            self.perform_action(key, data)
+        except Exception as error:
+            self.save_error_to_redis(error, data, key=key)
+        finally:
+            if breaker is not None:
+                breaker.release()
+            if self.metrics is not None:
+                suffix = self.get_suffix(key)
+                self.metrics.observe('item_processing_seconds', time.time() - start, suffix=suffix)
+                self.metrics.inc('items_processed_total', suffix=suffix)
+        # Failing items are kept in the error list, they can be acked as well
+        self.ack(key, receipt)
+
+    def stop_reporter(self):
+        if self.reporter is not None:
+            self.reporter.stop()
+            self.reporter = None
+
+    def flush_buffers(self, only_due=False):
+        """
+        Push the attributes, sightings and cowrie sessions buffered by the
+        helper, if buffering or aggregation is enabled
+        """
+        helper = self.pymisphelper
+        if only_due and self.misp_unavailable():
+            # keep buffering until MISP is back
+            return
+        if only_due:
+            errors = [(self.SUFFIX_ATTR, helper.flush_due_attributes()),
+                      (self.SUFFIX_OBJ, helper.flush_sessions(only_expired=True))]
+            if helper.sighting_window is not None:
+                errors.append((self.SUFFIX_SIGH, helper.flush_due_sightings()))
+        else:
+            errors = [(self.SUFFIX_ATTR, helper.flush_attributes()),
+                      (self.SUFFIX_SIGH, helper.flush_sightings()),
+                      (self.SUFFIX_OBJ, helper.flush_sessions())]
+        for suffix, suffix_errors in errors:
+            self.save_batch_errors(suffix_errors, suffix=suffix)
+        self.flush_errors()
+
+        # release the acks of the items now pushed to MISP
+        watermark = helper.buffer_watermark()
+        with self._ack_lock:
+            self._pending_acks += [(key, receipt) for key, receipt, seq in self._unflushed_acks if seq < watermark]
+            self._unflushed_acks = [x for x in self._unflushed_acks if x[2] >= watermark]
+            due = len(self._pending_acks) >= self.ack_batch or \
+                (self._pending_acks and time.time() - self._last_ack_flush >= self.ACK_INTERVAL)
+        # the consumer may never be idle, do not wait for it to ack
+        if due:
+            self.flush_acks()
+
+    def pop_raw(self, key):
+        """
+        Pop an item without decoding it. In reliable mode, the item is
+        atomically moved to the processing list of this consumer
+        """
+        if self.reliable:
+            return self.serv.lmove(key, self.get_processing_key(key),
+                                   'RIGHT', 'LEFT')
+        return self.serv.rpop(key)
+
+    def pop_many(self, key, count):
+        """
+        Return up to count raw items of key, taken in a single round trip
+        """
+        if count == 1:
+            raw = self.pop_raw(key)
+            return [] if raw is None else [raw]
+        pipe = self.serv.pipeline(transaction=False)
+        for i in range(count):
+            if self.reliable:
+                pipe.lmove(key, self.get_processing_key(key), 'RIGHT', 'LEFT')
+            else:
+                pipe.rpop(key)
+        return [x for x in pipe.execute() if x is not None]
+
+    def pop_scheduled(self):
+        """
+        Return a list of (key, data, raw) popped during a round of the
+        deficit round-robin over the keys (see `KeyScheduler`). The list is
+        empty if all the keys are empty
+        """
+        items = []
+        for key in self.scheduler.start_round():
+            count = self.scheduler.request(key)
+            while count > 0:
+                raws = self.pop_many(key, count)
+                self.scheduler.served(key, count, len(raws))
+                if raws and self.metrics is not None:
+                    self.metrics.observe('batch_size', len(raws), kind='redis_pop')
+                for raw in raws:
+                    items += self.decode_items(key, raw, raw)
+                count = self.scheduler.request(key)
+        return items
+
+    def pop_blocking(self):
+        """
+        Return a list of (key, data, raw) popped from the first non-empty key.
+        The list is empty if nothing arrived within `sleep` seconds
+        """
+        if self.reliable:
+            return self.pop_blocking_reliable()
+
+        popped = self.serv.brpop(self.scheduler.keys, timeout=self.sleep)
         if popped is None:
-            return None
+            return []
+        key, raw = popped
+        items = [raw]
+        if self.pop_batch > 1:
+            pipe = self.serv.pipeline(transaction=False)
+            for i in range(self.pop_batch - 1):
+                pipe.rpop(key)
+            items += [x for x in pipe.execute() if x is not None]
+        if self.metrics is not None:
+            self.metrics.observe('batch_size', len(items), kind='redis_pop')
+        return [item for raw in items for item in self.decode_items(key, raw, raw)]
+
+    def pop_blocking_reliable(self):
+        """
+        Move up to `pop_batch` items of the first non-empty key to the
+        processing list in a single round trip. As BLMOVE only waits on one
+        key, the keys are waited on in turn when they are all empty
+        """
+        for key in self.keynames:
+            pipe = self.serv.pipeline(transaction=False)
+            for i in range(self.pop_batch):
+                pipe.lmove(key, self.get_processing_key(key), 'RIGHT', 'LEFT')
+            items = [x for x in pipe.execute() if x is not None]
+            if items:
+                return [item for raw in items for item in self.decode_items(key, raw, raw)]
+
+        key = self.scheduler.keys[self._block_index % len(self.keynames)]
+        self._block_index += 1
+        timeout = max(0.1, float(self.sleep) / len(self.keynames))
+        raw = self.serv.blmove(key, self.get_processing_key(key), timeout,
+                               'RIGHT', 'LEFT')
+        if raw is None:
+            return []
+        return self.decode_items(key, raw, raw)
+
+    # RELIABLE QUEUE
+    def get_processing_key(self, key, consumer_name=None):
+        if consumer_name is None:
+            consumer_name = self.consumer_name
+        return '{}:processing:{}'.format(key, consumer_name)
+
+    def get_heartbeat_key(self, consumer_name=None):
+        if consumer_name is None:
+            consumer_name = self.consumer_name
+        return 'RedisToMISP:heartbeat:{}'.format(consumer_name)
+
+    def register_consumer(self):
+        """
+        Give back the items of dead consumers, then announce this consumer
+        and keep its heartbeat alive
+        """
+        self.reclaim_stale_items()
+        # a consumer seen without heartbeat is considered dead by its peers
+        self.serv.set(self.get_heartbeat_key(), time.time(), ex=self.heartbeat_ttl)
+        for key in self.keynames:
+            self.serv.sadd(key + ':consumers', self.consumer_name)
+        thr = threading.Thread(name="reliable-heartbeat", target=self.heartbeat)
+        thr.daemon = True
+        thr.start()
+
+    def heartbeat(self):
+        """
+        Renew the heartbeat every heartbeat_ttl / 3 seconds. If it cannot be
+        renewed before it expires, the consumer is stopped: its peers are
+        about to reclaim its in-flight items
+        """
+        interval = self.heartbeat_ttl / 3.0
+        last_beat = time.time()
+        wait = interval
+        while True:
+            time.sleep(wait)
+            try:
+                pipe = self.serv.pipeline(transaction=False)
+                pipe.set(self.get_heartbeat_key(), time.time(), ex=self.heartbeat_ttl)
+                # in case a peer removed this consumer while its heartbeat expired
+                for key in self.keynames:
+                    pipe.sadd(key + ':consumers', self.consumer_name)
+                pipe.execute()
+                last_beat = time.time()
+                wait = interval
+            except Exception as e:
+                print('Could not renew the heartbeat:', e)
+                wait = min(1, interval)
+                if time.time() + wait - last_beat >= self.heartbeat_ttl:
+                    print('Heartbeat expired, stopping the consumer')
+                    self.stop()
+                    return
+
+    def reclaim_stale_items(self):
+        """
+        Push back the in-flight items of consumers whose heartbeat expired
+        (and the ones left by a previous run of this consumer) at the head
+        of their list, so that they are popped first
+        """
+        reclaimed = 0
+        for key in self.keynames:
+            for consumer in self.serv.smembers(key + ':consumers'):
+                if consumer != self.consumer_name and \
+                        self.serv.exists(self.get_heartbeat_key(consumer)):
+                    continue
+                processing_key = self.get_processing_key(key, consumer)
+                while self.serv.lmove(processing_key, key, 'RIGHT', 'RIGHT') is not None:
+                    reclaimed += 1
+                if consumer != self.consumer_name:
+                    self.serv.srem(key + ':consumers', consumer)
+        if reclaimed > 0:
+            print('Reclaimed {} in-flight items'.format(reclaimed))
+        return reclaimed
+
+    def ack(self, key, receipt):
+        """
+        Remove the item from the processing list (or the pending entries of
+        the stream group), by batch of `ack_batch`.
+        Buffered items (attributes, sightings, cowrie sessions) are only
+        acked once pushed to MISP
+        """
+        if not (self.reliable or self.transport == self.TRANSPORT_STREAM) \
+                or receipt is None:
+            return
+        if isinstance(receipt, FrameReceipt):
+            receipt = receipt.done()
+            if receipt is None:
+                return
+        helper = self.pymisphelper
+        with self._ack_lock:
+            if helper.is_buffering():
+                # the item may still be in the buffer of the helper
+                self._unflushed_acks.append((key, receipt, helper.buffer_sequence()))
+                return
+            self._pending_acks.append((key, receipt))
+            if len(self._pending_acks) < self.ack_batch:
+                return
+        self.flush_acks()
+
+    def flush_acks(self):
+        # failing items must be in the error list before being acked
+        self.flush_errors()
+        with self._ack_lock:
+            acks, self._pending_acks = self._pending_acks, []
+            self._last_ack_flush = time.time()
+        if not acks:
+            return
+        pipe = self.serv.pipeline(transaction=False)
+        if self.transport == self.TRANSPORT_STREAM:
+            ids_per_key = {}
+            for key, entry_id in acks:
+                ids_per_key.setdefault(key, []).append(entry_id)
+            for key, entry_ids in ids_per_key.items():
+                pipe.xack(key, self.stream_group, *entry_ids)
+        else:
+            for key, raw in acks:
+                # in-flight items are the oldest ones, at the tail of the list
+                pipe.lrem(self.get_processing_key(key), -1, raw)
+        pipe.execute()
+
+    # STREAM
+    def create_stream_groups(self):
+        """
+        Create the consumer group on every stream, reading from its start
+        """
+        for key in self.keynames:
+            try:
+                self.serv.xgroup_create(key, self.stream_group, id='0', mkstream=True)
+            except redis.ResponseError as error:
+                if 'BUSYGROUP' not in str(error):  # the group already exists
+                    raise
+
+    def pop_stream(self):
+        """
+        Return a list of (key, data, entry_id) read for this consumer, up to
+        `pop_batch` entries per stream, waiting up to `sleep` seconds
+        """
+        streams = {key: '>' for key in self.keynames}
+        popped = self.serv.xreadgroup(self.stream_group, self.consumer_name,
+                                      streams, count=self.pop_batch,
+                                      block=int(self.sleep * 1000))
+        items = []
+        for key, entries in popped or []:
+            for entry_id, fields in entries:
+                items += self.decode_items(key, fields['data'], entry_id)
+        if self.metrics is not None and items:
+            self.metrics.observe('batch_size', len(items), kind='redis_pop')
+        return items
+
+    def claim_stale_entries(self):
+        """
+        Take over the entries delivered to a consumer for more than
+        `claim_idle` seconds without being acknowledged, up to `claim_batch`
+        entries per stream. The scan resumes where the previous one stopped,
+        and the next claim is not delayed while entries are left
+        """
+        items = []
+        for key in self.keynames:
+            claimed_count = 0
+            cursor = self._claim_cursors.get(key, '0-0')
+            while claimed_count < self.claim_batch:
+                claimed = self.serv.xautoclaim(key, self.stream_group,
+                                               self.consumer_name,
+                                               int(self.claim_idle * 1000),
+                                               start_id=cursor,
+                                               count=self.claim_batch - claimed_count)
+                cursor = claimed[0]
+                for entry in claimed[1]:
+                    if entry is None or entry[1] is None:  # trimmed entry
+                        continue
+                    entry_id, fields = entry
+                    claimed_count += 1
+                    items += self.decode_items(key, fields['data'], entry_id)
+                if cursor == '0-0':  # end of the pending entries
+                    break
+            self._claim_cursors[key] = cursor
+            if cursor != '0-0':
+                self._last_claim = 0
+        if items:
+            print('Claimed {} stale entries'.format(len(items)))
+        return items
+
+    def get_stream_lag(self):
+        """
+        Return, for each stream, the number of entries not yet delivered to
+        the group (`lag`) and delivered but not acknowledged (`pending`)
+        """
+        return get_stream_lag(self.serv, self.keynames, self.stream_group)
+
+    def decode_items(self, key, raw, receipt=None):
+        """
+        Return the list of (key, data, receipt) of a redis entry: a JSON
+        item, or one or more items in the compact format (see WireFormat).
+        The items of a frame share a FrameReceipt
+        """
         try:
-            popped = json.loads(popped)
-        except ValueError as error:
-            self.save_error_to_redis(error, popped)
-        except ValueError as error:
-            self.save_error_to_redis(error, popped)
-        return popped
+            items = WireFormat.WireFormat.decode_many(raw)
+        except Exception as error:
+            self.save_error_to_redis(error, raw, key=key)
+            self.ack(key, receipt)
+            return []
+        if len(items) > 1 and receipt is not None:
+            receipt = FrameReceipt(receipt, len(items))
+        return [(key, data, receipt) for data in items]
+
+    def advertise_wire_format(self, only_due=False):
+        """
+        Tell the producers which formats this consumer can read, in the hash
+        keyname:wire (see MISPItemToRedis, wire_format='auto'). The hash maps
+        the capabilities of the consumers to the last time they were seen,
+        renewed every WIRE_TTL / 3 seconds
+        """
+        if only_due and time.time() - self._last_advertisement < self.WIRE_TTL / 3.0:
+            return
+        self._last_advertisement = time.time()
+        pipe = self.serv.pipeline(transaction=False)
+        for k in self._wire_keynames:
+            pipe.hset(k + ':wire', WireFormat.capabilities(), int(self._last_advertisement))
+        pipe.execute()
 
     def perform_action(self, key, data):
         # sighting
         if key.endswith(self.SUFFIX_SIGH):
-            self.print_processing(self.SUFFIX_SIGH)
             r = self.pymisphelper.add_sighting_per_json(data)
 
         # attribute
         elif key.endswith(self.SUFFIX_ATTR):
-            self.print_processing(self.SUFFIX_ATTR)
             r = self.pymisphelper.add_attribute_per_json(data, event_id=self.event_id)
 
         # object
         elif key.endswith(self.SUFFIX_OBJ):
-            self.print_processing(self.SUFFIX_OBJ)
             r = self.pymisphelper.add_object_per_json(data, event_id=self.event_id)
 
         else:
             raise NoValidKey("Can't define action to perform")
 
-        if r is not None and 'errors' in r:
-            self.save_error_to_redis(r, data)
+        if r is None or not self.pymisphelper._has_errors(r):
+            return
+        batches = self.get_failed_batches(r)
+        if batches is None:
+            self.save_error_to_redis(r, data, key=key)
+            return
+        # data is one of the items of the batches, or is still buffered
+        self.save_batch_errors(batches, suffix=self.get_suffix(key))
+
+    @staticmethod
+    def get_failed_batches(r):
+        """
+        Return the list of failed batches ({'errors', 'items'}) returned by
+        the helper when pushing its buffers, or None if r is the error of a
+        single item
+        """
+        if not isinstance(r, dict):
+            return None
+        if 'items' in r:
+            return [r]
+        errors = r.get('errors')
+        if isinstance(errors, list) and errors and \
+                all(isinstance(e, dict) and 'items' in e for e in errors):
+            return errors
+        return None
+
+    def save_batch_errors(self, batches, suffix=None):
+        """
+        Save one error per item of the failed batches
+        """
+        for r in batches:
+            error = r.get('errors', r.get('error'))
+            for item in r.get('items') or [None]:
+                self.save_error_to_redis(error, item, suffix=suffix)
 
     def get_buffer_state(self):
         buffer_state = {'attribute': 0, 'object': 0, 'sighting': 0}
+        pipe = self.serv.pipeline(transaction=False)
         for k in self.keynames:
+            if self.transport == self.TRANSPORT_STREAM:
+                pipe.xlen(k)
+            else:
+                pipe.llen(k)
+        for k, length in zip(self.keynames, pipe.execute()):
             _, suffix = k.rsplit('_', 1)
-            buffer_state[suffix] += self.serv.llen(k)
+            buffer_state[suffix] += length
         return buffer_state
 
-    def print_processing(self, key):
-        if self.allow_animation:
-            self.evtObj = threading.Event()
-            self.thr = threading.Thread(name="processing-animation",
-                    target=processing_animation,
-                    args=(self.evtObj, self.get_buffer_state(), ))
-            self.thr.start()
+    def get_suffix(self, key):
+        for suffix in self.SUFFIX_LIST:
+            if key.endswith(suffix):
+                return suffix
+        return None
+
+    def build_error(self, error, item, key=None, suffix=None):
+        """
+        Return the JSON entry of the error list describing a failed item.
+        The payload is the item as it was pushed, so that it can be replayed
+        in the key it comes from (see `ErrorReplayer`)
+        """
+        if suffix is None and key is not None:
+            suffix = self.get_suffix(key)
+        return json.dumps({
+            'error': str(error),
+            'key': key,
+            'suffix': suffix,
+            'payload': item if isinstance(item, str) else json.dumps(item),
+            'time': time.time(),
+            'consumer': getattr(self, 'consumer_name', None)
+        })
+
+    def _collect_metrics(self, metrics):
+        pipe = self.serv.pipeline(transaction=False)
+        for k in self.keynames:
+            if self.transport == self.TRANSPORT_STREAM:
+                pipe.xlen(k)
+            else:
+                pipe.llen(k)
+        for k, length in zip(self.keynames, pipe.execute()):
+            metrics.set_gauge('queue_depth', length, key=k)
+        with self._ack_lock:
+            metrics.set_gauge('pending_acks', len(self._pending_acks) + len(self._unflushed_acks))
+        metrics.set_gauge('worker_queue_depth', sum(q.qsize() for q in self.worker_queues))
+
+    def save_error_to_redis(self, error, item, key=None, suffix=None):
+        """
+        Buffer the error, the buffer is written to `keynameError` once
+        `error_batch` errors are waiting or on `flush_errors`
+        Parameters:
+        -----------
+        error : Exception | dict
+            The error raised or returned by MISP
+        item : dict | str
+            The item that failed
+        key : str
+            The redis key the item was popped from
+        suffix : str
+            The kind of item, when the key is unknown (buffered items)
+        """
+        if self.metrics is not None:
+            self.metrics.inc('errors_total', suffix=suffix or self.get_suffix(key or ''))
+        with self._error_lock:
+            self._error_buffer.append((error, self.build_error(error, item, key, suffix)))
+            full = len(self._error_buffer) >= self.error_batch
+        if full:
+            self.flush_errors()
+
+    def flush_errors(self):
+        """
+        Write the buffered errors with a single LPUSH
+        """
+        with self._error_lock:
+            errors, self._error_buffer = self._error_buffer, []
+        if not errors:
+            return 0
+        self.serv.lpush(self.keynameError, *[entry for error, entry in errors])
+        print('Error: {} item(s) saved in {}, last error: {}'.format(
+            len(errors), self.keynameError, errors[-1][0]))
+        return len(errors)
+
+
+class ErrorReplayer:
+    SUFFIX_LIST = RedisToMISP.SUFFIX_LIST
+
+    TRANSPORT_LIST = 'list'
+    TRANSPORT_STREAM = 'stream'
+
+    def __init__(self, keynameError, host='localhost', port=6379, db=0,
+                 transport=TRANSPORT_LIST, maxlen=None):
+        """
+        Push the items of the error list saved by RedisToMISP back into the
+        queues they come from
+        Parameters:
+        -----------
+        keynameError : str
+            The error list
+        transport : str
+            'list' (LPUSH) or 'stream' (XADD), as consumed by RedisToMISP
+        maxlen : int
+            With streams, approximate number of entries kept in each stream
+        """
+        self.keynameError = keynameError
+        self.transport = transport
+        self.maxlen = maxlen
+        self.serv = redis.StrictRedis(host, port, db, decode_responses=True,
+                                      encoding_errors='surrogateescape')
+
+    def get_unreplayable_key(self):
+        return self.keynameError + ':unreplayable'
+
+    def replay(self, keyname=None, rate=None, batch_size=500, limit=None):
+        """
+        Move the errors back to their queue, oldest first, by batch of
+        batch_size. Each batch is moved atomically (MULTI/EXEC), entries
+        that cannot be replayed (not JSON, unknown destination) are moved
+        to `get_unreplayable_key()`
+        Returns the number of items replayed per key
+        Parameters:
+        -----------
+        keyname : str
+            Keyname prefix used for the errors not bound to a key (items
+            buffered by the helper)
+        rate : float
+            Maximum number of items replayed per second
+        batch_size : int
+            Number of errors moved in a single transaction
+        limit : int
+            Maximum number of errors to replay
+        """
+        if rate is not None:
+            batch_size = max(1, min(batch_size, int(rate)))
+        replayed = {}
+        done = 0
+        start = time.time()
+        while limit is None or done < limit:
+            count = batch_size if limit is None else min(batch_size, limit - done)
+            # the oldest errors are at the tail
+            entries = self.serv.lrange(self.keynameError, -count, -1)
+            if not entries:
+                break
+            per_key = {}
+            unreplayable = []
+            for entry in reversed(entries):
+                key, payload = self._parse(entry, keyname)
+                if key is None:
+                    unreplayable.append(entry)
+                else:
+                    per_key.setdefault(key, []).append(payload)
 
-    def save_error_to_redis(self, error, item):
-        to_push = {'error': str(error), 'item': str(item)}
-        print('Error:', str(error), '\nOn adding:', item)
-        self.serv.lpush(self.keynameError, to_push)
+            pipe = self.serv.pipeline(transaction=True)
+            for key, payloads in per_key.items():
+                if self.transport == self.TRANSPORT_STREAM:
+                    for payload in payloads:
+                        pipe.xadd(key, {'data': payload}, maxlen=self.maxlen,
+                                  approximate=True)
+                else:
+                    pipe.lpush(key, *payloads)
+            if unreplayable:
+                pipe.lpush(self.get_unreplayable_key(), *unreplayable)
+            # errors are only added at the head, the tail is ours
+            pipe.ltrim(self.keynameError, 0, -len(entries) - 1)
+            pipe.execute()
+
+            for key, payloads in per_key.items():
+                replayed[key] = replayed.get(key, 0) + len(payloads)
+            done += len(entries)
+            if rate is not None:
+                delay = done / float(rate) - (time.time() - start)
+                if delay > 0:
+                    time.sleep(delay)
+        return replayed
+
+    def _parse(self, entry, keyname):
+        try:
+            error = json.loads(entry)
+            payload = error['payload']
+        except (ValueError, TypeError, KeyError):
+            # entry written by an older version
+            return None, None
+        key = error.get('key')
+        if key is None and keyname is not None and error.get('suffix') in self.SUFFIX_LIST:
+            key = keyname + error['suffix']
+        return key, payload
 
 
 class MISPItemToRedis:
@@ -180,19 +1072,216 @@ class MISPItemToRedis:
     SUFFIX_OBJ = '_object'
     SUFFIX_LIST = [SUFFIX_SIGH, SUFFIX_ATTR, SUFFIX_OBJ]
 
-    def __init__(self, keyname, host='localhost', port=6379, db=0):
+    TRANSPORT_LIST = 'list'
+    TRANSPORT_STREAM = 'stream'
+
+    def __init__(self, keyname, host='localhost', port=6379, db=0,
+                 transport=TRANSPORT_LIST, maxlen=None, batch_size=None,
+                 max_linger=1, wire_format=None):
+        """
+        Push MISP items to redis, to be consumed by RedisToMISP
+        Parameters:
+        -----------
+        keyname : str
+            The keyname prefix, items are pushed in keyname_attribute,
+            keyname_object and keyname_sighting
+        transport : str
+            'list' (LPUSH) or 'stream' (XADD, the item is in the field 'data')
+        maxlen : int
+            With streams, approximate number of entries kept in each stream
+        batch_size : int
+            If set, items are buffered and sent through a redis pipeline
+            once this many items are waiting (see `batch`)
+        max_linger : float
+            Maximum number of seconds an item can stay in the buffer,
+            enforced by a background thread even if nothing else is pushed
+        wire_format : WireFormat.WireFormat | str
+            Encoding of the items, JSON by default. 'auto' picks the most
+            compact format read by all the consumers of keyname (msgpack,
+            compressed if possible, see WireFormat.WireFormat.negotiate)
+            that advertised it in the last RedisToMISP.WIRE_TTL seconds,
+            JSON if none did
+        """
         self.host = host
         self.port = port
         self.db = db
         self.keyname = keyname
+        self.transport = transport
+        self.maxlen = maxlen
+        self.batch_size = batch_size
+        self.max_linger = max_linger
+        self._buffer = {}  # key -> [items, encoded on flush]
+        self._buffer_len = 0
+        self._buffer_since = None
+        self._buffer_lock = threading.Lock()
+        self._flusher = None  # see `_start_flusher`
+        self._flush_error = None
         self.serv = redis.StrictRedis(self.host, self.port, self.db)
+        if wire_format is None:
+            wire_format = WireFormat.WireFormat('json')
+        elif wire_format == 'auto':
+            # consumers stopped for a while may not be able to read the new
+            # formats of the others when they come back
+            oldest = time.time() - RedisToMISP.WIRE_TTL
+            advertised = [k.decode('utf8') for k, last_seen in self.serv.hgetall(keyname + ':wire').items()
+                          if int(last_seen) >= oldest]
+            wire_format = WireFormat.WireFormat.negotiate(advertised, frame_size=50)
+        self.wire_format = wire_format
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.flush()
+
+    @contextlib.contextmanager
+    def batch(self, batch_size=500, max_linger=1):
+        """
+        Buffer the pushed items inside the `with` block, they are flushed
+        when `batch_size` items are waiting, after `max_linger` seconds and
+        when leaving the block
+
+        Examples:
+        ---------
+        >>> with helper.batch(batch_size=1000):
+        ...     for line in lines:
+        ...         helper.push_object(json.loads(line))
+        """
+        previous = (self.batch_size, self.max_linger)
+        self.batch_size, self.max_linger = batch_size, max_linger
+        try:
+            yield self
+        finally:
+            self.flush()
+            self.batch_size, self.max_linger = previous
+
+    def flush(self):
+        """
+        Send the buffered items through a single pipeline, with one
+        multi-value LPUSH per key. With a `frame_size` in the wire format,
+        items are packed by frames. Returns the number of items sent per key.
+        If redis fails, the items stay in the buffer and the error is raised
+        (items of a partially executed pipeline may then be sent twice)
+        """
+        with self._buffer_lock:
+            to_send, self._buffer = self._buffer, {}
+            count, self._buffer_len = self._buffer_len, 0
+            since, self._buffer_since = self._buffer_since, None
+        if not to_send:
+            return {}
+        try:
+            pipe = self.serv.pipeline(transaction=False)
+            for key, values in to_send.items():
+                payloads = self.wire_format.encode_many(values)
+                if self.transport == self.TRANSPORT_STREAM:
+                    for payload in payloads:
+                        pipe.xadd(key, {'data': payload}, maxlen=self.maxlen,
+                                  approximate=True)
+                else:
+                    pipe.lpush(key, *payloads)
+            pipe.execute()
+        except Exception:
+            # keep the items for the next flush, before the ones pushed since
+            with self._buffer_lock:
+                for key, values in self._buffer.items():
+                    to_send.setdefault(key, []).extend(values)
+                self._buffer = to_send
+                self._buffer_len += count
+                if since is not None:
+                    self._buffer_since = since
+            raise
+        self._flush_error = None
+        return {key: len(values) for key, values in to_send.items()}
+
+    def push_many(self, items, action):
+        """
+        Push several items of the same kind in a single round trip
+        Returns the number of items sent per key
+        Parameters:
+        -----------
+        items : list of dict | list of JSON (str)
+            The attributes, objects or sightings to push
+        action : str
+            attribute, object or sighting
+        """
+        all_action = [s.lstrip('_') for s in self.SUFFIX_LIST]
+        if action not in all_action:
+            raise ValueError('Invalid action. (Allowed: {})'.format(all_action))
+        key = self.keyname + '_' + action
+        with self.batch(batch_size=len(items) + self._buffer_len + 1,
+                        max_linger=None):
+            for item in items:
+                self._push(key, item)
+            return self.flush()
+
+    def _push(self, key, item):
+        """
+        item is a dict or a JSON string
+        """
+        if self.batch_size is None:
+            payload = self.wire_format.encode(item)
+            if self.transport == self.TRANSPORT_STREAM:
+                self.serv.xadd(key, {'data': payload}, maxlen=self.maxlen,
+                               approximate=True)
+            else:
+                self.serv.lpush(key, payload)
+            return
+
+        # a flush of the background thread failed, the items are still
+        # buffered
+        error, self._flush_error = self._flush_error, None
+        if error is not None:
+            raise error
+
+        with self._buffer_lock:
+            self._buffer.setdefault(key, []).append(item)
+            self._buffer_len += 1
+            if self._buffer_since is None:
+                self._buffer_since = time.time()
+            full = self._buffer_len >= self.batch_size
+            due = self.max_linger is not None and \
+                time.time() - self._buffer_since >= self.max_linger
+        if full or due:
+            return self.flush()
+        if self.max_linger is not None and self._flusher is None:
+            self._start_flusher()
+
+    def _start_flusher(self):
+        """
+        Flush the buffer once it is `max_linger` seconds old, from a daemon
+        thread, so that a producer going quiet does not keep its items
+        """
+        def flush_due():
+            while True:
+                max_linger = self.max_linger
+                since = self._buffer_since
+                if max_linger is None or since is None:
+                    time.sleep(0.1 if max_linger is None else max(0.01, max_linger / 2.0))
+                    continue
+                wait = since + max_linger - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                    continue
+                try:
+                    self.flush()
+                except Exception as e:
+                    # raised by the next push
+                    self._flush_error = e
+                    time.sleep(max(0.01, max_linger))
+
+        with self._buffer_lock:
+            if self._flusher is not None:
+                return
+            self._flusher = threading.Thread(name="producer-flush", target=flush_due)
+            self._flusher.daemon = True
+        self._flusher.start()
 
     def push_json(self, jdata, keyname, action):
         all_action = [s.lstrip('_') for s in self.SUFFIX_LIST]
         if action not in all_action:
             raise('Error: Invalid action. (Allowed: {})'.format(all_action))
         key = keyname + '_' + action
-        self.serv.lpush(key, jdata)
+        return self._push(key, jdata)
 
     def push_attribute(self, type_value, value, category=None, to_ids=False,
                 comment=None, distribution=None, proposal=False, **kwargs):
@@ -212,24 +1301,25 @@ class MISPItemToRedis:
         for k, v in kwargs.items():
             to_push[k] = v
         key = self.keyname + self.SUFFIX_ATTR
-        self.serv.lpush(key, json.dumps(to_push))
+        return self._push(key, to_push)
 
     def push_attribute_obj(self, MISP_Attribute, keyname):
         key = keyname + self.SUFFIX_ATTR
         jdata = MISP_Attribute.to_json()
-        self.serv.lpush(key, jdata)
+        return self._push(key, jdata)
 
     def push_object(self, dict_values):
         # check that 'name' field is present
         if 'name' not in dict_values:
             print("Error: JSON must contain the field 'name'")
         key = self.keyname + self.SUFFIX_OBJ
-        self.serv.lpush(key, json.dumps(dict_values))
+        # copied, the item may only be encoded on flush
+        return self._push(key, dict(dict_values))
 
     def push_object_obj(self, MISP_Object, keyname):
         key = keyname + self.SUFFIX_OBJ
         jdata = MISP_Object.to_json()
-        self.serv.lpush(key, jdata)
+        return self._push(key, jdata)
 
     def push_sighting(self, value=None, uuid=None, id=None, source=None,
                       type=0, timestamp=None, **kargs):
@@ -251,12 +1341,338 @@ class MISPItemToRedis:
             if v is not None:
                 to_push[k] = v
         key = self.keyname + self.SUFFIX_SIGH
-        self.serv.lpush(key, json.dumps(to_push))
+        return self._push(key, to_push)
 
     def push_sighting_obj(self, MISP_Sighting, keyname):
         key = keyname + self.SUFFIX_SIGH
         jdata = MISP_Sighting.to_json()
-        self.serv.lpush(key, jdata)
+        return self._push(key, jdata)
+
+
+def get_stream_lag(serv, keys, stream_group):
+    """
+    Return, for each stream of keys, its length, the number of entries not
+    yet delivered to stream_group (`lag`) and delivered but not acknowledged
+    (`pending`)
+    """
+    lag = {}
+    for key in keys:
+        info = {'lag': None, 'pending': None, 'length': serv.xlen(key)}
+        if serv.exists(key):
+            for group in serv.xinfo_groups(key):
+                if group['name'] == stream_group:
+                    info['pending'] = group['pending']
+                    # `lag` is only reported by redis >= 7
+                    info['lag'] = group.get('lag')
+        lag[key] = info
+    return lag
+
+
+def build_consumer(args, keynames=None, enable_metrics=False, serve_metrics=True):
+    """
+    Build the PyMISPHelper and the RedisToMISP consumer described by the
+    arguments of RedisToMISP.py, consuming keynames (default: --keynamePop)
+    """
+    if keynames is None:
+        keynames = args.keynamePop
+    try:
+        pymisp = PyMISP(args.url, args.mispkey, args.verifycert)
+    except PyMISPError as e:
+        print(e)
+    helper = PyMISPHelper(pymisp, daily_event_name=args.eventname,
+                          template_cache_file=args.templateCache,
+                          timezone=args.timezone)
+    helper.configure_http(
+        pool_maxsize=args.httpPool or max(10, args.workers),
+        timeout=(10, args.httpTimeout), retries=args.httpRetries)
+    if enable_metrics or args.metricsPort is not None or args.metricsRedisKey is not None:
+        helper.enable_metrics()
+    if args.circuitBreaker:
+        helper.enable_circuit_breaker(
+            error_threshold=args.breakerErrorRate,
+            latency_threshold=args.breakerLatency,
+            cooldown=args.breakerCooldown,
+            max_concurrency=max(1, args.workers))
+    if args.sharedEventCache:
+        helper.enable_shared_event_cache(
+            redis.StrictRedis(args.host, args.port, args.db))
+    if args.attributeBatch is not None:
+        helper.attribute_buffering(batch_size=args.attributeBatch,
+                                   max_linger=args.attributeLinger)
+
+    redisToMISP = RedisToMISP(args.host, args.port, args.db,
+            keynames, helper,
+            sleep=args.sleep, event_id=args.eventid,
+            daily_event_name=args.eventname, keynameError=args.keynameError,
+            allow_animation=args.allowAnimation, blocking=args.blocking,
+            pop_batch=args.popBatch, workers=args.workers,
+            queue_size=args.queueSize, reliable=args.reliable,
+            consumer_name=args.consumerName, ack_batch=args.ackBatch,
+            transport=args.transport, stream_group=args.streamGroup,
+            claim_idle=args.claimIdle, claim_batch=args.claimBatch,
+            error_batch=args.errorBatch,
+            key_weights=parse_key_settings(args.keyWeight),
+            key_priorities=parse_key_settings(args.keyPriority),
+            key_quotas=parse_key_settings(args.keyQuota, int),
+            round_weight=args.roundWeight)
+    if serve_metrics and args.metricsPort is not None:
+        helper.metrics.start_http_server(args.metricsPort)
+    if serve_metrics and args.metricsRedisKey is not None:
+        helper.metrics.start_redis_reporter(redisToMISP.serv,
+                                            args.metricsRedisKey,
+                                            interval=args.metricsInterval)
+    if args.precreateEvent is not None and args.eventid is None:
+        helper.enable_event_precreation(lead_time=args.precreateEvent)
+    if args.sightingWindow is not None:
+        helper.sighting_aggregation(window=args.sightingWindow,
+                                    max_batch=args.sightingBatch)
+    for generator in args.objectGenerator:
+        name, path = generator.split('=', 1)
+        helper.register_object_generator(name, path)
+    if args.cowrieSessions:
+        helper.enable_cowrie_sessions(idle_timeout=args.sessionIdle,
+                                      max_records=args.sessionMaxRecords)
+    if args.dedup is not None:
+        helper.enable_deduplication(max_size=args.dedup,
+                redis_serv=redisToMISP.serv if args.dedupShared else None,
+                as_sighting=args.dedupAsSighting)
+    return redisToMISP
+
+
+def run_consumer(redisToMISP):
+    """
+    Consume until interrupted, then push what is still buffered
+    """
+    try:
+        redisToMISP.consume()
+    except (KeyboardInterrupt, SystemExit):
+        redisToMISP.stop_reporter()
+        redisToMISP.stop_workers()
+        redisToMISP.flush_buffers()
+        redisToMISP.flush_acks()
+        redisToMISP.flush_errors()
+
+
+def shard_keynames(keynames, processes, share=False):
+    """
+    Return the keynames consumed by each process: the keynames are spread
+    over the processes, and shared by several processes when there are
+    more processes than keynames (popping is atomic, so an item is still
+    handled once). With share, every process consumes all the keynames
+    """
+    if share:
+        return [list(keynames) for i in range(processes)]
+    if len(keynames) < processes:
+        return [[keynames[i % len(keynames)]] for i in range(processes)]
+    return [list(keynames[i::processes]) for i in range(processes)]
+
+
+def _launched_consumer(args, keynames, index, stats_queue, stats_interval):
+    """
+    Entry point of the processes started by ConsumerLauncher
+    """
+    def interrupt(signum, frame):
+        # the terminal and the launcher may both interrupt us, the
+        # buffers are only flushed once
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGINT, interrupt)
+    signal.signal(signal.SIGTERM, interrupt)
+    # the consumer names must stay unique, and stay the same when a process
+    # is restarted so that it reclaims the in-flight items of the crashed one
+    if args.consumerName is None:
+        args.consumerName = socket.gethostname()
+    args.consumerName = '{}-{}'.format(args.consumerName, index)
+    # the launcher draws the progress
+    args.allowAnimation = False
+    if args.asyncio:
+        import asyncio
+        import AsyncRedisToMISP
+        args.keynamePop = keynames
+        try:
+            asyncio.run(AsyncRedisToMISP.run(args))
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        return
+
+    redisToMISP = build_consumer(args, keynames, enable_metrics=True,
+                                 serve_metrics=False)
+    metrics = redisToMISP.metrics
+
+    def report():
+        while True:
+            time.sleep(stats_interval)
+            try:
+                stats_queue.put((index, os.getpid(), metrics.snapshot()))
+            except Exception as e:
+                print('Could not send the stats to the launcher:', e)
+
+    thr = threading.Thread(name="stats-reporter", target=report)
+    thr.daemon = True
+    thr.start()
+    run_consumer(redisToMISP)
+    # last stats, with everything flushed
+    stats_queue.put((index, os.getpid(), metrics.snapshot()))
+
+
+class ConsumerLauncher:
+    def __init__(self, args, processes, share_keys=False, stats_interval=10,
+                 restart_delay=1, max_restart_delay=60):
+        """
+        Run the consumer described by the arguments of RedisToMISP.py in
+        `processes` processes, to use several cores for decoding and
+        building the MISP items. Crashed processes are restarted, with a
+        delay doubling while they keep crashing, and the metrics of the
+        processes are summed in `metrics`
+        Parameters:
+        -----------
+        share_keys : bool
+            Every process consumes all the keynames, instead of a share of
+            them (see `shard_keynames`)
+        stats_interval : float
+            Number of seconds between two reports of the processes
+        restart_delay : float
+            Number of seconds to wait before restarting a crashed process
+        """
+        self.args = args
+        self.processes = max(1, processes)
+        self.shards = shard_keynames(args.keynamePop, self.processes,
+                                     share=share_keys)
+        self.stats_interval = stats_interval
+        self.restart_delay = restart_delay
+        self.max_restart_delay = max_restart_delay
+        self.stats_queue = multiprocessing.Queue()
+        self.workers = [None] * self.processes  # index -> Process
+        self.started_at = [0] * self.processes
+        self.delays = [restart_delay] * self.processes
+        self.restart_at = [None] * self.processes
+        self.restarts = 0
+        self.snapshots = {}  # index -> (pid, last metrics snapshot)
+        self.retired = []  # last snapshots of the restarted processes
+        self._last_processed = 0
+        self.running = False
+        self._metrics_lock = threading.Lock()
+        self.metrics = Metrics()
+        self.metrics.describe('processes_alive', 'Number of consumer processes running')
+        self.metrics.describe('process_restarts_total', 'Number of consumer processes restarted')
+        self.metrics.register_collector(self._collect_metrics)
+
+    def _collect_metrics(self, metrics):
+        # also called by the threads exporting the metrics
+        with self._metrics_lock:
+            metrics.reset()
+            for snapshot in self.retired:
+                metrics.merge(snapshot)
+            for index, (pid, snapshot) in sorted(self.snapshots.items()):
+                metrics.merge(snapshot, process=index)
+            metrics.set_gauge('processes_alive', self.alive())
+            metrics.inc('process_restarts_total', self.restarts)
+
+    def spawn(self, index):
+        process = multiprocessing.Process(
+            name='RedisToMISP-{}'.format(index), target=_launched_consumer,
+            args=(self.args, self.shards[index], index, self.stats_queue,
+                  self.stats_interval))
+        process.daemon = True
+        process.start()
+        self.workers[index] = process
+        self.started_at[index] = time.time()
+        self.restart_at[index] = None
+        print('Consumer {} started (pid {}) on {}'.format(
+            index, process.pid, ', '.join(self.shards[index])))
+
+    def alive(self):
+        return sum(1 for p in self.workers if p is not None and p.is_alive())
+
+    def start(self):
+        self.running = True
+        for index in range(self.processes):
+            self.spawn(index)
+
+    def supervise(self):
+        """
+        Restart the crashed processes, and print the stats of the processes
+        every stats_interval seconds, until `stop`
+        """
+        last_report = time.time()
+        while self.running:
+            self.read_stats(timeout=1)
+            self.check_processes()
+            if time.time() - last_report >= self.stats_interval:
+                self.report(time.time() - last_report)
+                last_report = time.time()
+
+    def report(self, elapsed=None):
+        processed = self.metrics.total('items_processed_total')
+        rate = ''
+        if elapsed:
+            rate = ' ({:.1f}/s)'.format((processed - self._last_processed) / elapsed)
+        self._last_processed = processed
+        print('Consumers: {}/{} alive, {} restart(s), {} item(s) processed{}, {} error(s)'.format(
+            self.alive(), self.processes, self.restarts, processed, rate,
+            self.metrics.total('errors_total')))
+
+    def read_stats(self, timeout=1):
+        try:
+            index, pid, snapshot = self.stats_queue.get(timeout=timeout)
+        except queue.Empty:
+            return
+        self._store_snapshot(index, pid, snapshot)
+        self._collect_metrics(self.metrics)
+
+    def _store_snapshot(self, index, pid, snapshot):
+        previous = self.snapshots.get(index)
+        if previous is not None and previous[0] != pid:
+            # keep the counters of the process that was restarted
+            self.retired.append(dict(previous[1], gauges={}))
+        self.snapshots[index] = (pid, snapshot)
+
+    def check_processes(self):
+        for index, process in enumerate(self.workers):
+            if process is None or process.is_alive():
+                continue
+            if self.restart_at[index] is None:
+                if process.exitcode == 0:
+                    print('Consumer {} exited'.format(index))
+                    self.workers[index] = None
+                    continue
+                if time.time() - self.started_at[index] >= self.max_restart_delay:
+                    self.delays[index] = self.restart_delay
+                self.restart_at[index] = time.time() + self.delays[index]
+                print('Consumer {} died (exit code {}), restarting in {}s'.format(
+                    index, process.exitcode, self.delays[index]))
+                # crashing again right after the restart: back off
+                self.delays[index] = min(self.delays[index] * 2, self.max_restart_delay)
+            elif time.time() >= self.restart_at[index]:
+                self.restarts += 1
+                self.spawn(index)
+
+    def stop(self, timeout=30):
+        """
+        Interrupt the processes, which push what they buffered before
+        exiting, and kill the ones still running after timeout seconds
+        """
+        self.running = False
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signal.SIGINT)
+        deadline = time.time() + timeout
+        for process in self.workers:
+            if process is None:
+                continue
+            process.join(max(0, deadline - time.time()))
+            if process.is_alive():
+                process.terminate()
+        # the last reports of the processes
+        while True:
+            try:
+                index, pid, snapshot = self.stats_queue.get(timeout=0.1)
+            except queue.Empty:
+                break
+            self._store_snapshot(index, pid, snapshot)
+        self._collect_metrics(self.metrics)
+        self.report()
 
 
 if __name__ == '__main__':
@@ -278,8 +1694,87 @@ if __name__ == '__main__':
                         + "of the form honeypot_1 dd-mm-yyyy")
     parser.add_argument("-s", "--sleep", type=int, default=1,
                         help="Redis pooling time")
+    parser.add_argument("--blocking", action="store_true", default=False,
+                        help="Block on all the keys at once (BRPOP) instead"
+                        + " of polling them. --sleep is used as timeout")
+    parser.add_argument("--popBatch", type=int, default=1,
+                        help="Maximum number of items taken from redis in a"
+                        + " single round trip (blocking pops, streams, and the"
+                        + " per-key quota of the scheduler)")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="Number of threads pushing to MISP concurrently"
+                        + " (0: push from the main thread)")
+    parser.add_argument("--queueSize", type=int, default=100,
+                        help="Number of popped items each worker can have"
+                        + " waiting")
+    parser.add_argument("--keyWeight", nargs="+", default=[], metavar="KEY=WEIGHT",
+                        help="Number of items taken from KEY at each round"
+                        + " (KEY is a full key, a suffix such as sighting or"
+                        + " a keyname of --keynamePop)")
+    parser.add_argument("--keyPriority", nargs="+", default=[],
+                        metavar="KEY=PRIORITY",
+                        help="Keys with a higher priority are served first at"
+                        + " each round (e.g. attribute=1)")
+    parser.add_argument("--keyQuota", nargs="+", default=[], metavar="KEY=N",
+                        help="Maximum number of items taken from KEY in a"
+                        + " single round trip (default: --popBatch)")
+    parser.add_argument("--roundWeight", type=float, default=100,
+                        help="Number of items taken at each round from the"
+                        + " keys without --keyWeight")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Number of consumer processes, restarted when"
+                        + " they crash")
+    parser.add_argument("--shareKeys", action="store_true", default=False,
+                        help="With --processes, every process consumes all"
+                        + " the keynames instead of a share of them")
+    parser.add_argument("--statsInterval", type=float, default=10,
+                        help="Number of seconds between two reports of the"
+                        + " processes")
+    parser.add_argument("--asyncio", action="store_true", default=False,
+                        help="Push to MISP from an asyncio loop (requires"
+                        + " aiohttp) instead of threads. Not available with"
+                        + " the reliable and stream modes, the buffering,"
+                        + " deduplication, cowrie sessions and metrics")
+    parser.add_argument("--inFlight", type=int, default=100,
+                        help="Maximum number of concurrent MISP requests in"
+                        + " asyncio mode")
+    parser.add_argument("--reliable", action="store_true", default=False,
+                        help="Keep popped items in a processing list until"
+                        + " they are pushed to MISP, and reclaim the items"
+                        + " of crashed consumers on startup")
+    parser.add_argument("--consumerName", type=str, default=None,
+                        help="Unique name of this consumer in reliable mode"
+                        + " (default: hostname:pid, or hostname-N for the"
+                        + " process N of --processes)")
+    parser.add_argument("--ackBatch", type=int, default=50,
+                        help="Number of processed items acknowledged at once"
+                        + " in reliable or stream mode")
+    parser.add_argument("--transport", type=str, default='list',
+                        choices=['list', 'stream'],
+                        help="Read items from redis lists or from redis"
+                        + " streams through a consumer group")
+    parser.add_argument("--streamGroup", type=str, default='RedisToMISP',
+                        help="The consumer group name in stream mode")
+    parser.add_argument("--claimIdle", type=int, default=60,
+                        help="Number of seconds after which the unacknowledged"
+                        + " entries of a consumer are claimed by another one")
+    parser.add_argument("--claimBatch", type=int, default=100,
+                        help="Maximum number of stale entries claimed from a"
+                        + " stream at once")
+    parser.add_argument("--errorBatch", type=int, default=100,
+                        help="Number of errors written to the error list at"
+                        + " once")
+    parser.add_argument("--replayErrors", action="store_true", default=False,
+                        help="Push the items of the error list back into"
+                        + " their queue and exit")
+    parser.add_argument("--replayRate", type=float, default=None,
+                        help="Maximum number of items replayed per second")
+    parser.add_argument("--showLag", action="store_true", default=False,
+                        help="Print the consumer group lag of each stream"
+                        + " and exit (with --transport stream)")
 
     # PyMISPHelper
+    misp_url = misp_key = None
     if flag_MISPKeys:
         from MISPKeys import misp_url, misp_key
 
@@ -297,6 +1792,89 @@ if __name__ == '__main__':
                         + "that generated an error")
     parser.add_argument("--allowAnimation", action="store_true", default=True,
                         help="Display an animation while adding element to MISP")
+    parser.add_argument("--noAnimation", action="store_false",
+                        dest="allowAnimation",
+                        help="Do not display the animation (it is also"
+                        + " disabled when stdout is not a terminal)")
+    parser.add_argument("--attributeBatch", type=int, default=None,
+                        help="Buffer attributes and push them to MISP by batch"
+                        + " of this size (disabled by default)")
+    parser.add_argument("--attributeLinger", type=float, default=5,
+                        help="Maximum time in seconds an attribute can stay"
+                        + " in the buffer before being pushed")
+
+    parser.add_argument("--sightingWindow", type=float, default=None,
+                        help="Aggregate sightings over this many seconds and"
+                        + " push them in bulk (disabled by default)")
+    parser.add_argument("--sightingBatch", type=int, default=1000,
+                        help="Maximum number of aggregated sightings pushed"
+                        + " in a single request")
+    parser.add_argument("--objectGenerator", nargs="+", default=[],
+                        metavar="NAME=MODULE:CLASS",
+                        help="Generator building the objects NAME, imported"
+                        + " on first use (objects without generator are built"
+                        + " from their template)")
+    parser.add_argument("--cowrieSessions", action="store_true", default=False,
+                        help="Merge the cowrie records of a same session into"
+                        + " a single MISP object")
+    parser.add_argument("--sessionIdle", type=float, default=60,
+                        help="Number of seconds without records after which"
+                        + " a cowrie session is pushed")
+    parser.add_argument("--sessionMaxRecords", type=int, default=100,
+                        help="Maximum number of cowrie records merged in a"
+                        + " single object")
+    parser.add_argument("--dedup", type=int, default=None,
+                        help="Skip attributes already added to the event,"
+                        + " remembering up to this many attributes")
+    parser.add_argument("--dedupShared", action="store_true", default=False,
+                        help="Share the deduplication state between consumers"
+                        + " through redis")
+    parser.add_argument("--dedupAsSighting", action="store_true",
+                        default=False, help="Turn duplicated attributes into"
+                        + " sightings instead of dropping them")
+    parser.add_argument("--sharedEventCache", action="store_true",
+                        default=False, help="Share the daily event ids between"
+                        + " consumers through redis, and prevent them from"
+                        + " creating the same event twice (always on with"
+                        + " --processes)")
+    parser.add_argument("--timezone", type=str, default=None,
+                        help="Timezone in which the daily events start"
+                        + " (e.g. Europe/Luxembourg, local time by default)")
+    parser.add_argument("--precreateEvent", type=int, default=None,
+                        help="Create the event of the next day this many"
+                        + " seconds before midnight")
+    parser.add_argument("--httpPool", type=int, default=None,
+                        help="Keep up to this many connections to MISP alive"
+                        + " (default: max(10, workers))")
+    parser.add_argument("--httpTimeout", type=float, default=120,
+                        help="Timeout in seconds of the MISP requests")
+    parser.add_argument("--httpRetries", type=int, default=3,
+                        help="Number of retries of MISP requests failing with"
+                        + " a connection error, a 5xx or a 429 (only 429 and"
+                        + " 503 for POST requests)")
+    parser.add_argument("--circuitBreaker", action="store_true",
+                        default=False, help="Stop popping items while MISP"
+                        + " fails or is slow, and adapt the number of"
+                        + " concurrent requests")
+    parser.add_argument("--breakerErrorRate", type=float, default=0.5,
+                        help="Rate of failed requests opening the circuit")
+    parser.add_argument("--breakerLatency", type=float, default=None,
+                        help="Requests slower than this many seconds count"
+                        + " as failed")
+    parser.add_argument("--breakerCooldown", type=float, default=10,
+                        help="Number of seconds to wait before trying MISP"
+                        + " again once the circuit is open")
+    parser.add_argument("--metricsPort", type=int, default=None,
+                        help="Serve Prometheus metrics on this port"
+                        + " (http://127.0.0.1:PORT/metrics)")
+    parser.add_argument("--metricsRedisKey", type=str, default=None,
+                        help="Write the metrics to this redis hash")
+    parser.add_argument("--metricsInterval", type=float, default=10,
+                        help="Number of seconds between two writes of the"
+                        + " metrics to redis")
+    parser.add_argument("--templateCache", type=str, default=None,
+                        help="File in which the MISP object template index"
+                        + " is cached between runs")
 
     args = parser.parse_args()
 
@@ -304,21 +1882,67 @@ if __name__ == '__main__':
         args.dailymode = False
         args.eventname = ''
 
-    try:
-        pymisp = PyMISP(args.url, args.mispkey, args.verifycert)
-    except PyMISPError as e:
-        print(e)
-    PyMISPHelper = PyMISPHelper(pymisp, daily_event_name=args.eventname)
+    if args.asyncio:
+        # only implemented by the threaded consumer
+        unsupported = [flag for flag, used in (
+            ('--transport stream', args.transport == 'stream'),
+            ('--reliable', args.reliable),
+            ('--attributeBatch', args.attributeBatch is not None),
+            ('--sightingWindow', args.sightingWindow is not None),
+            ('--dedup', args.dedup is not None),
+            ('--cowrieSessions', args.cowrieSessions),
+            ('--precreateEvent', args.precreateEvent is not None),
+            ('--metricsPort', args.metricsPort is not None),
+            ('--metricsRedisKey', args.metricsRedisKey is not None)) if used]
+        if unsupported:
+            parser.error('{} cannot be used with --asyncio'.format(', '.join(unsupported)))
 
+    if args.showLag:
+        if args.transport != 'stream':
+            parser.error('--showLag requires --transport stream')
+        # no need for MISP, nor to register a consumer
+        serv = redis.StrictRedis(args.host, args.port, args.db, decode_responses=True)
+        keys = [k + s for k in args.keynamePop for s in RedisToMISP.SUFFIX_LIST]
+        for key, info in get_stream_lag(serv, keys, args.streamGroup).items():
+            print('{}: length={length}, lag={lag}, pending={pending}'.format(key, **info))
+        sys.exit(0)
 
-    redisToMISP = RedisToMISP(args.host, args.port, args.db,
-            args.keynamePop, PyMISPHelper,
-            sleep=args.sleep, event_id=args.eventid,
-            daily_event_name=args.eventname, keynameError=args.keynameError,
-            allow_animation=args.allowAnimation)
-    try:
-        redisToMISP.consume()
-    except (KeyboardInterrupt, SystemExit):
-        if evtObj is not None:
-            evtObj.set()
-            thr.join()
+    if args.replayErrors:
+        replayer = ErrorReplayer(args.keynameError, args.host, args.port,
+                                 args.db, transport=args.transport)
+        replayed = replayer.replay(keyname=args.keynamePop[0],
+                                   rate=args.replayRate)
+        for key, count in replayed.items():
+            print('{}: {} item(s) replayed'.format(key, count))
+        sys.exit(0)
+
+    if args.processes > 1:
+        if args.eventid is None:
+            # each process would create its own daily event otherwise
+            args.sharedEventCache = True
+        launcher = ConsumerLauncher(args, args.processes,
+                                    share_keys=args.shareKeys,
+                                    stats_interval=args.statsInterval)
+        if args.metricsPort is not None:
+            launcher.metrics.start_http_server(args.metricsPort)
+        if args.metricsRedisKey is not None:
+            launcher.metrics.start_redis_reporter(
+                redis.StrictRedis(args.host, args.port, args.db),
+                args.metricsRedisKey, interval=args.metricsInterval)
+        launcher.start()
+        try:
+            launcher.supervise()
+        except (KeyboardInterrupt, SystemExit):
+            launcher.stop()
+        sys.exit(0)
+
+    if args.asyncio:
+        import asyncio
+        import AsyncRedisToMISP
+        try:
+            asyncio.run(AsyncRedisToMISP.run(args))
+        except (KeyboardInterrupt, SystemExit):
+            pass
+        sys.exit(0)
+
+    run_consumer(build_consumer(args))
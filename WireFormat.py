@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+import json
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+
+class WireFormatError(ValueError):
+    pass
+
+
+# 0xc1 is never produced by msgpack and cannot start a JSON document nor a
+# UTF-8 string: items starting with it are binary, anything else is JSON
+MAGIC = b'\xc1'
+VERSION = 1
+COMPRESSIONS = {None: 0, 'zstd': 1, 'lz4': 2}
+FLAG_FRAME = 0x10  # the payload is a list of items
+COMPRESSION_MASK = 0x0f
+
+# The tables below are part of the format: only append to them, and bump
+# VERSION if an entry ever has to change
+FIELDS = ('type', 'value', 'category', 'to_ids', 'comment', 'distribution',
+          'proposal', 'uuid', 'id', 'source', 'timestamp', 'name', 'event_id',
+          'session', 'eventid', 'src_ip', 'src_port', 'dst_ip', 'dst_port',
+          'sensor', 'protocol', 'message', 'input', 'username', 'password',
+          'Tag', 'first_seen', 'last_seen')
+TYPES = ('ip-src', 'ip-dst', 'domain', 'hostname', 'url', 'uri', 'md5',
+         'sha1', 'sha256', 'sha512', 'filename', 'email-src', 'email-dst',
+         'email-subject', 'user-agent', 'AS', 'port', 'text', 'comment',
+         'ip-src|port', 'ip-dst|port', 'domain|ip', 'filename|md5',
+         'filename|sha1', 'filename|sha256', 'ssdeep', 'mutex', 'regkey',
+         'link', 'other', 'vulnerability', 'snort', 'yara', 'btc')
+CATEGORIES = ('Internal reference', 'Targeting data', 'Antivirus detection',
+              'Payload delivery', 'Artifacts dropped', 'Payload installation',
+              'Persistence mechanism', 'Network activity', 'Payload type',
+              'Attribution', 'External analysis', 'Financial fraud',
+              'Support Tool', 'Social network', 'Person', 'Other')
+# field -> table of the interned values
+INTERNED = {'type': TYPES, 'category': CATEGORIES}
+
+FIELD_IDS = {f: i for i, f in enumerate(FIELDS)}
+INTERNED_IDS = {f: {v: i for i, v in enumerate(t)} for f, t in INTERNED.items()}
+
+
+def available_compressions():
+    return [name for name, module in (('zstd', zstandard), ('lz4', lz4))
+            if module is not None]
+
+
+def capabilities():
+    """
+    Return what this side can decode, as advertised by the consumers
+    (e.g. '1:msgpack,zstd,lz4')
+    """
+    codecs = (['msgpack'] if msgpack is not None else []) + available_compressions()
+    return '{}:{}'.format(VERSION, ','.join(codecs))
+
+
+def parse_capabilities(value):
+    version, _, codecs = value.partition(':')
+    return int(version), set(c for c in codecs.split(',') if c)
+
+
+def is_binary(raw):
+    """
+    raw is bytes, or a str read with the 'surrogateescape' error handler
+    """
+    if isinstance(raw, bytes):
+        return raw[:1] == MAGIC
+    return raw[:1] == '\udcc1'
+
+
+class WireFormat:
+    def __init__(self, encoding='json', compression=None, frame_size=1,
+                 compress_min_size=512, level=None):
+        """
+        Encode the items pushed to redis. With msgpack, the keys of the
+        fields listed in FIELDS and the values of type and category are
+        replaced by small integers, and each payload starts with a header
+        (MAGIC, version, flags) telling the consumer how to read it. JSON
+        payloads are written as before, and are always accepted by
+        `decode_many`
+
+        Parameters:
+        -----------
+        encoding : str
+            'json' or 'msgpack'
+        compression : str
+            None, 'zstd' or 'lz4', only applied to msgpack payloads of at
+            least compress_min_size bytes
+        frame_size : int
+            Number of items packed in a single redis entry when items are
+            pushed by batch (msgpack only)
+        level : int
+            Compression level
+        """
+        if encoding not in ('json', 'msgpack'):
+            raise WireFormatError('Unknown encoding {}'.format(encoding))
+        if encoding == 'msgpack' and msgpack is None:
+            raise WireFormatError('The msgpack encoding requires the msgpack package')
+        if compression not in COMPRESSIONS:
+            raise WireFormatError('Unknown compression {}'.format(compression))
+        if compression is not None and compression not in available_compressions():
+            raise WireFormatError('The {} compression requires the {} package'.format(
+                compression, 'zstandard' if compression == 'zstd' else 'lz4'))
+        if compression is not None and encoding != 'msgpack':
+            raise WireFormatError('Compression is only supported with msgpack')
+        self.encoding = encoding
+        self.compression = compression
+        self.frame_size = max(1, frame_size) if encoding == 'msgpack' else 1
+        self.compress_min_size = compress_min_size
+        self.level = level
+
+    @classmethod
+    def negotiate(cls, advertised, encoding='msgpack', compression=None, **kargs):
+        """
+        Return the best WireFormat understood by all the consumers, from
+        their advertised capabilities (see `capabilities`). Falls back on
+        JSON when a consumer does not support msgpack or advertised nothing
+        """
+        if not advertised or msgpack is None or encoding == 'json':
+            return cls('json')
+        common = None
+        for value in advertised:
+            version, codecs = parse_capabilities(value)
+            if version < 1:
+                return cls('json')
+            common = codecs if common is None else common & codecs
+        if 'msgpack' not in common:
+            return cls('json')
+        candidates = [compression] if compression is not None else available_compressions()
+        compression = next((c for c in candidates if c in common and c in available_compressions()), None)
+        return cls('msgpack', compression=compression, **kargs)
+
+    def __repr__(self):
+        return 'WireFormat({}, compression={}, frame_size={})'.format(
+            self.encoding, self.compression, self.frame_size)
+
+    # ENCODING
+    def encode(self, item):
+        """
+        Return the payload of a single item (str for JSON, bytes otherwise).
+        item is a dict or a JSON string
+        """
+        if self.encoding == 'json':
+            return item if isinstance(item, str) else json.dumps(item)
+        if isinstance(item, (str, bytes)):
+            item = json.loads(item)
+        return self._pack(self.compact(item), 0)
+
+    def encode_many(self, items):
+        """
+        Return the list of payloads of items, packed by frame_size
+        """
+        if self.frame_size <= 1:
+            return [self.encode(item) for item in items]
+        payloads = []
+        for i in range(0, len(items), self.frame_size):
+            frame = [self.compact(json.loads(item) if isinstance(item, (str, bytes)) else item)
+                     for item in items[i:i + self.frame_size]]
+            payloads.append(self._pack(frame, FLAG_FRAME))
+        return payloads
+
+    def _pack(self, obj, flags):
+        body = msgpack.packb(obj, use_bin_type=True)
+        if self.compression is not None and len(body) >= self.compress_min_size:
+            flags |= COMPRESSIONS[self.compression]
+            if self.compression == 'zstd':
+                # compressors cannot be shared between threads
+                body = zstandard.ZstdCompressor(level=self.level or 3).compress(body)
+            else:
+                body = lz4.frame.compress(body, compression_level=self.level or 0)
+        return MAGIC + bytes((VERSION, flags)) + body
+
+    @staticmethod
+    def compact(item):
+        if not isinstance(item, dict):
+            return item
+        compacted = {}
+        for k, v in item.items():
+            table = INTERNED_IDS.get(k)
+            if table is not None and isinstance(v, str) and v in table:
+                # interned values are stored under the negated field id
+                compacted[-1 - FIELD_IDS[k]] = table[v]
+            else:
+                compacted[FIELD_IDS.get(k, k)] = v
+        return compacted
+
+    # DECODING
+    @staticmethod
+    def expand(item):
+        if not isinstance(item, dict):
+            return item
+        expanded = {}
+        for k, v in item.items():
+            if isinstance(k, int):
+                if k < 0:
+                    k = FIELDS[-1 - k]
+                    v = INTERNED[k][v]
+                else:
+                    k = FIELDS[k]
+            expanded[k] = v
+        return expanded
+
+    @classmethod
+    def decode_many(cls, raw):
+        """
+        Return the list of items of a payload: a single item for JSON, one
+        or more for msgpack. raw is bytes, or a str read with the
+        'surrogateescape' error handler. Invalid JSON is returned as is (the
+        error is then saved when performing the action)
+        """
+        if not is_binary(raw):
+            try:
+                return [json.loads(raw)]
+            except ValueError:
+                return [raw]
+        if isinstance(raw, str):
+            raw = raw.encode('utf8', 'surrogateescape')
+        if len(raw) < 3:
+            raise WireFormatError('Truncated payload')
+        version, flags = raw[1], raw[2]
+        if version > VERSION:
+            raise WireFormatError('Unsupported wire format version {}'.format(version))
+        if msgpack is None:
+            raise WireFormatError('Decoding msgpack items requires the msgpack package')
+        body = raw[3:]
+        compression = flags & COMPRESSION_MASK
+        if compression == COMPRESSIONS['zstd']:
+            if zstandard is None:
+                raise WireFormatError('Decoding zstd items requires the zstandard package')
+            body = zstandard.ZstdDecompressor().decompress(body)
+        elif compression == COMPRESSIONS['lz4']:
+            if lz4 is None:
+                raise WireFormatError('Decoding lz4 items requires the lz4 package')
+            body = lz4.frame.decompress(body)
+        elif compression != 0:
+            raise WireFormatError('Unknown compression {}'.format(compression))
+        obj = msgpack.unpackb(body, raw=False, strict_map_key=False)
+        try:
+            if flags & FLAG_FRAME:
+                return [cls.expand(item) for item in obj]
+            return [cls.expand(obj)]
+        except (IndexError, KeyError):
+            raise WireFormatError('Unknown field or value, the producer uses a newer format')
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from CowrieMISPObject import CowrieMispObject
+
+
+SAMPLE_RECORD = {
+    "eventid": "cowrie.command.input", "session": "a9f4a7e2c3b1",
+    "timestamp": "2018-03-06T10:21:12.712345Z", "src_ip": "198.51.100.23",
+    "src_port": 51712, "dst_ip": "192.0.2.10", "dst_port": 2222,
+    "sensor": "honeypot_1", "protocol": "ssh", "username": "root",
+    "password": "123456", "input": "uname -a", "message": "CMD: uname -a",
+    "isError": 0, "time": 1520331672.712345, "log_level": "info"
+}
+
+
+class LegacyCowrieMispObject(CowrieMispObject):
+    """
+    CowrieMispObject as built before the field plans, for reference
+    """
+
+    def generate_attributes(self):
+        skip_list = ['time', 'duration', 'isError', 'ttylog']
+        for object_relation, value in self._dico_val.items():
+            if object_relation in skip_list or 'log_' in object_relation:
+                continue
+            if object_relation == 'timestamp':
+                value = value.rstrip('Z')
+            if isinstance(value, dict):
+                self.add_attribute(object_relation, **value)
+            else:
+                self.add_attribute(object_relation, value=value)
+
+
+def bench(name, func, records):
+    start = time.perf_counter()
+    func(records)
+    elapsed = time.perf_counter() - start
+    print('{:<10} {:>10.1f} objects/s {:>10.1f} us/object'.format(
+        name, len(records) / elapsed, elapsed / len(records) * 1e6))
+    return elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the construction time of cowrie MISP objects')
+    parser.add_argument("-n", "--records", type=int, default=2000, help="Number of records to convert")
+    args = parser.parse_args()
+
+    records = [dict(SAMPLE_RECORD, session='{:012x}'.format(i)) for i in range(args.records)]
+    # compile the field plan and warm up the template files cache
+    CowrieMispObject(SAMPLE_RECORD)
+    LegacyCowrieMispObject(SAMPLE_RECORD)
+
+    legacy = bench('legacy', lambda r: [LegacyCowrieMispObject(x) for x in r], records)
+    planned = bench('planned', lambda r: [CowrieMispObject(x) for x in r], records)
+    bulk = bench('bulk', CowrieMispObject.from_records, records)
+    print('speedup: planned x{:.1f}, bulk x{:.1f}'.format(legacy / planned, legacy / bulk))
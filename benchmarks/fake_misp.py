@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+
+import re
+import json
+import time
+import random
+import threading
+import argparse
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+except ImportError:  # python2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+# Timestamp embedded in the benchmark items (see run_benchmarks.py)
+STAMP_RE = re.compile(r'bench:([0-9.]+)')
+
+
+class FakeMISPServer:
+    def __init__(self, host='127.0.0.1', port=0, latency=0, error_rate=0,
+                 event_size=0, template_names=('cowrie', 'domain-ip')):
+        """
+        Stand-in for the parts of the MISP REST API used by PyMISPHelper
+
+        Parameters:
+        -----------
+        latency : float
+            Number of seconds added to every answer
+        error_rate : float
+            Probability of answering with a 500 error to a write request
+        event_size : int
+            Number of attributes in the events returned by the server
+        template_names : list
+            Names of the object templates known by the server
+        """
+        self.latency = latency
+        self.error_rate = error_rate
+        self.event_size = event_size
+        self.templates = [{'ObjectTemplate': {'id': str(i + 1), 'name': name}}
+                          for i, name in enumerate(template_names)]
+        self._lock = threading.Lock()
+        self._next_event_id = 1
+        self.reset()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # headers and body are written separately
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                server.handle(self)
+
+            do_POST = do_GET
+
+            def log_message(self, *args):
+                pass
+
+        self.http_server = ThreadingHTTPServer((host, port), Handler)
+        self.url = 'http://{}:{}'.format(*self.http_server.server_address)
+
+    def reset(self):
+        """
+        Reset the counters
+        """
+        with self._lock:
+            self.requests = {}  # operation -> count
+            self.errors = 0
+            self.latencies = []  # end-to-end latency of the benchmark items
+            self.received = 0  # number of benchmark items received
+
+    def start(self):
+        thr = threading.Thread(name="fake-misp", target=self.http_server.serve_forever)
+        thr.daemon = True
+        thr.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def total_requests(self):
+        with self._lock:
+            return sum(self.requests.values())
+
+    def get_event(self, event_id, info='benchmark'):
+        return {'Event': {
+            'id': str(event_id), 'info': info, 'date': time.strftime('%Y-%m-%d'),
+            'Attribute': [{'id': str(i), 'type': 'ip-src', 'category': 'Network activity',
+                           'value': '10.0.{}.{}'.format(i // 256 % 256, i % 256)}
+                          for i in range(self.event_size)]
+        }}
+
+    def handle(self, request):
+        length = int(request.headers.get('Content-Length') or 0)
+        body = request.rfile.read(length).decode('utf8') if length else ''
+        received_at = time.time()
+        path = request.path.lstrip('/')
+        operation = path.split('/')[0]
+        if self.latency:
+            time.sleep(self.latency)
+
+        code, answer = 200, {}
+        if path.startswith('servers/getPyMISPVersion') or path.startswith('servers/getVersion'):
+            answer = {'version': '2.4.111'}
+        elif path.startswith('attributes/describeTypes'):
+            # PyMISP falls back on its local copy
+            code = 404
+        elif path.startswith('objectTemplates'):
+            answer = self.templates
+        elif request.command == 'POST' and self.error_rate and random.random() < self.error_rate:
+            code, answer = 500, {'errors': 'Fake MISP error'}
+        elif path.startswith('events/index') or path.startswith('events/restSearch'):
+            answer = []
+        elif path.rstrip('/') in ('events', 'events/add') and request.command == 'POST':
+            with self._lock:
+                event_id, self._next_event_id = self._next_event_id, self._next_event_id + 1
+            info = json.loads(body).get('Event', {}).get('info', 'benchmark') if body else 'benchmark'
+            answer = self.get_event(event_id, info)
+        elif path.startswith('events/'):
+            answer = self.get_event(path.split('/')[-1])
+        elif path.startswith('attributes/add'):
+            attributes = json.loads(body) if body else []
+            if isinstance(attributes, dict):
+                attributes = [attributes]
+            answer = [{'Attribute': a} for a in attributes] if len(attributes) > 1 \
+                else {'Attribute': attributes[0] if attributes else {}}
+
+        stamps = [float(x) for x in STAMP_RE.findall(body)] if code == 200 else []
+        with self._lock:
+            self.requests[operation] = self.requests.get(operation, 0) + 1
+            if code >= 500:
+                self.errors += 1
+            self.received += len(stamps)
+            self.latencies += [received_at - x for x in stamps]
+
+        data = json.dumps(answer).encode('utf8')
+        request.send_response(code)
+        request.send_header('Content-Type', 'application/json')
+        request.send_header('Content-Length', str(len(data)))
+        request.end_headers()
+        request.wfile.write(data)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a fake MISP server answering the requests of PyMISPHelper')
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on")
+    parser.add_argument("--latency", type=float, default=0, help="Seconds added to every answer")
+    parser.add_argument("--errorRate", type=float, default=0, help="Probability of failing a write request")
+    parser.add_argument("--eventSize", type=int, default=0, help="Number of attributes in the events returned")
+    args = parser.parse_args()
+
+    server = FakeMISPServer(port=args.port, latency=args.latency,
+                            error_rate=args.errorRate, event_size=args.eventSize)
+    print('Fake MISP listening on', server.url)
+    try:
+        server.http_server.serve_forever()
+    except KeyboardInterrupt:
+        pass
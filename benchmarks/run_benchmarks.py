@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import threading
+import resource
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import redis
+
+from fake_misp import FakeMISPServer
+
+
+# name -> description, kind of item, helper and consumer options
+SCENARIOS = {
+    'attributes': {
+        'description': 'Attributes pushed one request per item',
+        'kind': 'attribute', 'helper': {}, 'consumer': {}},
+    'attributes_batched': {
+        'description': 'Attributes buffered and pushed by batch of 500',
+        'kind': 'attribute', 'helper': {'attribute_buffering': {'batch_size': 500, 'max_linger': 1}},
+        'consumer': {}},
+    'cowrie_objects': {
+        'description': 'Cowrie objects, one object per record',
+        'kind': 'object', 'helper': {}, 'consumer': {}},
+    'cowrie_sessions': {
+        'description': 'Cowrie records merged per session',
+        'kind': 'object', 'helper': {'enable_cowrie_sessions': {'idle_timeout': 1, 'max_records': 10}},
+        'consumer': {}},
+    'sightings': {
+        'description': 'Sightings aggregated over 1 second',
+        'kind': 'sighting', 'helper': {'sighting_aggregation': {'window': 1, 'max_batch': 1000}},
+        'consumer': {}},
+    'daily_rollover': {
+        'description': 'Attributes in daily mode, with the daily event rolled over every 0.5 second',
+        'kind': 'attribute', 'helper': {}, 'consumer': {}, 'daily': True, 'rollover_every': 0.5},
+}
+
+
+def make_item(kind, i):
+    stamp = 'bench:{:.6f}'.format(time.time())
+    if kind == 'attribute':
+        return {'type': 'ip-src', 'value': '198.51.{}.{}'.format(i // 256 % 256, i % 256),
+                'category': 'Network activity', 'comment': stamp}
+    if kind == 'object':
+        return {'name': 'cowrie', 'session': '{:012x}'.format(i // 10),
+                'eventid': 'cowrie.command.input', 'src_ip': '198.51.100.{}'.format(i % 256),
+                'dst_port': 22, 'protocol': 'ssh', 'input': 'uname -a', 'message': stamp,
+                'timestamp': '2018-03-06T10:21:12.712345Z'}
+    return {'value': stamp, 'source': 'benchmark'}
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macOS
+    return rss / 1024.0 / (1024.0 if sys.platform == 'darwin' else 1.0)
+
+
+def use_fake_redis():
+    import fakeredis
+    server = fakeredis.FakeServer()
+    real = redis.StrictRedis
+
+    def factory(*args, **kargs):
+        kargs.pop('host', None), kargs.pop('port', None), kargs.pop('db', None)
+        return fakeredis.FakeStrictRedis(server=server, **kargs)
+    redis.StrictRedis = factory
+    return real
+
+
+def get_wire_format(args):
+    from WireFormat import WireFormat
+    if args.wireFormat == 'auto':
+        return 'auto'
+    return WireFormat(args.wireFormat, compression=args.compression,
+                      frame_size=args.frameSize)
+
+
+def run_scenario(name, args, misp):
+    from pymisp import PyMISP
+    from PyMISPHelper import PyMISPHelper
+    from RedisToMISP import RedisToMISP, MISPItemToRedis
+
+    scenario = SCENARIOS[name]
+    keyname = 'benchmark_{}_{}'.format(name, os.getpid())
+    misp.reset()
+    misp.error_rate = args.errorRate
+
+    helper = PyMISPHelper(PyMISP(misp.url, 'benchmark', False))
+    helper.configure_http(pool_maxsize=max(10, args.workers), retries=0)
+    for method, kargs in scenario['helper'].items():
+        getattr(helper, method)(**kargs)
+    consumer = RedisToMISP(args.host, args.port, args.db, [keyname], helper,
+                           sleep=0.1, event_id=None if scenario.get('daily') else 1,
+                           daily_event_name='benchmark', keynameError=keyname + '_error',
+                           allow_animation=False, blocking=True, pop_batch=args.popBatch,
+                           workers=args.workers, **scenario['consumer'])
+    producer = MISPItemToRedis(keyname, args.host, args.port, args.db,
+                               wire_format=get_wire_format(args))
+    setup_requests = misp.total_requests()
+    misp.reset()
+
+    rss_before = max_rss_mb()
+    start = time.time()
+    thr = threading.Thread(name="consumer", target=consumer.consume)
+    thr.daemon = True
+    thr.start()
+
+    def produce():
+        with producer.batch(batch_size=500, max_linger=0.05):
+            for i in range(args.items):
+                producer.push_json(json.dumps(make_item(scenario['kind'], i)), keyname, scenario['kind'])
+    producer_thr = threading.Thread(name="producer", target=produce)
+    producer_thr.start()
+
+    deadline = start + args.timeout
+    next_rollover = start + scenario.get('rollover_every', args.timeout)
+    expected = args.items * (1 - args.errorRate) if args.errorRate else args.items
+    while time.time() < deadline:
+        time.sleep(0.01)
+        if time.time() >= next_rollover:
+            # pretend midnight passed
+            helper._rollover_deadline = 0
+            next_rollover += scenario['rollover_every']
+        if not producer_thr.is_alive() and (misp.received >= expected or (
+                args.errorRate and consumer.serv.llen(keyname + '_' + scenario['kind']) == 0
+                and time.time() - start > 1 and misp.received >= expected * 0.9)):
+            break
+    producer_thr.join()
+    consumer.stop()
+    consumer.flush_buffers()
+    elapsed = time.time() - start
+    thr.join(5)
+    consumer.stop_workers()
+    errors = consumer.serv.llen(keyname + '_error')
+    consumer.serv.delete(keyname + '_error', *consumer.keynames)
+
+    latencies = list(misp.latencies)
+    requests = dict(misp.requests)
+    return {
+        'scenario': name,
+        'description': scenario['description'],
+        'items': args.items,
+        'received': misp.received,
+        'errors': errors,
+        'timed_out': misp.received < expected,
+        'seconds': round(elapsed, 3),
+        'items_per_second': round(misp.received / elapsed, 1) if elapsed else None,
+        'latency_p50': percentile(latencies, 50),
+        'latency_p99': percentile(latencies, 99),
+        'misp_calls': requests,
+        'misp_calls_per_item': round(float(sum(requests.values())) / max(1, misp.received), 4),
+        'setup_misp_calls': setup_requests,
+        'max_rss_mb': round(max_rss_mb(), 1),
+        'max_rss_growth_mb': round(max_rss_mb() - rss_before, 1),
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the throughput of RedisToMISP against a local fake MISP')
+    parser.add_argument("-s", "--scenarios", nargs='+', default=sorted(SCENARIOS.keys()),
+                        choices=sorted(SCENARIOS.keys()), help="Scenarios to run")
+    parser.add_argument("-n", "--items", type=int, default=2000, help="Number of items per scenario")
+    parser.add_argument("--latency", type=float, default=0.002, help="Latency of the fake MISP in seconds")
+    parser.add_argument("--errorRate", type=float, default=0, help="Probability of a MISP write failing")
+    parser.add_argument("--eventSize", type=int, default=0, help="Number of attributes in the events returned by MISP")
+    parser.add_argument("--workers", type=int, default=0, help="Number of RedisToMISP workers")
+    parser.add_argument("--popBatch", type=int, default=100, help="Items popped in a single round trip")
+    parser.add_argument("--wireFormat", type=str, default='json',
+                        choices=['json', 'msgpack', 'auto'], help="Encoding of the pushed items")
+    parser.add_argument("--compression", type=str, default=None,
+                        choices=['zstd', 'lz4'], help="Compression of the msgpack items")
+    parser.add_argument("--frameSize", type=int, default=1, help="Number of msgpack items per redis entry")
+    parser.add_argument("--timeout", type=float, default=120, help="Maximum duration of a scenario in seconds")
+    parser.add_argument("--host", type=str, default=None,
+                        help="Redis host, an in-memory fakeredis is used if not set")
+    parser.add_argument("-p", "--port", type=int, default=6379, help="The redis port")
+    parser.add_argument("--db", type=int, default=0, help="The redis DB number")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the simulated errors")
+    parser.add_argument("-o", "--output", type=str, default=None, help="Write the results to this JSON file")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    if args.host is None:
+        use_fake_redis()
+        args.host = 'localhost'
+
+    misp = FakeMISPServer(latency=args.latency, error_rate=args.errorRate,
+                          event_size=args.eventSize).start()
+    results = []
+    for name in args.scenarios:
+        result = run_scenario(name, args, misp)
+        results.append(result)
+        print('{scenario:<20} {items_per_second:>9} items/s  p50={latency_p50:.4f}s  '
+              'p99={latency_p99:.4f}s  {misp_calls_per_item} calls/item  '
+              'rss={max_rss_mb}MB  errors={errors}'.format(**result)
+              if result['latency_p50'] is not None else '{scenario:<20} no item received'.format(**result))
+    misp.stop()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'time': time.time(),
+                'python': platform.python_version(),
+                'parameters': {k: v for k, v in vars(args).items() if k != 'output'},
+                'results': results
+            }, f, indent=2)
+        print('Results written to', args.output)
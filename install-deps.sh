@@ -1,3 +1,7 @@
 virtualenv -p python3 wrapenv
 . ./wrapenv/bin/activate
 pip3 install -U pymisp redis
+# optional, for AsyncPyMISPHelper
+pip3 install -U aiohttp
+# optional, for the compact wire format (see WireFormat.py)
+pip3 install -U msgpack zstandard lz4